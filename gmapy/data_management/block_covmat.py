@@ -0,0 +1,58 @@
+import hashlib
+from importlib import metadata
+import numpy as np
+from scipy.linalg import cholesky, LinAlgError
+
+
+# to be increased whenever the content or the computation
+# of the cached blocks changes
+CACHE_FORMAT_VERSION = 2
+
+
+def get_cache_version():
+    """Versions that must match for cached blocks to be reused."""
+    try:
+        gmapy_version = metadata.version('gmapy')
+    except metadata.PackageNotFoundError:
+        gmapy_version = 'unknown'
+    return (CACHE_FORMAT_VERSION, gmapy_version)
+
+
+def get_content_hash(obj):
+    """Hash over nested dictionaries, lists, arrays and scalars.
+
+    The hash only depends on the content, e.g., the order of the
+    keys of dictionaries does not matter. It can therefore be used
+    to recognize unchanged datablocks across sessions.
+    """
+    hasher = hashlib.sha1()
+
+    def update(x):
+        if isinstance(x, dict):
+            hasher.update(b'dict')
+            for key in sorted(x.keys(), key=str):
+                update(str(key))
+                update(x[key])
+        elif isinstance(x, (list, tuple)):
+            hasher.update(b'list' + str(len(x)).encode())
+            for el in x:
+                update(el)
+        elif isinstance(x, np.ndarray):
+            hasher.update(str((x.dtype.str, x.shape)).encode())
+            if x.dtype == object:
+                update(x.tolist())
+            else:
+                hasher.update(np.ascontiguousarray(x).tobytes())
+        else:
+            hasher.update((type(x).__name__ + repr(x)).encode())
+
+    update(obj)
+    return hasher.hexdigest()
+
+
+def factorize_block(block):
+    """Lower Cholesky factor of a block or None if not positive definite."""
+    try:
+        return cholesky(block, lower=True)
+    except LinAlgError:
+        return None
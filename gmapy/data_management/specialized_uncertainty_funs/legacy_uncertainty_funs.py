@@ -50,7 +50,14 @@ def create_dataset_relunc_vector(dataset):
 
     # calculate total uncertainty
     # NOTE: The last element of effCO is ignored!
-    RELU = np.sum(np.square(effCO[:,2:11]), axis=1)
+    # The components are summed one after the other as in Fortran GMAP.
+    # np.sum along the rows uses pairwise summation for C-contiguous
+    # arrays but not for the column-major views of the legacy reader,
+    # which changes the result by up to two ulps if the dataset is
+    # copied, e.g., when it is sent to another process
+    RELU = np.zeros(effCO.shape[0], dtype=float)
+    for L in range(2, 11):
+        RELU += np.square(effCO[:,L])
     curDCS = np.sqrt(XNORU + RELU)
     return curDCS
 
@@ -83,40 +90,48 @@ def create_relative_dataset_covmat(dataset):
         CO /= 10
     # construct correlation matrix for dataset
     covmat = np.zeros((numpts, numpts), dtype=float)
-    problematic_datasets = {}
-    for KS in range(numpts):
-        for KT in range(KS):
-            Q1 = 0.
-            for L in range(2,11):
-                if dataset['NETG'][L] not in (0,9):
-                    FKS = EPAF[0,L] + EPAF[1,L]
-                    if EPAF[2,L] == 0.:
-                        if dataset['NS'] not in problematic_datasets:
-                            print(f'Warning: EPAF[2,{L}] is zero for dataset {dataset["NS"]} '
-                                  f'(MT: {dataset["MT"]}, {dataset.get("BREF","").strip()}, '
-                                  f'{dataset.get("CLABL").strip()}). '
-                                   'You may want to check the uncertainty specifications '
-                                   'of this datasset.')
-                            problematic_datasets[dataset['NS']] = True
-                    XYY = EPAF[1,L] - (E[KS]-E[KT])/(EPAF[2,L]*E[KS])
-                    XYY = max(XYY, 0.)
-                    FKT = EPAF[0,L] + XYY
-                    Q1 += CO[KS,L]*CO[KT,L]*FKS*FKT
+    if numpts > 1:
+        # the covariance elements are computed for all pairs of
+        # points KS > KT at once. The operations are carried out in
+        # the same order as in Fortran GMAP to obtain exactly the
+        # same numbers
+        KS, KT = np.tril_indices(numpts, k=-1)
+        EKS = E[KS]
+        EKT = E[KT]
+        Q1 = np.zeros(len(KS), dtype=float)
+        warned = False
+        for L in range(2,11):
+            if dataset['NETG'][L] in (0,9):
+                continue
+            FKS = EPAF[0,L] + EPAF[1,L]
+            if EPAF[2,L] == 0. and not warned:
+                print(f'Warning: EPAF[2,{L}] is zero for dataset {dataset["NS"]} '
+                      f'(MT: {dataset["MT"]}, {dataset.get("BREF","").strip()}, '
+                      f'{dataset.get("CLABL").strip()}). '
+                       'You may want to check the uncertainty specifications '
+                       'of this datasset.')
+                warned = True
+            with np.errstate(divide='ignore', invalid='ignore'):
+                XYY = EPAF[1,L] - (EKS-EKT)/(EPAF[2,L]*EKS)
+                XYY = np.where(0. > XYY, 0., XYY)
+                FKT = EPAF[0,L] + XYY
+                Q1 += CO[KS,L]*CO[KT,L]*FKS*FKT
 
-            XNORU = 0.
-            if MT not in SHAPE_MT_IDS:
-                XNORU = np.sum(np.square(ENFF))
+        XNORU = 0.
+        if MT not in SHAPE_MT_IDS:
+            XNORU = np.sum(np.square(ENFF))
 
-            CERR = Q1 + XNORU
-            # CERR contains the covariance element.
-            # if corresponding correlation too large, reduce it
-            if CERR / (uncs[KS] * uncs[KT]) > 0.99:
-                CERR = 0.99 * uncs[KS] * uncs[KT]
+        CERR = Q1 + XNORU
+        # CERR contains the covariance elements.
+        # if corresponding correlation too large, reduce it
+        with np.errstate(divide='ignore', invalid='ignore'):
+            too_large = CERR / (uncs[KS] * uncs[KT]) > 0.99
+        CERR = np.where(too_large, 0.99 * uncs[KS] * uncs[KT], CERR)
 
-            covmat[KS, KT] = CERR
-            covmat[KT, KS] = CERR
+        covmat[KS, KT] = CERR
+        covmat[KT, KS] = CERR
 
-        covmat[KS, KS] = uncs[KS]*uncs[KS]
+    covmat[np.diag_indices(numpts)] = uncs*uncs
     return covmat
 
 
@@ -0,0 +1,440 @@
+import numpy as np
+from scipy.sparse import csr_matrix, csc_matrix, coo_matrix, issparse
+from scipy.sparse.csgraph import connected_components
+from scipy.linalg import cholesky, cho_solve, solve_triangular
+
+
+class _CovarianceBlock:
+    # A block is either diagonal, given by the vector of variances,
+    # or dense. Blocks are never modified after creation, hence they
+    # can be shared by several covariance matrices, e.g., the result
+    # of StructuredCovariance.select, together with their factor.
+
+    def __init__(self, kind, mat, factor=None):
+        self.kind = kind
+        self.mat = mat
+        self.factor = factor
+
+    @property
+    def is_diagonal(self):
+        return self.mat.ndim == 1
+
+    @property
+    def size(self):
+        return self.mat.shape[0]
+
+    def get_factor(self):
+        if self.factor is None:
+            if self.is_diagonal:
+                self.factor = np.sqrt(self.mat)
+            else:
+                self.factor = cholesky(self.mat, lower=True)
+        return self.factor
+
+    def _as_column(self, vec, b):
+        return vec.reshape((-1,) + (1,)*(b.ndim-1))
+
+    def solve(self, b):
+        if self.is_diagonal:
+            return b / self._as_column(self.mat, b)
+        return cho_solve((self.get_factor(), True), b)
+
+    def whiten(self, b):
+        if self.is_diagonal:
+            return b / self._as_column(self.get_factor(), b)
+        return solve_triangular(self.get_factor(), b, lower=True)
+
+    def dot(self, b):
+        if self.is_diagonal:
+            return b * self._as_column(self.mat, b)
+        return self.mat @ b
+
+    def logdet(self):
+        if self.is_diagonal:
+            return np.sum(np.log(self.mat))
+        return 2 * np.sum(np.log(np.diagonal(self.get_factor())))
+
+    def inv(self):
+        if self.is_diagonal:
+            return 1. / self.mat
+        return cho_solve((self.get_factor(), True), np.identity(self.size))
+
+    def select(self, keep):
+        if self.is_diagonal:
+            return _CovarianceBlock(self.kind, self.mat[keep])
+        return _CovarianceBlock(self.kind, self.mat[np.ix_(keep, keep)])
+
+    def with_diagonal(self, pos, values):
+        mat = self.mat.copy()
+        if self.is_diagonal:
+            mat[pos] = values
+        else:
+            mat[pos, pos] = values
+        return _CovarianceBlock(self.kind, mat)
+
+    def scale(self, sclvec):
+        if self.is_diagonal:
+            factor = None
+            if self.factor is not None:
+                factor = self.factor * np.abs(sclvec)
+            return _CovarianceBlock(self.kind, self.mat * np.square(sclvec),
+                                    factor)
+        mat = self.mat * sclvec.reshape(1, -1) * sclvec.reshape(-1, 1)
+        # the Cholesky factor of D C D is D L for positive D
+        factor = None
+        if self.factor is not None and np.all(sclvec > 0):
+            factor = self.factor * sclvec.reshape(-1, 1)
+        return _CovarianceBlock(self.kind, mat, factor)
+
+    def coo_entries(self, idcs):
+        if self.is_diagonal:
+            return idcs, idcs
+        return np.repeat(idcs, len(idcs)), np.tile(idcs, len(idcs))
+
+
+class StructuredCovariance:
+    """Covariance matrix composed of uncorrelated blocks.
+
+    Each block covers the rows given by an index array and is either
+    diagonal or dense. A block is labelled by its kind, e.g., 'prior',
+    'exp', 'norm', 'relerr' or 'usu', and several blocks can be of the
+    same kind, e.g., one dense block per experimental datablock.
+    Rows not covered by any block have zero variance.
+
+    The Cholesky factors of the blocks are computed when needed and
+    cached. As blocks are shared between a covariance matrix and the
+    matrices obtained by `select`, `copy` or `concatenate` if they are
+    not changed, the factors are shared as well. Diagonal updates by
+    `set_diagonal` only replace the blocks concerned, so the other
+    factors are kept. Solves with the matrix are performed by calling
+    the object, hence it can be used in place of a factorization.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._blocks = []
+        self._idcs = []
+        self._reset()
+
+    def _reset(self):
+        self._index_map = None
+        self._csr = None
+
+    @classmethod
+    def from_diagonal(cls, variances, kind):
+        variances = np.asarray(variances, dtype=float)
+        covmat = cls(len(variances))
+        if len(variances) > 0:
+            covmat.add_block(kind, np.arange(len(variances)), variances)
+        return covmat
+
+    @classmethod
+    def from_blocks(cls, blocks, kind, factors=None):
+        """Block diagonal matrix of dense blocks in the given order."""
+        if factors is None:
+            factors = [None] * len(blocks)
+        sizes = [np.shape(b)[0] for b in blocks]
+        covmat = cls(int(np.sum(sizes)))
+        offset = 0
+        for block, factor, size in zip(blocks, factors, sizes):
+            idcs = np.arange(offset, offset + size)
+            covmat.add_block(kind, idcs, block, factor)
+            offset += size
+        return covmat
+
+    @classmethod
+    def from_sparse(cls, covmat, kind):
+        """Determine the blocks of a sparse or dense matrix.
+
+        The blocks are given by the connected components of the
+        pattern of the matrix. All rows uncorrelated with the other
+        ones are collected in one diagonal block.
+        """
+        covmat = csr_matrix(covmat)
+        covmat.eliminate_zeros()
+        res = cls(covmat.shape[0])
+        _, labels = connected_components(covmat, directed=False)
+        counts = np.bincount(labels)
+        has_var = np.ravel(abs(covmat).sum(axis=1)) != 0
+        is_single = (counts[labels] == 1) & has_var
+        if np.any(is_single):
+            idcs = np.flatnonzero(is_single)
+            res.add_block(kind, idcs, covmat.diagonal()[idcs])
+        for label in np.flatnonzero(counts > 1):
+            idcs = np.flatnonzero(labels == label)
+            block = covmat[idcs,:][:,idcs].toarray()
+            res.add_block(kind, idcs, block)
+        return res
+
+    @classmethod
+    def concatenate(cls, covmats):
+        """Block diagonal matrix of structured covariance matrices."""
+        res = cls(sum(c.shape[0] for c in covmats))
+        offset = 0
+        for covmat in covmats:
+            res._blocks.extend(covmat._blocks)
+            res._idcs.extend(idcs + offset for idcs in covmat._idcs)
+            offset += covmat.shape[0]
+        return res
+
+    @property
+    def shape(self):
+        return (self._size, self._size)
+
+    def copy(self):
+        res = StructuredCovariance(self._size)
+        res._blocks = list(self._blocks)
+        res._idcs = list(self._idcs)
+        return res
+
+    def add_block(self, kind, idcs, mat, factor=None):
+        idcs = np.asarray(idcs, dtype=int)
+        mat = np.array(mat, dtype=float)
+        if mat.shape[0] != len(idcs) or mat.ndim not in (1, 2):
+            raise IndexError('block does not match the number of indices')
+        if mat.ndim == 2 and mat.shape[0] != mat.shape[1]:
+            raise IndexError('block must be a square matrix')
+        block_of, _ = self._get_index_map()
+        if np.any(block_of[idcs] >= 0):
+            raise IndexError('rows must not belong to several blocks')
+        self._blocks.append(_CovarianceBlock(kind, mat, factor))
+        self._idcs.append(idcs)
+        self._reset()
+
+    def get_blocks(self, kind=None):
+        """List of tuples (kind, idcs, matrix) of the blocks."""
+        return [(b.kind, idcs.copy(), b.mat.copy())
+                for b, idcs in zip(self._blocks, self._idcs)
+                if kind is None or b.kind == kind]
+
+    def get_kind_idcs(self, kind):
+        idcs = [idcs for b, idcs in zip(self._blocks, self._idcs)
+                if b.kind == kind]
+        if len(idcs) == 0:
+            return np.empty(0, dtype=int)
+        return np.sort(np.concatenate(idcs))
+
+    def is_factorized(self):
+        return np.array([b.factor is not None for b in self._blocks],
+                        dtype=bool)
+
+    def _get_index_map(self):
+        # block number and position within block of each row
+        if self._index_map is None:
+            block_of = np.full(self._size, -1, dtype=int)
+            pos = np.full(self._size, -1, dtype=int)
+            for i, idcs in enumerate(self._idcs):
+                block_of[idcs] = i
+                pos[idcs] = np.arange(len(idcs))
+            self._index_map = (block_of, pos)
+        return self._index_map
+
+    def diagonal(self):
+        res = np.zeros(self._size, dtype=float)
+        for block, idcs in zip(self._blocks, self._idcs):
+            res[idcs] = block.mat if block.is_diagonal else block.mat.diagonal()
+        return res
+
+    def _remove_empty_blocks(self):
+        keep = [len(idcs) > 0 for idcs in self._idcs]
+        self._blocks = [b for b, k in zip(self._blocks, keep) if k]
+        self._idcs = [idcs for idcs, k in zip(self._idcs, keep) if k]
+
+    def _remove_rows(self, idcs):
+        block_of, pos = self._get_index_map()
+        for i in np.unique(block_of[idcs]):
+            if i < 0:
+                continue
+            keep = np.full(len(self._idcs[i]), True)
+            keep[pos[idcs[block_of[idcs] == i]]] = False
+            self._blocks[i] = self._blocks[i].select(keep)
+            self._idcs[i] = self._idcs[i][keep]
+        self._remove_empty_blocks()
+        self._reset()
+
+    def set_diagonal(self, idcs, values, uncorrelated=False):
+        """Set the variances of the given rows.
+
+        Only the blocks containing these rows are replaced. If
+        `uncorrelated` is True, the covariances of these rows with
+        all other rows are removed as well.
+        """
+        idcs = np.asarray(idcs, dtype=int)
+        values = np.broadcast_to(np.asarray(values, dtype=float), idcs.shape)
+        block_of, pos = self._get_index_map()
+        cur_blocks = block_of[idcs]
+        # rows not covered by a block and, if they become uncorrelated,
+        # rows of dense blocks are moved to new diagonal blocks
+        move = cur_blocks < 0
+        if uncorrelated:
+            move |= np.array([not self._blocks[i].is_diagonal if i >= 0
+                              else True for i in cur_blocks], dtype=bool)
+        for i in np.unique(cur_blocks[~move]):
+            sel = cur_blocks == i
+            self._blocks[i] = self._blocks[i].with_diagonal(pos[idcs[sel]],
+                                                            values[sel])
+        self._reset()
+        if np.any(move):
+            kinds = [self._blocks[i].kind if i >= 0 else None
+                     for i in cur_blocks[move]]
+            self._remove_rows(idcs[move])
+            for kind in dict.fromkeys(kinds):
+                sel = np.array([k == kind for k in kinds], dtype=bool)
+                self.add_block(kind, idcs[move][sel], values[move][sel])
+
+    def replace(self, idcs, covmat, kind=None):
+        """Replace the covariances of the given rows.
+
+        The rows are removed from their blocks and the blocks of the
+        structured covariance matrix `covmat`, whose dimension is
+        the number of rows, are inserted. Their kind is changed to
+        `kind` unless it is None.
+        """
+        idcs = np.asarray(idcs, dtype=int)
+        if covmat.shape[0] != len(idcs):
+            raise IndexError('dimension of covariance matrix does not '
+                             'match the number of rows')
+        self._remove_rows(idcs)
+        for block, block_idcs in zip(covmat._blocks, covmat._idcs):
+            if kind is not None and kind != block.kind:
+                block = _CovarianceBlock(kind, block.mat, block.factor)
+            self._blocks.append(block)
+            self._idcs.append(idcs[block_idcs])
+        self._reset()
+
+    def select(self, sel):
+        """Submatrix of the rows and columns given by `sel`.
+
+        `sel` is a boolean mask or an array of indices, which
+        determines the order of rows in the result. Blocks completely
+        contained in the selection are shared with this matrix.
+        """
+        sel = np.asarray(sel)
+        if sel.dtype == bool:
+            sel = np.flatnonzero(sel)
+        newpos = np.full(self._size, -1, dtype=int)
+        newpos[sel] = np.arange(len(sel))
+        res = StructuredCovariance(len(sel))
+        for block, idcs in zip(self._blocks, self._idcs):
+            curpos = newpos[idcs]
+            keep = curpos >= 0
+            if np.all(keep):
+                res._blocks.append(block)
+            elif np.any(keep):
+                res._blocks.append(block.select(keep))
+            else:
+                continue
+            res._idcs.append(curpos[keep])
+        return res
+
+    def is_correlated(self, sel):
+        """Check for covariances between the selected and the other rows."""
+        sel = np.asarray(sel)
+        if sel.dtype != bool:
+            mask = np.full(self._size, False)
+            mask[sel] = True
+            sel = mask
+        for block, idcs in zip(self._blocks, self._idcs):
+            if block.is_diagonal:
+                continue
+            cursel = sel[idcs]
+            if np.any(cursel) and not np.all(cursel):
+                offdiag = block.mat[np.ix_(cursel, np.logical_not(cursel))]
+                if np.any(offdiag != 0):
+                    return True
+        return False
+
+    def scale(self, sclvec):
+        """Structured covariance matrix D C D with D = diag(sclvec)."""
+        sclvec = np.asarray(sclvec, dtype=float)
+        res = StructuredCovariance(self._size)
+        res._blocks = [b.scale(sclvec[idcs])
+                       for b, idcs in zip(self._blocks, self._idcs)]
+        res._idcs = list(self._idcs)
+        return res
+
+    def _assemble(self, get_vals):
+        rows, cols, vals = [], [], []
+        for block, idcs in zip(self._blocks, self._idcs):
+            currows, curcols = block.coo_entries(idcs)
+            rows.append(currows)
+            cols.append(curcols)
+            vals.append(np.ravel(get_vals(block)))
+        if len(rows) == 0:
+            return coo_matrix(self.shape, dtype=float)
+        return coo_matrix((np.concatenate(vals),
+                           (np.concatenate(rows), np.concatenate(cols))),
+                          shape=self.shape, dtype=float)
+
+    def tocsr(self):
+        if self._csr is None:
+            self._csr = self._assemble(lambda block: block.mat).tocsr()
+            self._csr.eliminate_zeros()
+        return self._csr.copy()
+
+    def toarray(self):
+        return self.tocsr().toarray()
+
+    def factorize(self):
+        """Compute the factors of all blocks and return the matrix."""
+        block_of, _ = self._get_index_map()
+        if np.any(block_of < 0):
+            raise ValueError('covariance matrix with zero variances '
+                             'cannot be factorized')
+        for block in self._blocks:
+            block.get_factor()
+        return self
+
+    def _apply(self, fun, b):
+        # apply a block operation to a vector, a dense matrix or
+        # a sparse matrix, for the latter only to its nonzero columns
+        if not issparse(b):
+            b = np.asarray(b, dtype=float)
+            res = np.zeros(b.shape, dtype=float)
+            for block, idcs in zip(self._blocks, self._idcs):
+                res[idcs] = fun(block, b[idcs])
+            return res
+        b = csr_matrix(b)
+        rows, cols, vals = [], [], []
+        for block, idcs in zip(self._blocks, self._idcs):
+            curb = b[idcs].tocsc()
+            nzcols = np.flatnonzero(np.diff(curb.indptr))
+            if len(nzcols) == 0:
+                continue
+            curres = fun(block, curb[:, nzcols].toarray())
+            rows.append(np.repeat(idcs, len(nzcols)))
+            cols.append(np.tile(nzcols, len(idcs)))
+            vals.append(curres.ravel())
+        if len(rows) == 0:
+            return csc_matrix(b.shape, dtype=float)
+        res = coo_matrix((np.concatenate(vals),
+                          (np.concatenate(rows), np.concatenate(cols))),
+                         shape=b.shape, dtype=float)
+        return res.tocsc()
+
+    def __call__(self, b):
+        """Solve the linear system with the covariance matrix."""
+        return self._apply(lambda block, x: block.solve(x), b)
+
+    def whiten(self, b):
+        """Multiply by the inverse of the block diagonal Cholesky factor."""
+        return self._apply(lambda block, x: block.whiten(x), b)
+
+    def __matmul__(self, b):
+        return self._apply(lambda block, x: block.dot(x), b)
+
+    def dot(self, b):
+        return self @ b
+
+    def logdet(self):
+        return sum(block.logdet() for block in self._blocks)
+
+    def inv(self):
+        return self._assemble(lambda block: block.inv()).tocsc()
+
+
+def select_covmat(covmat, sel):
+    """Submatrix of a sparse or structured covariance matrix."""
+    if isinstance(covmat, StructuredCovariance):
+        return covmat.select(sel)
+    return covmat.tocsr()[sel,:].tocsc()[:,sel]
@@ -45,10 +45,13 @@ def calculate_ppp_factors(datasets, css):
     return factors
 
 
-def fix_cormat(cormat):
-    """Fix non positive-definite correlation matrix."""
-    if np.any(cormat.diagonal() != 1):
-        raise ValueError('All diagonal elements of correlation matrix must be one')
+def shrink_cormat(cormat):
+    """Divide the off-diagonal elements by 1.1 until positive definite.
+
+    This is the approach of the Fortran GMAP version, which needs a
+    Cholesky factorization per try and is only kept to reproduce
+    its results.
+    """
     tries = 0
     cormat = cormat.copy()
     success = False
@@ -66,5 +69,93 @@ def fix_cormat(cormat):
             break
     if not success:
         raise ValueError('Failed to make the matrix positive definite')
-
     return cormat
+
+
+def _clip_eigenvalues(mat, min_eig):
+    eigvals, eigvecs = np.linalg.eigh(mat)
+    eigvals = np.maximum(eigvals, min_eig)
+    mat = (eigvecs * eigvals) @ eigvecs.T
+    return (mat + mat.T) / 2
+
+
+def clip_cormat_eigenvalues(cormat, min_eig=1e-8):
+    """Repair a correlation matrix by clipping its eigenvalues.
+
+    The eigenvalues below `min_eig` are raised to this value and the
+    result is rescaled to a unit diagonal. Only one eigendecomposition
+    is needed but the result is not the nearest correlation matrix.
+    """
+    return cov2cor(_clip_eigenvalues(cormat, min_eig))
+
+
+def nearest_cormat(cormat, min_eig=1e-8, maxiter=100, tol=1e-10):
+    """Nearest correlation matrix in the Frobenius norm.
+
+    The alternating projections method with Dykstra's correction
+    of Higham (2002), IMA Journal of Numerical Analysis 22, 329-343,
+    is used. It projects alternately on the matrices with eigenvalues
+    not smaller than `min_eig` and the matrices with unit diagonal.
+    Each iteration needs an eigendecomposition.
+    """
+    Y = cormat.copy()
+    dS = np.zeros(cormat.shape, dtype=float)
+    for i in range(maxiter):
+        R = Y - dS
+        X = _clip_eigenvalues(R, min_eig)
+        dS = X - R
+        Y = X.copy()
+        np.fill_diagonal(Y, 1.)
+        if np.linalg.norm(Y - X) <= tol * np.linalg.norm(Y):
+            break
+    # the last projection on the unit diagonal may
+    # leave eigenvalues slightly below min_eig
+    return clip_cormat_eigenvalues(Y, min_eig)
+
+
+def fix_cormat(cormat, method='shrink', min_eig=1e-8, max_higham_size=250,
+               return_distance=False):
+    """Fix non positive-definite correlation matrix.
+
+    Positive definite matrices are returned unchanged. Otherwise,
+    the matrix is repaired according to `method`:
+
+        'higham': nearest correlation matrix, see `nearest_cormat`
+        'clip':   eigenvalue clipping, see `clip_cormat_eigenvalues`
+        'shrink': shrinking of the correlations as done by Fortran GMAP
+        'auto':   'higham' for matrices up to dimension `max_higham_size`
+                  and 'clip' for larger ones
+
+    If `return_distance` is true, the Frobenius norm of the
+    difference between the repaired and the original matrix is also
+    returned.
+    """
+    if np.any(cormat.diagonal() != 1):
+        raise ValueError('All diagonal elements of correlation matrix must be one')
+    if method == 'auto':
+        method = 'higham' if cormat.shape[0] <= max_higham_size else 'clip'
+    if method not in ('higham', 'clip', 'shrink'):
+        raise ValueError(f'unknown method {method} to fix correlation matrix')
+
+    cormat = np.asarray(cormat, dtype=float)
+    if method == 'shrink':
+        # the first try of shrink_cormat is the check of the
+        # unchanged matrix, hence no factorization is done here
+        newcormat = shrink_cormat(cormat)
+    else:
+        try:
+            np.linalg.cholesky(cormat)
+            newcormat = cormat.copy()
+        except np.linalg.LinAlgError:
+            if method == 'higham':
+                newcormat = nearest_cormat(cormat, min_eig)
+            else:
+                newcormat = clip_cormat_eigenvalues(cormat, min_eig)
+            try:
+                np.linalg.cholesky(newcormat)
+            except np.linalg.LinAlgError:
+                raise ValueError('Failed to make the matrix positive definite')
+
+    if return_distance:
+        return newcormat, np.linalg.norm(newcormat - cormat)
+    return newcormat
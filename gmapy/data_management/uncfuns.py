@@ -1,11 +1,16 @@
+import os
+from warnings import warn
 import numpy as np
-from scipy.sparse import block_diag, csr_matrix, diags
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import block_diag, diags
 from .unc_utils import (
     scale_covmat,
     cov2cor,
     calculate_ppp_factors,
     fix_cormat
 )
+from .block_covmat import get_content_hash, get_cache_version, factorize_block
+from .structured_covmat import StructuredCovariance
 from .specialized_uncertainty_funs import (
     legacy_uncertainty_funs as legacy_uncfuns,
     simple_uncertainty_funs as simple_uncfuns
@@ -37,54 +42,184 @@ def create_relative_datablock_covmat(datablock):
     return curfun(datablock)
 
 
-def create_experimental_covmat(datablock_list, propcss=None,
-        fix_ppp_bug=True, fix_covmat=True, relative=False):
-    """Calculate experimental covariance matrix."""
-    uncs = create_relunc_vector(datablock_list)
-    covmat_list = []
+def create_datablock_covmat(datablock, propcss=None,
+        fix_ppp_bug=True, fix_covmat=True, relative=False,
+        return_distance=False):
+    """Calculate the covariance matrix of a single datablock.
+
+    If `fix_covmat` is True, a correlation matrix that is not positive
+    definite is repaired by shrinking the correlations as done by
+    Fortran GMAP. It can also be any method accepted by `fix_cormat`,
+    e.g., 'auto'. If `return_distance` is True, the Frobenius norm of
+    the change of the correlation matrix is also returned.
+    """
+    curuncs = create_relunc_vector([datablock])
+    curexpcss = []
+    for ds in datablock['datasets']:
+        curexpcss.extend(ds['CSS'])
+    curexpcss = np.array(curexpcss, dtype=float)
+    curpropcss = propcss if propcss is not None else curexpcss
+    ppp_factors = calculate_ppp_factors(datablock['datasets'], curpropcss)
+    cureffuncs = curuncs * ppp_factors
+    curabsuncs = curexpcss * cureffuncs * 0.01
+
+    curcovmat = create_relative_datablock_covmat(datablock)
+
+    # This if-else statement is here to be able to
+    # reproduce a bug of the Fortran GMAP version
+    if (datablock['type'] == 'legacy-experiment-datablock' and
+            'ECOR' not in datablock and not fix_ppp_bug):
+        curcormat = legacy_uncfuns.relcov_to_wrong_cor(
+            curcovmat, datablock['datasets'], curpropcss
+        )
+    else:
+        curcormat = cov2cor(curcovmat)
+
+    distance = 0.
+    if fix_covmat:
+        # fix_covmat can also be the name of the repair method
+        method = 'shrink' if fix_covmat is True else fix_covmat
+        try:
+            curcormat, distance = fix_cormat(curcormat, method=method,
+                                             return_distance=True)
+        except Exception:
+            ds_ids = ', '.join((str(ds['NS']) for ds in datablock['datasets']))
+            raise ValueError(f'Problem with covariance matrix of datablock '
+                             f'with dataset ids {ds_ids}')
+
+    if relative:
+        covmat = scale_covmat(curcormat, curabsuncs/curpropcss)
+    else:
+        covmat = scale_covmat(curcormat, curabsuncs)
+    if return_distance:
+        return covmat, distance
+    return covmat
+
+
+def _create_datablock_covmat_list(args_list, options, factorize):
+    # the blocks are factorized where they are created
+    # so that the factorization is done in parallel as well
+    res_list = []
+    for datablock, propcss in args_list:
+        covmat, distance = create_datablock_covmat(
+            datablock, propcss, return_distance=True, **options
+        )
+        factor = factorize_block(covmat) if factorize else None
+        res_list.append((covmat, factor, distance))
+    return res_list
+
+
+def create_experimental_block_covmat(datablock_list, propcss=None,
+        fix_ppp_bug=True, fix_covmat=True, relative=False,
+        num_workers=1, cache_dir=None, factorize=True, kind='exp'):
+    """Calculate the experimental covariance matrix block by block.
+
+    A StructuredCovariance with one dense block of kind `kind` per
+    datablock is returned, whose blocks are also factorized if
+    `factorize` is True. Otherwise the factors are computed on first
+    use. If `num_workers` is larger than one, the blocks are computed
+    by this number of processes. If a
+    directory `cache_dir` is given, the blocks and their factors are
+    stored there under a hash of the content of the datablock, the
+    other arguments and the cache and gmapy versions, so that
+    unchanged datablocks are loaded instead of being recomputed.
+    For every datablock whose correlation matrix had to be fixed,
+    see `create_datablock_covmat`, a warning with the Frobenius norm
+    of the change is issued.
+    """
+    options = {'fix_ppp_bug': fix_ppp_bug, 'fix_covmat': fix_covmat,
+               'relative': relative}
+    args_list = []
     start_idx = 0
     for db in datablock_list:
-        numpts = 0
-        curexpcss = []
-        for ds in db['datasets']:
-            numpts += len(ds['CSS'])
-            curexpcss.extend(ds['CSS'])
+        numpts = sum(len(ds['CSS']) for ds in db['datasets'])
         next_idx = start_idx + numpts
+        curpropcss = None
+        if propcss is not None:
+            curpropcss = np.asarray(propcss[start_idx:next_idx], dtype=float)
+        args_list.append((db, curpropcss))
+        start_idx = next_idx
 
-        curuncs = uncs[start_idx:next_idx]
-        curpropcss = propcss[start_idx:next_idx] if propcss is not None else curexpcss
-        ppp_factors = calculate_ppp_factors(db['datasets'], curpropcss)
-        cureffuncs = curuncs * ppp_factors
-        curabsuncs = curexpcss * cureffuncs * 0.01
+    num_blocks = len(args_list)
+    blocks = [None] * num_blocks
+    factors = [None] * num_blocks
+    distances = [0.] * num_blocks
+    cache_paths = [None] * num_blocks
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_version = get_cache_version()
+        for i, (db, curpropcss) in enumerate(args_list):
+            key = get_content_hash((cache_version, db, curpropcss, options))
+            cache_paths[i] = os.path.join(cache_dir, key + '.npz')
+            if os.path.exists(cache_paths[i]):
+                with np.load(cache_paths[i]) as cached:
+                    blocks[i] = cached['covmat']
+                    distances[i] = float(cached['distance'])
+                    if 'factor' in cached:
+                        factors[i] = cached['factor']
 
-        curcovmat = create_relative_datablock_covmat(db)
+    missing = [i for i in range(num_blocks) if blocks[i] is None]
+    missing_args = [args_list[i] for i in missing]
+    if num_workers == 1 or len(missing) <= 1:
+        res_list = _create_datablock_covmat_list(missing_args, options,
+                                                 factorize)
+    else:
+        chunks = np.array_split(np.arange(len(missing)), num_workers)
+        chunk_args = [[missing_args[i] for i in chunk]
+                      for chunk in chunks if len(chunk) > 0]
+        # exceptions in the workers are raised again by map
+        with ProcessPoolExecutor(max_workers=len(chunk_args)) as executor:
+            num_chunks = len(chunk_args)
+            res_chunks = executor.map(_create_datablock_covmat_list,
+                                      chunk_args, [options]*num_chunks,
+                                      [factorize]*num_chunks)
+            res_list = [res for cur in res_chunks for res in cur]
 
-        # This if-else statement is here to be able to
-        # reproduce a bug of the Fortran GMAP version
-        if (db['type'] == 'legacy-experiment-datablock' and
-                'ECOR' not in db and not fix_ppp_bug):
-            curcormat = legacy_uncfuns.relcov_to_wrong_cor(curcovmat, db['datasets'], curpropcss)
-        else:
-            curcormat = cov2cor(curcovmat)
-
-        if fix_covmat:
-            try:
-                curcormat = fix_cormat(curcormat)
-            except Exception:
-                ds_ids = ', '.join((str(ds['NS']) for ds in db['datasets']))
-                raise ValueError(f'Problem with covariance matrix of datablock '
-                                 f'with dataset ids {ds_ids}')
-
-        if relative:
-            curcovmat = scale_covmat(curcormat, curabsuncs/curpropcss)
-        else:
-            curcovmat = scale_covmat(curcormat, curabsuncs)
+    for i, (covmat, factor, distance) in zip(missing, res_list):
+        blocks[i] = covmat
+        factors[i] = factor
+        distances[i] = distance
+        if cache_paths[i] is not None:
+            arrays = {'covmat': covmat, 'distance': distance}
+            if factor is not None:
+                arrays['factor'] = factor
+            # write to a temporary file first so that
+            # no incomplete file can be picked up later
+            tmppath = cache_paths[i] + f'.{os.getpid()}.tmp.npz'
+            np.savez(tmppath, **arrays)
+            os.replace(tmppath, cache_paths[i])
 
-        covmat_list.append(csr_matrix(curcovmat))
-        start_idx = next_idx
+    # the warnings are issued here because those
+    # of worker processes would not be seen
+    for (db, _), distance in zip(args_list, distances):
+        if distance > 0:
+            ds_ids = ', '.join(str(ds['NS']) for ds in db['datasets'])
+            warn(f'Correlation matrix of datablock with dataset ids '
+                 f'{ds_ids} was not positive definite and has been '
+                 f'fixed (Frobenius norm of change: {distance:.4g})')
 
-    covmat = block_diag(covmat_list, format='csr')
-    return covmat
+    return StructuredCovariance.from_blocks(blocks, kind, factors)
+
+
+def create_experimental_covmat(datablock_list, propcss=None,
+        fix_ppp_bug=True, fix_covmat=True, relative=False,
+        num_workers=1, cache_dir=None, retblockcov=False):
+    """Calculate experimental covariance matrix.
+
+    If `retblockcov` is True, the StructuredCovariance with the
+    factorized blocks is returned instead of the assembled sparse
+    matrix so that the factorizations can be reused. Otherwise the
+    blocks are only factorized to be stored in `cache_dir`.
+    """
+    blockcov = create_experimental_block_covmat(
+        datablock_list, propcss, fix_ppp_bug=fix_ppp_bug,
+        fix_covmat=fix_covmat, relative=relative,
+        num_workers=num_workers, cache_dir=cache_dir,
+        factorize=retblockcov or cache_dir is not None
+    )
+    if retblockcov:
+        return blockcov
+    return blockcov.tocsr()
 
 
 def create_prior_covmat(prior_list):
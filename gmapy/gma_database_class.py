@@ -1,19 +1,24 @@
 import pandas as pd
 import numpy as np
-from scipy.sparse import coo_matrix, csr_matrix, block_diag, diags
+import warnings
 from .data_management.database_IO import read_gma_database
 from .data_management.tablefuns import (
     create_prior_table,
     create_experiment_table
 )
 from .data_management.uncfuns import (
-    create_relunc_vector, create_experimental_covmat,
+    create_relunc_vector, create_experimental_block_covmat,
     create_prior_covmat
 )
-from .data_management.unc_utils import scale_covmat
+from .data_management.structured_covmat import StructuredCovariance
 from .mappings.compound_map import CompoundMap
 from .mappings.relative_error_map import attach_relative_error_df
-from .inference import lm_update, compute_posterior_covmat
+from .inference import (
+    lm_update,
+    incremental_update,
+    leave_one_out_update,
+    PosteriorCovmatQuery
+)
 from .mappings.priortools import (
     propagate_mesh_css,
     attach_shape_prior,
@@ -26,7 +31,8 @@ class GMADatabase:
 
     def __init__(self, dbfile=None, prior_list=None, datablock_list=None,
                  remove_dummy=True, mapping=None, fix_covmat=True,
-                 use_relative_errors=False, abserr_nugget=1e-4):
+                 use_relative_errors=False, abserr_nugget=1e-4,
+                 num_workers=1, covmat_cache_dir=None):
         if dbfile is not None:
             if prior_list is not None or datablock_list is not None:
                 raise ValueError(
@@ -59,12 +65,12 @@ class GMADatabase:
         reluncs[expsel] = create_relunc_vector(db['datablock_list'])
 
         if not mapping:
-            mapping = CompoundMap()
+            mapping = CompoundMap(compiled=True)
         initialize_shape_prior(datatable, mapping, refvals, reluncs)
         # convert absolute experimental errors to relative ones if desired
         if use_relative_errors:
             datatable = attach_relative_error_df(datatable)
-            mapping = CompoundMap()
+            mapping = CompoundMap(compiled=True)
         # define the state variables of the instance
         self._cache = {}
         self._raw_database = db
@@ -73,11 +79,13 @@ class GMADatabase:
         self._mapping = mapping
         self._initialize_uncertainty_info(
             fix_covmat=fix_covmat, use_relative_errors=use_relative_errors,
-            abserr_nugget=abserr_nugget
+            abserr_nugget=abserr_nugget, num_workers=num_workers,
+            covmat_cache_dir=covmat_cache_dir
         )
 
     def _initialize_uncertainty_info(self, fix_covmat, use_relative_errors,
-                                     abserr_nugget):
+                                     abserr_nugget, num_workers=1,
+                                     covmat_cache_dir=None):
         datatable = self._datatable
         db = self._raw_database
         datatable.sort_index(inplace=True)
@@ -89,44 +97,51 @@ class GMADatabase:
         if not np.all(all_sel):
             raise ValueError('something wrong with the datatable!')
 
-        # assemble covariance matrix
-        priorcov = create_prior_covmat(db['prior_list'])
-        expcov = create_experimental_covmat(db['datablock_list'],
-                                            fix_covmat=fix_covmat,
-                                            relative=use_relative_errors)
+        # assemble covariance matrix, which keeps the blocks
+        # of the prior, the experimental datablocks, the normalization
+        # errors and the relative errors separately
+        priorcov = StructuredCovariance.from_sparse(
+            create_prior_covmat(db['prior_list']), 'prior'
+        )
+        # the blocks of the datablocks can be computed in parallel
+        # and are loaded from covmat_cache_dir if unchanged
+        expcov = create_experimental_block_covmat(
+            db['datablock_list'], fix_covmat=fix_covmat,
+            relative=use_relative_errors, num_workers=num_workers,
+            cache_dir=covmat_cache_dir,
+            kind='relerr' if use_relative_errors else 'exp'
+        )
         # we know the order because attach_shape_prior attaches
         # the normalization errors at the end of datatable
         normuncs = datatable.loc[normsel, 'UNC'].to_numpy()
-        normcov = diags(np.square(normuncs), dtype='d')
+        normcov = StructuredCovariance.from_diagonal(np.square(normuncs), 'norm')
         if use_relative_errors:
             isexp = datatable['NODE'].str.match('exp_')
             expvals = datatable.loc[isexp, 'DATA'].to_numpy()
             abscov_diag = expcov.diagonal() * np.square(expvals*abserr_nugget)
-            absexpcov = diags(abscov_diag, format='csr')
-            covmat = block_diag(
-                [priorcov, absexpcov, normcov, expcov], format='csr', dtype='d'
+            absexpcov = StructuredCovariance.from_diagonal(abscov_diag, 'exp')
+            covmat = StructuredCovariance.concatenate(
+                [priorcov, absexpcov, normcov, expcov]
             )
             # special case MT:6 (SACS)
             # in legacy GMA the SACS uncertainties are kept as absolute
             # even if PPP correction is enabled
             is_mt6_exp = (datatable['NODE'].str.match('exp_') &
-                          datatable['REAC'].str.match('MT:6-'))
+                          datatable['REAC'].str.match('MT:6-')).to_numpy()
             is_mt6_relerr = (datatable['NODE'].str.match('relerr_') &
-                             datatable['REAC'].str.match('MT:6-'))
+                             datatable['REAC'].str.match('MT:6-')).to_numpy()
             expvals_mt6 = datatable.loc[is_mt6_exp, 'DATA'].to_numpy()
-            relcov_mt6 = covmat[np.ix_(is_mt6_relerr, is_mt6_relerr)]
-            abscov_mt6 = scale_covmat(relcov_mt6, expvals_mt6)
-            covmat = covmat.tolil()
-            covmat[np.ix_(is_mt6_exp, is_mt6_exp)] = abscov_mt6
+            relcov_mt6 = covmat.select(is_mt6_relerr)
+            abscov_mt6 = relcov_mt6.scale(expvals_mt6)
+            covmat.replace(np.flatnonzero(is_mt6_exp), abscov_mt6, kind='exp')
             # remove the relative SACS errors
             # (because now converted to absolute ones)
             not_mt6_relerr = np.logical_not(is_mt6_relerr)
             datatable = datatable.loc[not_mt6_relerr].reset_index()
-            covmat = covmat[np.ix_(not_mt6_relerr, not_mt6_relerr)]
-            covmat = covmat.tocsr()
+            covmat = covmat.select(not_mt6_relerr)
         else:
-            covmat = block_diag(
-                [priorcov, expcov, normcov], format='csr', dtype='d'
+            covmat = StructuredCovariance.concatenate(
+                [priorcov, expcov, normcov]
             )
         # update uncertainties in datatable
         datatable['UNC'] = np.sqrt(covmat.diagonal())
@@ -137,7 +152,6 @@ class GMADatabase:
 
     def _update_covmat(self):
         datatable = self._datatable
-        covmat = self._covmat
         datatable.sort_index(inplace=True)
         uncs = datatable.UNC.to_numpy()
         if 'uncertainties' in self._cache:
@@ -146,24 +160,13 @@ class GMADatabase:
         else:
             unc_not_changed = np.full(len(uncs), False)
         unc_changed = np.logical_not(unc_not_changed)
-        static_idcs = datatable.index[unc_not_changed]
         changed_idcs = datatable.index[unc_changed]
-        # preserve the static covariance matrix block
-        static_cov = covmat[static_idcs,:][:,static_idcs]
-        static_cov = coo_matrix(static_cov)
-        static_row_idcs = static_idcs[static_cov.row]
-        static_col_idcs = static_idcs[static_cov.col]
-        # replace the covmat block where uncertainties changed
-        # by a diagonal matrix with the new squared uncertainties
+        # the covariance matrix elements where uncertainties changed
+        # are replaced by a diagonal matrix with the new squared
+        # uncertainties, the other blocks are preserved
         new_priorvars = np.square(uncs[unc_changed])
-        row_idcs = np.concatenate([static_row_idcs, changed_idcs])
-        col_idcs = np.concatenate([static_col_idcs, changed_idcs])
-        elems = np.concatenate([static_cov.data, new_priorvars])
-        covmat = csr_matrix(
-            (elems, (row_idcs, col_idcs)),
-            shape=(len(datatable), len(datatable)), dtype='d'
-        )
-        self._covmat = covmat
+        self._covmat.set_diagonal(changed_idcs, new_priorvars,
+                                  uncorrelated=True)
         self._cache['uncertainties'] = uncs
 
     def evaluate(self, remove_idcs=None, ret_uncs=True, **kwargs):
@@ -186,17 +189,26 @@ class GMADatabase:
         self._cache['lmb'] = lmres['lmb']
         self._cache['last_rejected'] = lmres['last_rejected']
         self._cache['converged'] = lmres['converged']
-        self._cache['upd_vals'] = lmres['upd_vals']
-        self._cache['upd_invcov']= lmres['upd_invcov']
         if remove_idcs is None:
             adj_idcs = lmres['idcs']
         else:
-            datatable = self._datatable
             adj_idcs = orig_idcs[lmres['idcs']]
+        return self._store_posterior(lmres, adj_idcs, ret_uncs)
+
+    def _store_posterior(self, res, adj_idcs, ret_uncs):
+        mapping = self._mapping
+        datatable = self._datatable
+        self._cache['upd_vals'] = res['upd_vals']
+        self._cache['upd_invcov']= res['upd_invcov']
+        self._cache['upd_invcov_solver'] = res['upd_invcov_solver']
         self._cache['adj_idcs'] = adj_idcs
+        self._cache['postcov_query'] = PosteriorCovmatQuery(
+            mapping, res['upd_vals'], res['upd_invcov'], adj_idcs,
+            invcov_solver=res['upd_invcov_solver']
+        )
 
         refvals = datatable.PRIOR.to_numpy()
-        refvals[adj_idcs] = lmres['upd_vals']
+        refvals[adj_idcs] = res['upd_vals']
         propvals = propagate_mesh_css(
             datatable, mapping, refvals, prop_normfact=False,
             prop_usu_errors=False
@@ -209,6 +221,58 @@ class GMADatabase:
 
         return propvals
 
+    def _polish_posterior(self, polish_iters, ret_uncs, solver_backend):
+        # a few LM iterations starting from the linearized
+        # solution to account for non-linearities. The column
+        # POST contains predictions, so the start values are the
+        # updated parameters and the prior values of the others
+        startvals = self._datatable['PRIOR'].to_numpy()
+        startvals[self._cache['adj_idcs']] = self._cache['upd_vals']
+        with warnings.catch_warnings():
+            # only a few iterations are done on purpose
+            warnings.filterwarnings(
+                'ignore', message='LM algorithm did not converge'
+            )
+            return self.evaluate(ret_uncs=ret_uncs, startvals=startvals,
+                                 maxiter=polish_iters, must_converge=False,
+                                 solver_backend=solver_backend)
+
+    def _check_incremental_update(self):
+        if 'upd_invcov_solver' not in self._cache:
+            raise ValueError('an incremental update requires ' +
+                             'a previous evaluation')
+
+    def cross_validate(self, num_workers=1):
+        """Leave-one-dataset-out cross-validation.
+
+        Each experimental dataset is left out in turn and the
+        posterior of the previous evaluation is downdated accordingly.
+        The predictions for the left out data are stored in the
+        column LOOPRED of the datatable. A dataframe with the
+        chi-square value of each dataset with respect to the
+        predictions (CHISQR) and with respect to the predictive
+        distribution (PRED_CHISQR) is returned.
+        """
+        self._check_incremental_update()
+        cache = self._cache
+        datatable = self._datatable
+        expdt = datatable.loc[datatable['NODE'].str.match('exp_', na=False)]
+        groups = expdt.groupby('NODE', sort=False).groups
+        nodes = list(groups.keys())
+        group_idcs_list = [np.array(groups[node]) for node in nodes]
+        res = leave_one_out_update(
+            self._mapping, datatable, self._covmat, cache['upd_vals'],
+            cache['adj_idcs'], cache['upd_invcov'], group_idcs_list,
+            invcov_solver=cache['upd_invcov_solver'], num_workers=num_workers
+        )
+        self._datatable['LOOPRED'] = res['loo_preds']
+        return pd.DataFrame({
+            'NODE': nodes,
+            'NUM': res['num_points'],
+            'CHISQR': res['chisqr'],
+            'PRED_CHISQR': res['pred_chisqr']
+        })
+
     def get_prior_idcs(self):
         dt = self._datatable
         priordt = dt.loc[~dt['NODE'].str.match('exp_')]
@@ -227,7 +291,7 @@ class GMADatabase:
 
     def get_priorcov(self):
         prior_idcs = self.get_prior_idcs()
-        priorcov = self._covmat[prior_idcs,:][:,prior_idcs]
+        priorcov = self._covmat.select(prior_idcs).tocsr()
         return priorcov
 
     def get_expvals(self):
@@ -237,7 +301,7 @@ class GMADatabase:
 
     def get_expcov(self):
         exp_idcs = self.get_exp_idcs()
-        expcov = self._covmat[exp_idcs,:][:,exp_idcs]
+        expcov = self._covmat.select(exp_idcs).tocsr()
         return expcov
 
     def get_postvals(self, testdf, **mapargs):
@@ -256,9 +320,26 @@ class GMADatabase:
         else:
             workdf = pd.concat([self._datatable, testdf], axis=0, ignore_index=True)
             idcs = np.arange(len(self._datatable), len(self._datatable) + len(testdf))
-        return compute_posterior_covmat(self._mapping, workdf,
-                self._cache['upd_vals'], self._cache['upd_invcov'],
-                source_idcs=self._cache['adj_idcs'], idcs=idcs, unc_only=unc_only)
+        query = self._cache['postcov_query']
+        return query.compute(workdf, idcs=idcs, unc_only=unc_only)
+
+    def get_postcov_batch(self, testdf_list, unc_only=False):
+        """Compute posterior covariances for several test tables.
+
+        All test tables are processed with a single evaluation of the
+        Jacobian matrix and the cached factorization of the posterior
+        inverse covariance matrix. A list with the posterior
+        covariance matrices or uncertainties is returned.
+        """
+        workdf = pd.concat([self._datatable] + list(testdf_list), axis=0,
+                           ignore_index=True)
+        idcs_list = []
+        offset = len(self._datatable)
+        for testdf in testdf_list:
+            idcs_list.append(np.arange(offset, offset + len(testdf)))
+            offset += len(testdf)
+        query = self._cache['postcov_query']
+        return query.compute_batch(workdf, idcs_list, unc_only=unc_only)
 
     def _remove_data_internal(self, datatable, covmat, idcs):
         self._cache = {}
@@ -271,13 +352,42 @@ class GMADatabase:
         orig_idcs = datatable.index
         datatable.reset_index(drop=True, inplace=True)
         # reduce covariance matrix
-        covmat = covmat[:, inv_remove_mask]
-        covmat = covmat[inv_remove_mask,:]
+        covmat = covmat.select(inv_remove_mask)
         return datatable, covmat, orig_idcs
 
-    def remove_data(self, idcs):
+    def remove_data(self, idcs, incremental=False, polish_iters=0,
+                    ret_uncs=True, solver_backend='auto'):
+        """Remove data from the database.
+
+        If `incremental` is True, the posterior of the previous evaluation
+        is updated by a downdate of the factorization of the posterior
+        inverse covariance matrix instead of being discarded.
+        Optionally, `polish_iters` iterations of the LM algorithm
+        are performed afterwards. New factorizations are computed
+        with the backend `solver_backend`.
+        """
+        cache = self._cache
+        if incremental:
+            self._check_incremental_update()
+            upd_res = incremental_update(
+                self._mapping, self._datatable, self._covmat,
+                cache['upd_vals'], cache['adj_idcs'], cache['upd_invcov'],
+                cache['upd_invcov_solver'], idcs, remove=True,
+                solver_backend=solver_backend
+            )
         res = self._remove_data_internal(self._datatable, self._covmat, idcs)
-        self._datatable, self._covmat, _  = res
+        self._datatable, self._covmat, orig_idcs = res
+        if 'uncertainties' in cache:
+            self._cache['uncertainties'] = cache['uncertainties'][orig_idcs]
+        if incremental:
+            for key in ('lmb', 'last_rejected', 'converged'):
+                if key in cache:
+                    self._cache[key] = cache[key]
+            adj_idcs = np.searchsorted(orig_idcs, upd_res['idcs'])
+            self._store_posterior(upd_res, adj_idcs, ret_uncs)
+            if polish_iters > 0:
+                self._polish_posterior(polish_iters, ret_uncs,
+                                       solver_backend)
         return None
 
     def get_datatable(self):
@@ -295,6 +405,9 @@ class GMADatabase:
         self._update_covmat()
 
     def get_covmat(self):
+        return self._covmat.tocsr()
+
+    def get_structured_covmat(self):
         return self._covmat.copy()
 
     def set_covmat(self, covmat):
@@ -307,19 +420,35 @@ class GMADatabase:
                     'incompatible with the number of rows in datatable')
         # update the uncertainties in table
         self._cache = {}
-        covmat = covmat.copy()
+        if isinstance(covmat, StructuredCovariance):
+            covmat = covmat.copy()
+        else:
+            covmat = StructuredCovariance.from_sparse(covmat, 'user')
         datatable = self._datatable
         datatable.sort_index(inplace=True)
         datatable.UNC = np.sqrt(covmat.diagonal())
         self._covmat = covmat
 
-    def add_data(self, new_datatable, new_covmat):
+    def add_data(self, new_datatable, new_covmat, incremental=False,
+                 polish_iters=0, ret_uncs=True, solver_backend='auto'):
+        """Add data to the database.
+
+        If `incremental` is True, the posterior of the previous evaluation
+        is updated by a rank-k update of the factorization of the posterior
+        inverse covariance matrix. The new data must be experimental data
+        not introducing new parameters. Optionally, `polish_iters`
+        iterations of the LM algorithm are performed afterwards.
+        New factorizations are computed with the backend `solver_backend`.
+        """
         if (len(new_covmat.shape) != 2 or
                 new_covmat.shape[0] != new_covmat.shape[1]):
             raise ValueError('expect square matrix')
         if len(new_datatable) != new_covmat.shape[0]:
             raise ValueError('datatable and covariance matrix must have compatible dimensions')
 
+        if incremental:
+            self._check_incremental_update()
+
         new_uncs = np.sqrt(new_covmat.diagonal())
         if ('UNC' in new_datatable.columns and
                 not np.allclose(new_datatable['UNC'].to_numpy(), new_uncs)):
@@ -332,7 +461,25 @@ class GMADatabase:
             self._cache['uncertainties'] = ext_uncertainties
         self._datatable.sort_index(inplace=True)
         self._datatable = pd.concat([self._datatable, new_datatable], axis=0, ignore_index=True)
-        self._covmat = block_diag([self._covmat, new_covmat], format='csr', dtype='d')
+        if not isinstance(new_covmat, StructuredCovariance):
+            new_covmat = StructuredCovariance.from_sparse(new_covmat, 'exp')
+        self._covmat = StructuredCovariance.concatenate(
+            [self._covmat, new_covmat]
+        )
+        if incremental:
+            cache = self._cache
+            new_idcs = np.arange(len(self._datatable) - len(new_datatable),
+                                 len(self._datatable))
+            upd_res = incremental_update(
+                self._mapping, self._datatable, self._covmat,
+                cache['upd_vals'], cache['adj_idcs'], cache['upd_invcov'],
+                cache['upd_invcov_solver'], new_idcs, remove=False,
+                solver_backend=solver_backend
+            )
+            self._store_posterior(upd_res, upd_res['idcs'], ret_uncs)
+            if polish_iters > 0:
+                self._polish_posterior(polish_iters, ret_uncs,
+                                       solver_backend)
 
     def get_mapping(self):
         return self._mapping
@@ -2,6 +2,7 @@ import pandas as pd
 import numpy as np
 from .mappings.usu_error_map import USUErrorMap
 from .gma_database_class import GMADatabase
+from .data_management.structured_covmat import StructuredCovariance
 import scipy.sparse as spsp
 from scipy.optimize import minimize
 from warnings import warn
@@ -56,10 +57,8 @@ class GMADatabaseUSU(GMADatabase):
         # extend the covariance matrix
         usuuncs = new_dt.UNC[new_dt.NODE.str.match('usu_')]
         usuuncs = usuuncs.to_numpy()
-        usucov = spsp.diags(np.square(usuuncs))
-        covmat = self._covmat
-        self._covmat = spsp.block_diag([covmat, usucov],
-                format='csr')
+        usucov = StructuredCovariance.from_diagonal(np.square(usuuncs), 'usu')
+        self._covmat = StructuredCovariance.concatenate([self._covmat, usucov])
         self._cache['uncertainties'] =  np.concatenate(
                 [self._cache['uncertainties'], usuuncs])
 
@@ -99,7 +98,8 @@ class GMADatabaseUSU(GMADatabase):
         self._usu_coupling_column = coupling_column
 
     def evaluate(self, remove_idcs=None, adjust_usu=True,
-            outer_iter=50, inner_iter=1, atol=1e-6, rtol=1e-6, print_status=False, **lm_options):
+            outer_iter=50, inner_iter=1, atol=1e-6, rtol=1e-6, print_status=False,
+            usu_method='moments', **lm_options):
         if adjust_usu and remove_idcs is not None:
             raise ValueError('dynamic removal of experimental data ' +
                             'and USU adjustment not allowed at the same time')
@@ -139,7 +139,7 @@ class GMADatabaseUSU(GMADatabase):
                 if print_status:
                     print('Estimate USU uncertainties...')
                 old_usu_uncs = dt.UNC[dt.NODE.str.match('usu_')]
-                self.determine_usu_uncertainties()
+                self.determine_usu_uncertainties(method=usu_method)
                 new_usu_uncs = dt.UNC[dt.NODE.str.match('usu_')]
 
             if print_status:
@@ -175,7 +175,13 @@ class GMADatabaseUSU(GMADatabase):
                      'of this run will be used as starting values for '
                      'the next run.')
 
-    def determine_usu_uncertainties(self, refvals=None):
+    def determine_usu_uncertainties(self, refvals=None, method='moments'):
+        # With method='moments', the USU uncertainty of a group is the
+        # root mean square of the USU errors in this group. With
+        # method='ml', the USU uncertainties maximize the likelihood
+        # of the experimental data with the USU errors integrated out.
+        if method not in ('moments', 'ml'):
+            raise ValueError(f'unknown method {method}')
         if self._usu_coupling_column is None:
             raise IndexError('no uncertainty coupling specified! ' +
                    'Please call set_usu_uncertainty_coupling first')
@@ -195,12 +201,48 @@ class GMADatabaseUSU(GMADatabase):
             else:
                 refvals = dt.PRIOR.to_numpy()
 
+        if method == 'ml':
+            # the log likelihood and its gradient are obtained from
+            # the same factorizations for each set of group uncertainties
+            evaluator = mapping.likelihood_evaluator(dt, covmat, expvals)
+            numels = np.ravel(Scoup.sum(axis=0))
+            cur_uncs = evaluator.get_usu_uncertainties()
+            x0 = np.sqrt((Scoup.T @ np.square(cur_uncs)) / numels)
+            # the likelihood depends on the squared uncertainties so
+            # that zero uncertainties are a stationary point. Therefore
+            # the logarithms of the variances are optimized, starting
+            # from a relative uncertainty of one percent if none is given
+            x0 = np.where(x0 > 0., x0, 0.01)
+            logvars0 = np.log(np.square(x0))
+
+            def neg_loglikelihood(logvars):
+                x = np.exp(logvars / 2)
+                usu_uncs = Scoup @ x
+                loglike, grad = evaluator.loglikelihood_and_gradient(
+                    refvals, usu_uncs
+                )
+                return -loglike, -(Scoup.T @ grad) * x / 2
+
+            optres = minimize(neg_loglikelihood, logvars0, jac=True,
+                              method='L-BFGS-B')
+            if not optres.success:
+                warn('maximization of the likelihood with respect to the '
+                     'USU uncertainties failed: ' + str(optres.message))
+            new_uncs = Scoup @ np.exp(optres.x / 2)
+            dt.loc[usu_idcs, 'UNC'] = new_uncs
+            # only the block of the USU errors is replaced
+            covmat.set_diagonal(usu_idcs, np.square(new_uncs))
+            self._cache['uncertainties'] = dt['UNC'].to_numpy()
+            return
+
+        new_vars = np.empty(len(usu_idcs), dtype=float)
         for usu_unc_group in usu_unc_groups:
-            err_sel = (usu_unc_assoc == usu_unc_group)
+            err_sel = (usu_unc_assoc == usu_unc_group).to_numpy()
             numel = err_sel.sum()
             cur_usu_idcs = usu_idcs[err_sel]
             cur_errs = refvals[cur_usu_idcs]
             cur_var = 1/numel * np.sum(np.square(cur_errs))
             dt.loc[cur_usu_idcs, 'UNC'] = np.sqrt(cur_var)
-            covmat[cur_usu_idcs, cur_usu_idcs] = cur_var
-            self._cache['uncertainties'] = dt['UNC'].to_numpy()
+            new_vars[err_sel] = cur_var
+        covmat.set_diagonal(usu_idcs, new_vars)
+        self._cache['uncertainties'] = dt['UNC'].to_numpy()
@@ -26,7 +26,7 @@ def run_gmap_simplified(prior_list=None, datablock_list=None,
         remove_dummy=True):
 
     compmap = CompoundMap(fix_sacs_jacobian=True,
-                          legacy_integration=False)
+                          legacy_integration=False, compiled=True)
 
     if dbfile is not None:
         if dbtype == 'legacy':
@@ -1,16 +1,100 @@
 import numpy as np
 import pandas as pd
-from scipy.sparse import identity, csc_matrix
-from scipy.sparse.linalg import spsolve
-from scipy.linalg.lapack import dpotri, dpotrf
+from scipy.sparse import csr_matrix, csc_matrix, hstack
+from scipy.sparse.csgraph import connected_components
+from scipy.linalg import (cholesky as cholesky_dense, solve_triangular,
+        cho_factor, cho_solve, LinAlgError)
 from sksparse.cholmod import cholesky
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 from .mappings.priortools import propagate_mesh_css
-from .data_management.uncfuns import scale_covmat
+from .linear_solvers import (CholeskySolver, LinearSolver,
+        SchurComplementSolver, WoodburySolver, ScaledSolver,
+        DiagonalUpdateSolver, conjugate_gradients)
+from .selected_inversion import is_covered_by_pattern
+from .data_management.structured_covmat import (
+    StructuredCovariance,
+    select_covmat
+)
 
 
-def gls_update(mapping, datatable, covmat, retcov=False):
-    """Calculate updated values and covariance matrix."""
+def _get_posterior_solver(datatable, isadj, eliminate_norm, solver_backend):
+    # the normalization factors only couple to the data of their
+    # dataset and can be eliminated by a Schur complement
+    if eliminate_norm:
+        is_norm = np.full(len(datatable), False)
+        is_norm[datatable.index] = datatable['NODE'].str.match('norm_',
+                                                               na=False)
+        return SchurComplementSolver(is_norm[isadj], backend=solver_backend)
+    return LinearSolver(backend=solver_backend)
+
+
+def _get_covmat_solver(covmat, create_solver):
+    # structured covariance matrices are solved blockwise
+    # with the cached factorizations of their blocks
+    if isinstance(covmat, StructuredCovariance):
+        return covmat.factorize()
+    return create_solver(covmat)
+
+
+def _get_probing_groups(S, labels):
+    # the columns of the Jacobian matrix S are grouped so that the
+    # columns of a group have no elements in the same block of
+    # correlated data, whose rows are labelled by `labels`
+    S = csc_matrix(S)
+    cols = np.repeat(np.arange(S.shape[1]), np.diff(S.indptr))
+    incidence = csr_matrix(
+        (np.ones(len(cols)), (cols, labels[S.indices])),
+        shape=(S.shape[1], np.max(labels, initial=0) + 1)
+    )
+    conflicts = (incidence @ incidence.T).tocsr()
+    groups = np.full(S.shape[1], -1, dtype=int)
+    for j in range(S.shape[1]):
+        nbs = conflicts.indices[conflicts.indptr[j]:conflicts.indptr[j+1]]
+        used = np.zeros(len(nbs) + 1, dtype=bool)
+        nbgroups = groups[nbs]
+        nbgroups = nbgroups[(nbgroups >= 0) & (nbgroups <= len(nbs))]
+        used[nbgroups] = True
+        groups[j] = np.argmin(used)
+    return groups
+
+
+def _probe_data_diagonal(mult_S, lik_fact, S, groups, block_size=256):
+    # diagonal of S' inv(C) S from one product with S and one solve
+    # per group, where `mult_S` multiplies S with several vectors
+    # and the solves are performed for several groups at once.
+    # With the columns of a group in distinct blocks of the
+    # block-diagonal matrix C, inv(C) S e_j and the sum over the
+    # group coincide in the rows of column j. Without the
+    # structure S, each group must consist of a single column
+    num_groups = np.max(groups, initial=-1) + 1
+    Sstruct = None
+    if S is not None:
+        Sstruct = csc_matrix(
+            (np.ones(S.nnz), S.indices, S.indptr), shape=S.shape
+        )
+    diag = np.zeros(len(groups), dtype=float)
+    for start in range(0, num_groups, block_size):
+        cur_groups = np.arange(start, min(start + block_size, num_groups))
+        U = mult_S(groups.reshape(-1, 1) == cur_groups.reshape(1, -1))
+        W = U * lik_fact(U)
+        if Sstruct is None:
+            sums = np.tile(np.sum(W, axis=0), (len(groups), 1))
+        else:
+            sums = Sstruct.T @ W
+        sel = (groups >= start) & (groups < start + len(cur_groups))
+        diag[sel] = sums[sel, groups[sel] - start]
+    return diag
+
+
+def gls_update(mapping, datatable, covmat, retcov=False,
+               solver_backend='auto', eliminate_norm=False):
+    """Calculate updated values and covariance matrix.
+
+    If `eliminate_norm` is True, the normalization factors are
+    eliminated from the linear system by a Schur complement
+    and obtained afterwards by back-substitution.
+    """
     # prepare quantities required for update
     priorvals = np.full(len(datatable), 0.)
     priorvals[datatable.index] = datatable['PRIOR']
@@ -40,37 +124,70 @@ def gls_update(mapping, datatable, covmat, retcov=False):
     obscovmat = obscovmat[:,isobs]
 
     # prepare the inverse prior covariance matrix
-    idmat = identity(np.sum(isadj), dtype='d').tocsc()
     priorcovmat = covmat[isadj,:].tocsc()
     priorcovmat = priorcovmat[:,isadj]
-    inv_prior_cov = spsolve(priorcovmat, idmat)
+    inv_prior_cov = LinearSolver(priorcovmat, backend=solver_backend).inv()
 
     # perform the update
-    inv_post_cov = S.T @ spsolve(obscovmat, S) + inv_prior_cov
+    obscovmat_solver = LinearSolver(obscovmat, backend=solver_backend)
+    inv_post_cov = S.T @ obscovmat_solver(S) + inv_prior_cov
     # NOTE: the second term in in zvals, which is
     # inv_priorcov * (priorvals-refvals) is omitted because in this
     # GLS update the expansion vector priorvals conincides with refvals
-    zvals = S.T @ spsolve(obscovmat, meas-preds)
-    postvals = priorvals + spsolve(inv_post_cov, zvals)
+    zvals = S.T @ obscovmat_solver(meas-preds)
+    inv_post_cov_solver = _get_posterior_solver(
+        datatable, isadj, eliminate_norm, solver_backend
+    )
+    inv_post_cov_solver.factorize(inv_post_cov)
+    postvals = priorvals + inv_post_cov_solver(zvals)
 
     post_covmat = None
-    if retcov is True:
+    if retcov == 'selected':
+        # only the elements on the pattern of the Cholesky factor
+        # are computed, which includes the posterior variances
+        post_covmat = inv_post_cov_solver.selected_inv()
+    elif retcov is True:
         # following is equivalent to:
         # post_covmat = np.linalg.inv(inv_post_cov.toarray())
-        cholfact, _ = dpotrf(inv_post_cov.toarray(), False, False)
-        invres , info = dpotri(cholfact)
-        if info != 0:
-            raise ValueError('Experimental covariance matrix not positive definite')
+        invres = inv_post_cov_solver.inv().toarray()
         post_covmat = np.triu(invres) + np.triu(invres, k=1).T
 
     return {'upd_vals': postvals, 'upd_covmat': post_covmat,
+            'upd_invcov': inv_post_cov,
+            'upd_invcov_solver': inv_post_cov_solver,
             'idcs': np.sort(datatable.index[isadj])}
 
 
 def lm_update(mapping, datatable, covmat, retcov=False, startvals=None,
         maxiter=10, atol=1e-6, rtol=1e-6, lmb=1e-6, print_status=False,
         correct_ppp=False, ret_invcov=False, must_converge=True,
-        no_reject=False):
+        no_reject=False, solver_backend='auto', inner_solver='direct',
+        pcg_maxiter=None, eliminate_norm=False, marginalize_errors=False):
+    # The damped normal equations are either solved by factorizing
+    # the posterior inverse covariance matrix (inner_solver='direct')
+    # or by preconditioned conjugate gradients (inner_solver='pcg'),
+    # which avoid the construction of this matrix and only need
+    # products of the Jacobian matrix with vectors provided by the
+    # methods jvp and vjp of the mapping. With the direct solver,
+    # the normalization factors can be eliminated from the system
+    # by a Schur complement if eliminate_norm is True.
+    # If marginalize_errors is True, the USU and relative error
+    # parameters are not adjusted but integrated out, i.e., the
+    # experimental covariance matrix C is replaced by C + S_u B S_u'
+    # with the Jacobian matrix S_u of the predictions with respect
+    # to these parameters and their prior covariance matrix B.
+    # The solves with this matrix rely on the Woodbury identity.
+    # As S_u is evaluated at the current parameters and the prior
+    # mean of the marginalized parameters, the effective covariance
+    # matrix is refreshed in each iteration (like the PPP correction).
+    # The returned values of the marginalized parameters are their
+    # conditional posterior means given the final parameters
+    if inner_solver not in ('direct', 'pcg'):
+        raise ValueError(f'unknown inner solver {inner_solver}')
+    if inner_solver == 'pcg' and not (hasattr(mapping, 'jvp') and
+                                      hasattr(mapping, 'vjp')):
+        raise TypeError('the mapping must provide jvp and vjp '
+                        'for the inner solver pcg')
     # define the prior vector
     priorvals = np.full(len(datatable), 0.)
     priorvals[datatable.index] = datatable['PRIOR']
@@ -94,31 +211,151 @@ def lm_update(mapping, datatable, covmat, retcov=False, startvals=None,
     # (a measurement without uncertainty is no measurement)
     if np.any(np.logical_and(has_zerounc, isobs)):
         raise ValueError('observed data must have non-zero uncertainty')
+    # the parameters of the linear error components to be marginalized
+    ismarg = np.full(len(datatable), False)
+    if marginalize_errors:
+        ismarg[datatable.index] = datatable['NODE'].str.match(
+            '(usu|relerr)_', na=False
+        )
+        ismarg = np.logical_and(ismarg, isadj)
+        marginalize_errors = np.any(ismarg)
+    if marginalize_errors:
+        if isinstance(covmat, StructuredCovariance):
+            is_correlated = covmat.is_correlated(ismarg)
+        else:
+            is_correlated = covmat[ismarg,:][:,np.logical_not(ismarg)].count_nonzero() > 0
+        if is_correlated:
+            raise ValueError('the marginalized error parameters must be '
+                             'uncorrelated with the other quantities')
+        isadj = np.logical_and(isadj, np.logical_not(ismarg))
+        # the predictions are linearized at the prior mean
+        fullrefvals[ismarg] = priorvals[ismarg]
+        margcovmat = select_covmat(covmat, ismarg)
+        margcov_solver = _get_covmat_solver(
+            margcovmat, lambda A: LinearSolver(A, backend=solver_backend)
+        )
 
     # prepare experimental covariance matrix
-    obscovmat = covmat[isobs,:].tocsc()
-    obscovmat = obscovmat[:,isobs]
-    orig_obscovmat = obscovmat.copy()
-    # PPP correction
+    obscovmat = select_covmat(covmat, isobs)
+    # the PPP correction rescales the experimental covariance matrix
+    # C to D C D with a diagonal matrix D, hence the solves with the
+    # corrected matrix only require the factorization of C
+    orig_obscovmat_fact = _get_covmat_solver(obscovmat, CholeskySolver)
+    obscovmat_fact = orig_obscovmat_fact
     if correct_ppp:
         tmp_preds = propagate_mesh_css(datatable, mapping, fullrefvals,
                                         prop_normfact=False, mt6_exp=True,
                                         prop_usu_errors=False)
-        obscovmat = scale_covmat(orig_obscovmat, tmp_preds[isobs] / meas)
-        obscovmat_fact = cholesky(obscovmat)
-    else:
-        obscovmat_fact = cholesky(obscovmat)
+        obscovmat_fact = ScaledSolver(orig_obscovmat_fact,
+                                      tmp_preds[isobs] / meas)
     # prepare parameter prior covariance matrix
-    priorcovmat = covmat[isadj,:].tocsc()
-    priorcovmat = priorcovmat[:,isadj]
-    priorcovmat_fact = cholesky(priorcovmat)
-    inv_prior_cov = priorcovmat_fact.inv()
-    # prepare identity matrix for update damping
-    idmat = identity(np.sum(isadj))
+    priorcovmat = select_covmat(covmat, isadj)
+    priorcovmat_fact = _get_covmat_solver(priorcovmat, cholesky)
+    # the inverse prior covariance matrix is only
+    # needed to assemble the posterior one
+    inv_prior_cov = None
+    if inner_solver == 'direct':
+        inv_prior_cov = priorcovmat_fact.inv()
+    # the sparsity pattern of the posterior inverse covariance
+    # matrix does not change, so the selected solver backend
+    # keeps the symbolic analysis throughout the iterations
+    # (the damping term lmb*I is added by the factorization)
+    inv_post_cov_solver = _get_posterior_solver(
+        datatable, isadj, eliminate_norm, solver_backend
+    )
 
     # these quantities remain constant despite
     # throughout the loops below
     priorvals = priorvals[isadj]
+    # the sparsity pattern of the Jacobian matrix only depends
+    # on the datatable, hence the index map to extract the
+    # submatrix of observed data and adjustable parameters
+    # is set up once and the values refilled in each iteration
+    jac_pattern = None
+    if hasattr(mapping, 'jacobian_pattern'):
+        jac_pattern = mapping.jacobian_pattern(datatable)
+        S_submap = jac_pattern.get_submatrix_map(isobs, isadj)
+        if marginalize_errors:
+            Smarg_submap = jac_pattern.get_submatrix_map(isobs, ismarg)
+
+    # the Jacobian matrices with respect to the adjustable
+    # and the marginalized parameters (None if not marginalized).
+    # If `only_marg` is True, the first one is not extracted
+    # and nothing is computed if no errors are marginalized
+    def get_jacobians(fullrefvals, only_marg=False):
+        S = Smarg = None
+        if only_marg and not marginalize_errors:
+            return S, Smarg
+        if jac_pattern is not None:
+            Sfull = mapping.jacobian(fullrefvals, datatable,
+                                     pattern=jac_pattern)
+            if marginalize_errors:
+                Smarg = Smarg_submap.refill(Sfull)
+            if not only_marg:
+                S = S_submap.refill(Sfull)
+            return S, Smarg
+        Sfull = mapping.jacobian(fullrefvals, datatable)
+        Sfull = Sfull[isobs,:].tocsc()
+        if marginalize_errors:
+            Smarg = Sfull[:,ismarg]
+        if not only_marg:
+            S = Sfull[:,isadj]
+        return S, Smarg
+
+    # solver for the experimental covariance matrix
+    # including the marginalized error components
+    def get_likelihood_solver(obscovmat_fact, Smarg):
+        if not marginalize_errors:
+            return obscovmat_fact
+        return WoodburySolver(obscovmat_fact, Smarg, margcov_solver)
+
+    # products with the Jacobian matrix restricted to the
+    # observed data and the adjustable parameters
+    def mult_S(fullrefvals, vec):
+        fullvec = np.zeros(len(fullrefvals), dtype=float)
+        fullvec[isadj] = vec
+        return mapping.jvp(fullrefvals, fullvec, datatable)[isobs]
+
+    def mult_St(fullrefvals, vec):
+        fullvec = np.zeros(len(fullrefvals), dtype=float)
+        fullvec[isobs] = vec
+        return mapping.vjp(fullrefvals, fullvec, datatable)[isadj]
+
+    # products with the columns of a matrix,
+    # evaluated together if the mapping supports it
+    def mult_S_cols(fullrefvals, vecs):
+        vecs = np.asarray(vecs, dtype=float)
+        if not hasattr(mapping, 'jvp_batch'):
+            return np.column_stack([mult_S(fullrefvals, vec)
+                                    for vec in vecs.T])
+        fullvecs = np.zeros((len(fullrefvals), vecs.shape[1]), dtype=float)
+        fullvecs[isadj] = vecs
+        fullrefmat = np.repeat(fullrefvals.reshape(-1, 1), vecs.shape[1],
+                               axis=1)
+        return mapping.jvp_batch(fullrefmat, fullvecs, datatable)[isobs]
+
+    # the preconditioner of the conjugate gradients is the inverse
+    # prior covariance matrix plus the diagonal of the data
+    # contribution S' inv(C) S, because the prior alone does not
+    # precondition the parameters with vague priors. This diagonal
+    # is obtained in the first iteration by products of the Jacobian
+    # matrix with vectors of groups of parameters that influence
+    # disjoint blocks of correlated data, and the preconditioner is
+    # kept for the remaining iterations. Marginalized errors
+    # correlate the blocks, so the diagonal is then approximate.
+    # The inexact solves become more accurate as the gradient decreases
+    if inner_solver == 'pcg':
+        precond_solver = None
+        first_gradnorm = None
+        num_pcg_iter = 0
+        probe_S = None
+        if jac_pattern is not None:
+            probe_S = S_submap.refill(jac_pattern.get_matrix())
+            _, obs_labels = connected_components(obscovmat.tocsr(),
+                                                 directed=False)
+            probe_groups = _get_probing_groups(probe_S, obs_labels)
+        else:
+            probe_groups = np.arange(np.sum(isadj))
 
     old_postvals = None
     num_iter = 0
@@ -129,21 +366,55 @@ def lm_update(mapping, datatable, covmat, retcov=False, startvals=None,
         num_iter += 1
         # get the predictions and Jacobian matrix
         preds = mapping.propagate(fullrefvals, datatable)
-        S = mapping.jacobian(fullrefvals, datatable)
         # reduce the matrices for the LM solve
         refvals = fullrefvals[isadj]
         preds = preds[isobs]
-        S = S[isobs,:].tocsc()
-        S = S[:,isadj]
+        S, Smarg = get_jacobians(fullrefvals,
+                                 only_marg=(inner_solver == 'pcg'))
+        lik_fact = get_likelihood_solver(obscovmat_fact, Smarg)
         # GLS update
-        inv_post_cov = S.T @ obscovmat_fact(S) + inv_prior_cov + lmb * idmat
-        zvec = S.T @ obscovmat_fact(meas-preds) + priorcovmat_fact(priorvals-refvals)
-        postvals = refvals + spsolve(inv_post_cov, zvec)
+        if inner_solver == 'direct':
+            inv_post_cov = S.T @ lik_fact(S) + inv_prior_cov
+            zvec = S.T @ lik_fact(meas-preds) + priorcovmat_fact(priorvals-refvals)
+            inv_post_cov_solver.factorize(inv_post_cov, beta=lmb)
+            postvals = refvals + inv_post_cov_solver(zvec)
+            expected_step = S @ (postvals - refvals)
+        else:
+            zvec = (mult_St(fullrefvals, lik_fact(meas-preds)) +
+                    priorcovmat_fact(priorvals-refvals))
+            gradnorm = np.linalg.norm(zvec)
+            if first_gradnorm is None:
+                first_gradnorm = gradnorm
+            pcg_rtol = 0.1
+            if first_gradnorm > 0:
+                pcg_rtol = min(pcg_rtol, np.sqrt(gradnorm / first_gradnorm))
+            pcg_rtol = max(pcg_rtol, 1e-10)
+
+            def mult_inv_post_cov(vec):
+                res = mult_St(fullrefvals,
+                              lik_fact(mult_S(fullrefvals, vec)))
+                return res + priorcovmat_fact(vec) + lmb * vec
+
+            if precond_solver is None:
+                datadiag = _probe_data_diagonal(
+                    lambda vecs: mult_S_cols(fullrefvals, vecs), lik_fact,
+                    probe_S, probe_groups
+                )
+                precond_solver = DiagonalUpdateSolver(
+                    priorcovmat.tocsr(), datadiag
+                )
+            step, cur_pcg_iter = conjugate_gradients(
+                mult_inv_post_cov, zvec, precond=precond_solver,
+                rtol=pcg_rtol, maxiter=pcg_maxiter
+            )
+            num_pcg_iter += cur_pcg_iter
+            postvals = refvals + step
+            expected_step = mult_S(fullrefvals, step)
 
         # calculate real prediction and expected prediction
         # according to linearization for posterior parameters
         current_propcss = preds
-        expected_propcss = preds + S @ (postvals - refvals)
+        expected_propcss = preds + expected_step
         new_fullrefvals = fullrefvals.copy()
         new_fullrefvals[isadj] = postvals
         real_propcss = mapping.propagate(new_fullrefvals, datatable)
@@ -160,21 +431,22 @@ def lm_update(mapping, datatable, covmat, retcov=False, startvals=None,
         real_measdiff = meas - real_propcss
         # in later iterations, we can adopt for cur_negloglike
         # one of the values from the previous iterations
-        if first_cycle:
-            cur_negloglike = cur_measdiff.T @ obscovmat_fact(cur_measdiff) + cur_neglogprior
-        exp_negloglike = exp_measdiff.T @ obscovmat_fact(exp_measdiff) + new_neglogprior
+        # unless the likelihood changes with the marginalized errors
+        if first_cycle or marginalize_errors:
+            cur_negloglike = cur_measdiff.T @ lik_fact(cur_measdiff) + cur_neglogprior
+        exp_negloglike = exp_measdiff.T @ lik_fact(exp_measdiff) + new_neglogprior
         # calculate the PPP corrected matrix
         if correct_ppp:
             tmp_preds = propagate_mesh_css(datatable, mapping, new_fullrefvals,
                                             prop_normfact=False, mt6_exp=True,
                                             prop_usu_errors=False)
-            new_obscovmat = scale_covmat(orig_obscovmat, tmp_preds[isobs] / meas)
-            new_obscovmat_fact = cholesky(new_obscovmat)
+            new_obscovmat_fact = ScaledSolver(orig_obscovmat_fact,
+                                              tmp_preds[isobs] / meas)
         else:
-            new_obscovmat = obscovmat
             new_obscovmat_fact = obscovmat_fact
+        new_lik_fact = get_likelihood_solver(new_obscovmat_fact, Smarg)
 
-        real_negloglike = real_measdiff.T @ new_obscovmat_fact(real_measdiff) + new_neglogprior
+        real_negloglike = real_measdiff.T @ new_lik_fact(real_measdiff) + new_neglogprior
         # calculate expected and real improvement and use the ratio
         # as criterion to determine the adjustment of the damping term
         exp_improvement = cur_negloglike - exp_negloglike
@@ -197,7 +469,6 @@ def lm_update(mapping, datatable, covmat, retcov=False, startvals=None,
             old_postvals = fullrefvals[isadj]
             fullrefvals[isadj] = postvals
             cur_negloglike = real_negloglike
-            obscovmat = new_obscovmat
             obscovmat_fact = new_obscovmat_fact
             accepted = True
 
@@ -216,6 +487,8 @@ def lm_update(mapping, datatable, covmat, retcov=False, startvals=None,
             print('real_improvement: ' + str(real_improvement))
             print('lambda used: ' + str(lmb_used))
             print('rho: ' + str(rho))
+            if inner_solver == 'pcg':
+                print('pcg iterations: ' + str(cur_pcg_iter))
             if old_postvals is not None:
                 print('maximal relative parameter change: ' + str(maxreldiff))
             print('accepted' if accepted else 'REJECTED!')
@@ -236,34 +509,377 @@ def lm_update(mapping, datatable, covmat, retcov=False, startvals=None,
     res = {'upd_vals': postvals, 'upd_covmat': None,
             'idcs': np.sort(datatable.index[isadj]), 'lmb': lmb,
             'last_rejected': (not accepted), 'converged': converged}
+    if inner_solver == 'pcg':
+        res['num_pcg_iter'] = num_pcg_iter
+
+    if marginalize_errors:
+        # the marginalized parameters are returned alongside the
+        # other parameters and the results refer to both
+        final_fullrefvals = fullrefvals.copy()
+        final_fullrefvals[isadj] = postvals
+        final_preds = mapping.propagate(final_fullrefvals, datatable)[isobs]
+        S, Smarg = get_jacobians(final_fullrefvals)
+        lik_fact = get_likelihood_solver(obscovmat_fact, Smarg)
+        final_fullrefvals[ismarg] += margcovmat @ (
+            Smarg.T @ lik_fact(meas - final_preds)
+        )
+        isadj = np.logical_or(isadj, ismarg)
+        res['upd_vals'] = final_fullrefvals[isadj]
+        res['idcs'] = np.sort(datatable.index[isadj])
+        if ret_invcov:
+            S = mapping.jacobian(final_fullrefvals, datatable)
+            S = S[isobs,:].tocsc()[:,isadj]
+            priorcovmat = select_covmat(covmat, isadj)
+            inv_prior_cov = _get_covmat_solver(priorcovmat, cholesky).inv()
+            inv_post_cov_solver = _get_posterior_solver(
+                datatable, isadj, eliminate_norm, solver_backend
+            )
 
     if ret_invcov:
+        if S is None:
+            # the conjugate gradients do not need these
+            S, _ = get_jacobians(fullrefvals)
+            inv_prior_cov = priorcovmat_fact.inv()
         inv_post_cov = S.T @ obscovmat_fact(S) + inv_prior_cov
+        inv_post_cov_solver.factorize(inv_post_cov)
         res['upd_invcov'] = inv_post_cov
+        res['upd_invcov_solver'] = inv_post_cov_solver
 
     return res
 
 
-def compute_posterior_covmat(mapping, datatable, postvals, invcovmat,
-        source_idcs, idcs=None,  unc_only=False, **mapargs):
-    # calculate the refvals
+def _linearize_at_posterior(mapping, datatable, postvals, source_idcs):
     has_prior = np.logical_not(datatable.PRIOR.isna())
     refvals = np.zeros(len(datatable))
     refvals[has_prior] = datatable.loc[has_prior, 'PRIOR'].to_numpy()
     refvals[source_idcs] = postvals
-    # calculate and trim sensitivity matrix
-    S = mapping.jacobian(refvals, datatable, **mapargs)
-    if idcs is not None:
-        S = S[idcs,:]
-    if source_idcs is not None:
-        S = S[:, source_idcs]
-    S = S.tocsr()
-    invcovmat = invcovmat.tocsc(copy=True)
-
-    cov_times_St = spsolve(invcovmat, S.T)
-    if unc_only:
-        uncs = np.sqrt(np.sum(S.multiply(cov_times_St.T), axis=1))
-        return np.ravel(uncs)
+    preds = mapping.propagate(refvals, datatable)
+    S = mapping.jacobian(refvals, datatable).tocsr()
+    S = S[:, source_idcs]
+    return preds, S
+
+
+def _get_correlated_idcs(labels, data_idcs):
+    block_idcs = np.where(np.isin(labels, labels[data_idcs]))[0]
+    return np.setdiff1d(block_idcs, data_idcs)
+
+
+def _whiten_data_contribution(S, resid, covmat, data_idcs, other_idcs):
+    S_k = S[data_idcs,:].toarray()
+    res_k = resid[data_idcs]
+    cov_kk = covmat[data_idcs,:][:,data_idcs].toarray()
+    # with the remaining correlated data o, the contribution of the data k
+    # to the inverse covariance matrix is given by S' U inv(Z) U' S with
+    # U = [I, -inv(C_oo) C_ok] and the Schur complement
+    # Z = C_kk - C_ko inv(C_oo) C_ok
+    if len(other_idcs) > 0:
+        cov_oo = covmat[other_idcs,:][:,other_idcs].toarray()
+        cov_ok = covmat[other_idcs,:][:,data_idcs].toarray()
+        X = cho_solve(cho_factor(cov_oo, lower=True), cov_ok)
+        S_k -= X.T @ S[other_idcs,:].toarray()
+        res_k = res_k - X.T @ resid[other_idcs]
+        cov_kk -= cov_ok.T @ X
+    # with Z = L L' we have S' U inv(Z) U' S = W W' for W = (inv(L) U' S)'
+    schur_chol = cholesky_dense(cov_kk, lower=True)
+    W = solve_triangular(schur_chol, S_k, lower=True).T
+    wres = solve_triangular(schur_chol, res_k, lower=True)
+    return W, wres
+
+
+def incremental_update(mapping, datatable, covmat, postvals, source_idcs,
+        invcovmat, invcov_solver, data_idcs, remove=False,
+        solver_backend='auto'):
+    """Update the posterior for added or removed experimental data.
+
+    The posterior distribution given by `postvals` and the posterior
+    inverse covariance matrix `invcovmat` with its factorization
+    `invcov_solver` is updated for the experimental data in the rows
+    `data_idcs` of the datatable. The datatable and covariance matrix
+    must include these data. The model is linearized at the current
+    posterior values and the factorization is modified by a rank-k
+    update (if `remove` is False) or downdate (if `remove` is True).
+    The solver object is modified in place.
+
+    Adjustable parameters, such as normalization errors, can be
+    removed alongside the experimental data if no other data depend
+    on them. In this case, a new factorization is computed for the
+    reduced posterior inverse covariance matrix with the backend
+    `solver_backend`.
+    """
+    data_idcs = np.sort(np.asarray(data_idcs))
+    is_param = np.isin(data_idcs, source_idcs)
+    param_idcs = data_idcs[is_param]
+    data_idcs = data_idcs[np.logical_not(is_param)]
+    if len(param_idcs) > 0 and not remove:
+        raise ValueError('adjustable parameters cannot be added ' +
+                         'in an incremental update')
+    # only the data correlated with the added or removed data
+    # are relevant for the update of the posterior
+    covmat = covmat.tocsr()
+    _, labels = connected_components(covmat, directed=False)
+    other_idcs = _get_correlated_idcs(labels, data_idcs)
+    block_idcs = np.union1d(data_idcs, other_idcs)
+    if np.any(datatable.loc[block_idcs, 'DATA'].isna()):
+        raise ValueError('only experimental data and adjustable parameters ' +
+                         'can be removed in an incremental update')
+    # linearize the model at the current posterior values
+    preds, S = _linearize_at_posterior(mapping, datatable, postvals,
+                                       source_idcs)
+    resid = datatable['DATA'].to_numpy() - preds
+    W, wres = _whiten_data_contribution(S, resid, covmat,
+                                        data_idcs, other_idcs)
+    W = csc_matrix(W)
+    # the gradient of the negative log posterior of the original
+    # data vanishes at the posterior, hence the Newton step
+    # only depends on the residuals of the added or removed data
+    grad = W @ wres
+    if remove:
+        grad *= -1.
+        upd_invcov = csc_matrix(invcovmat - W @ W.T)
+    else:
+        upd_invcov = csc_matrix(invcovmat + W @ W.T)
+
+    if len(param_idcs) == 0:
+        invcov_solver.update(W, subtract=remove)
+        upd_vals = postvals + invcov_solver(grad)
+        upd_idcs = source_idcs
+    else:
+        # the removed parameters are decoupled from the remaining ones
+        keep = np.logical_not(np.isin(source_idcs, param_idcs))
+        upd_invcov = upd_invcov[keep,:][:,keep]
+        invcov_solver = LinearSolver(upd_invcov, backend=solver_backend)
+        upd_vals = postvals[keep] + invcov_solver(grad[keep])
+        upd_idcs = source_idcs[keep]
+    return {'upd_vals': upd_vals, 'upd_invcov': upd_invcov,
+            'upd_invcov_solver': invcov_solver, 'idcs': upd_idcs}
+
+
+def _leave_one_out_worker(invcov_solver, S, preds, resid, covmat, labels,
+                          group_idcs_list):
+    res_list = []
+    for data_idcs in group_idcs_list:
+        data_idcs = np.sort(np.asarray(data_idcs))
+        other_idcs = _get_correlated_idcs(labels, data_idcs)
+        W, wres = _whiten_data_contribution(S, resid, covmat,
+                                            data_idcs, other_idcs)
+        # the inverse of the downdated matrix P - W W' is applied
+        # by means of the Woodbury identity so that the factorization
+        # of P is shared by all datasets. With Y = inv(P) W and
+        # M = I - W' Y, the Newton step is given by -Y inv(M) wres
+        Y = invcov_solver(W)
+        M = np.identity(W.shape[1]) - W.T @ Y
+        try:
+            z = cho_solve(cho_factor(M, lower=True), wres)
+        except LinAlgError:
+            # M is singular if some parameters are only
+            # determined by the left out data so that
+            # the leave-one-out posterior is improper
+            res_list.append({
+                'loo_preds': np.full(len(data_idcs), np.nan),
+                'chisqr': np.nan,
+                'pred_chisqr': np.nan
+            })
+            continue
+        parvals_diff = -Y @ z
+        loo_preds = preds[data_idcs] + S[data_idcs,:] @ parvals_diff
+        # the whitened residuals with respect to the leave-one-out
+        # posterior are given by z and their predictive
+        # covariance matrix by inv(M)
+        res_list.append({
+            'loo_preds': loo_preds,
+            'chisqr': z @ z,
+            'pred_chisqr': wres @ (M @ wres)
+        })
+    return res_list
+
+
+def _leave_one_out_process(invcovmat, backend, *args):
+    # the factorization cannot be sent to the process
+    # and is therefore recomputed once per process
+    invcov_solver = LinearSolver(invcovmat, backend=backend)
+    return _leave_one_out_worker(invcov_solver, *args)
+
+
+def leave_one_out_update(mapping, datatable, covmat, postvals, source_idcs,
+        invcovmat, group_idcs_list, invcov_solver=None, num_workers=1,
+        solver_backend='auto'):
+    """Leave-one-dataset-out predictions and chi-square values.
+
+    Each element of `group_idcs_list` contains the row indices of
+    experimental data in the datatable, usually the ones of a single
+    dataset. Starting from the posterior given by `postvals` and the
+    posterior inverse covariance matrix `invcovmat`, the contribution
+    of each group is removed by a block downdate and the posterior
+    without this group is obtained by a Newton step of the model
+    linearized at the posterior. The factorization `invcov_solver`
+    of `invcovmat` is shared by all groups. If `num_workers` is
+    larger than one, the groups are distributed among this number
+    of processes, each of which factorizes `invcovmat` with the
+    backend of `invcov_solver`. If no factorization is given, it is
+    computed with the backend `solver_backend`.
+
+    The predictions for the left out data are returned in the
+    vector `loo_preds` of the length of the datatable. The elements
+    of the array `chisqr` are the chi-square values of the left out
+    data with respect to the predictions, and the elements of
+    `pred_chisqr` the ones computed with the covariance matrix of
+    the predictive distribution, which includes the posterior
+    uncertainty of the predictions. Correlations with the other
+    data are taken into account by conditioning on them.
+    If some parameters are only determined by the left out data,
+    the predictions and chi-square values of the group are NaN.
+    """
+    covmat = covmat.tocsr()
+    _, labels = connected_components(covmat, directed=False)
+    preds, S = _linearize_at_posterior(mapping, datatable, postvals,
+                                       source_idcs)
+    resid = datatable['DATA'].to_numpy() - preds
+    for data_idcs in group_idcs_list:
+        if np.any(np.isnan(resid[data_idcs])):
+            raise ValueError('only experimental data can be left out')
+    worker_args = (S, preds, resid, covmat, labels)
+    if num_workers == 1 or len(group_idcs_list) <= 1:
+        if invcov_solver is None:
+            invcov_solver = LinearSolver(invcovmat, backend=solver_backend)
+        res_list = _leave_one_out_worker(invcov_solver, *worker_args,
+                                         group_idcs_list)
     else:
-        postcov = S @ cov_times_St
-        return postcov
+        chunks = np.array_split(np.arange(len(group_idcs_list)), num_workers)
+        chunks = [chunk for chunk in chunks if len(chunk) > 0]
+        # the processes factorize in the same way as a serial run
+        backend = solver_backend
+        if invcov_solver is not None:
+            backend = invcov_solver.get_backend() or solver_backend
+        # exceptions in the workers are raised again by result
+        with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+            futures = []
+            for chunk in chunks:
+                cur_group_idcs_list = [group_idcs_list[i] for i in chunk]
+                futures.append(executor.submit(
+                    _leave_one_out_process, invcovmat, backend, *worker_args,
+                    cur_group_idcs_list
+                ))
+            res_list = []
+            for future in futures:
+                res_list.extend(future.result())
+
+    loo_preds = np.full(len(datatable), np.nan)
+    for data_idcs, curres in zip(group_idcs_list, res_list):
+        loo_preds[np.sort(np.asarray(data_idcs))] = curres['loo_preds']
+    return {
+        'loo_preds': loo_preds,
+        'chisqr': np.array([r['chisqr'] for r in res_list], dtype=float),
+        'pred_chisqr': np.array([r['pred_chisqr'] for r in res_list],
+                                dtype=float),
+        'num_points': np.array([len(g) for g in group_idcs_list], dtype=int)
+    }
+
+
+class PosteriorCovmatQuery:
+    """Repeated queries of posterior covariances and uncertainties.
+
+    The posterior inverse covariance matrix is factorized once
+    (or the factorization is taken from `invcov_solver`) and reused
+    for all subsequent queries. The sensitivity matrix of the
+    requested quantities is passed through the factorization
+    in blocks of `block_size` rows to limit the memory footprint.
+    """
+
+    def __init__(self, mapping, postvals, invcovmat, source_idcs,
+                 invcov_solver=None, block_size=256):
+        self.__mapping = mapping
+        self.__postvals = postvals
+        self.__source_idcs = source_idcs
+        self.__block_size = block_size
+        if invcov_solver is None:
+            invcov_solver = LinearSolver(invcovmat)
+        self.__solver = invcov_solver
+
+    def get_solver(self):
+        return self.__solver
+
+    def _get_sensmat(self, datatable, idcs=None, **mapargs):
+        source_idcs = self.__source_idcs
+        # calculate the refvals
+        has_prior = np.logical_not(datatable.PRIOR.isna())
+        refvals = np.zeros(len(datatable))
+        refvals[has_prior] = datatable.loc[has_prior, 'PRIOR'].to_numpy()
+        refvals[source_idcs] = self.__postvals
+        # calculate and trim sensitivity matrix
+        S = self.__mapping.jacobian(refvals, datatable, **mapargs)
+        if idcs is not None:
+            S = S[idcs,:]
+        if source_idcs is not None:
+            S = S[:, source_idcs]
+        return S.tocsr()
+
+    def _compute_uncs(self, S):
+        solver = self.__solver
+        # the posterior variances of rows of S whose nonzero
+        # elements are all connected in the pattern of the Cholesky
+        # factor are obtained from the selected inverse
+        uncs_sq = np.zeros(S.shape[0], dtype=float)
+        is_covered = np.full(S.shape[0], False)
+        if solver.get_backend() == 'cholmod':
+            postcov_sel = solver.selected_inv()
+            is_covered = is_covered_by_pattern(S, postcov_sel)
+            covS = S[is_covered,:]
+            uncs_sq[is_covered] = np.ravel(
+                np.sum(covS.multiply(covS @ postcov_sel), axis=1)
+            )
+        # the remaining ones require solves with the factor
+        uncov_idcs = np.where(np.logical_not(is_covered))[0]
+        for start in range(0, len(uncov_idcs), self.__block_size):
+            curidcs = uncov_idcs[start:start+self.__block_size]
+            curS = S[curidcs,:]
+            cov_times_St = solver(curS.T.tocsc())
+            uncs_sq[curidcs] = np.ravel(
+                np.sum(curS.multiply(cov_times_St.T), axis=1)
+            )
+        return np.sqrt(uncs_sq)
+
+    def _compute_covmat(self, S):
+        solver = self.__solver
+        if S.shape[0] == 0:
+            return csr_matrix(S.shape[:1]*2, dtype=float)
+        # the columns of the covariance matrix
+        # are computed block by block
+        blocks = []
+        for start in range(0, S.shape[0], self.__block_size):
+            curS = S[start:start+self.__block_size,:]
+            cov_times_St = solver(curS.T.tocsc())
+            blocks.append(csc_matrix(S @ cov_times_St))
+        return hstack(blocks, format='csr')
+
+    def compute(self, datatable, idcs=None, unc_only=False, **mapargs):
+        S = self._get_sensmat(datatable, idcs, **mapargs)
+        if unc_only:
+            return self._compute_uncs(S)
+        else:
+            return self._compute_covmat(S)
+
+    def compute_batch(self, datatable, idcs_list, unc_only=False, **mapargs):
+        """Answer several queries with a single Jacobian evaluation.
+
+        `idcs_list` is a list of index arrays referring to rows
+        of the datatable. The result is a list with the posterior
+        uncertainties or the posterior covariance matrix
+        associated with each element in `idcs_list`.
+        """
+        S = self._get_sensmat(datatable, **mapargs)
+        res = []
+        for idcs in idcs_list:
+            curS = S[idcs,:]
+            if unc_only:
+                res.append(self._compute_uncs(curS))
+            else:
+                res.append(self._compute_covmat(curS))
+        return res
+
+
+def compute_posterior_covmat(mapping, datatable, postvals, invcovmat,
+        source_idcs, idcs=None,  unc_only=False, invcov_solver=None,
+        **mapargs):
+    query = PosteriorCovmatQuery(mapping, postvals, invcovmat,
+                                 source_idcs, invcov_solver)
+    return query.compute(datatable, idcs, unc_only, **mapargs)
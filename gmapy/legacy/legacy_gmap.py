@@ -46,7 +46,8 @@ def run_gmap(dbfile='data.gma', resfile='gma.res', plotfile='plot.dta',
     # END LEGACY
 
     compmap = CompoundMap(fix_sacs_jacobian=fix_sacs_jacobian,
-                          legacy_integration=legacy_integration)
+                          legacy_integration=legacy_integration,
+                          compiled=True)
 
     if dbtype == 'legacy':
         db_dic = read_gma_database(dbfile, format_dic=format_dic)
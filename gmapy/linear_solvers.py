@@ -0,0 +1,614 @@
+import warnings
+import numpy as np
+from scipy.sparse import (csc_matrix, csr_matrix, issparse, identity,
+        hstack, vstack, diags)
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import splu
+from scipy.linalg import (cho_factor, cho_solve, cholesky as cholesky_dense,
+        solve_triangular, LinAlgError)
+from sksparse.cholmod import analyze, CholmodNotPositiveDefiniteError
+from .selected_inversion import selected_inverse
+
+
+# matrices up to this dimension are always
+# handled by the dense LAPACK backend
+DENSE_SIZE_LIMIT = 500
+# matrices up to this dimension are handled by the
+# dense backend if their fraction of nonzero elements
+# exceeds DENSE_DENSITY_LIMIT
+DENSE_MAX_SIZE = 5000
+DENSE_DENSITY_LIMIT = 0.3
+
+
+def _as_sorted_csc(A):
+    if not issparse(A):
+        A = csc_matrix(A)
+    A = A.tocsc()
+    if not A.has_sorted_indices:
+        A = A.sorted_indices()
+    return A
+
+
+def _solve_sparse_rhs(solve, B, block_size=256):
+    # solvers working with dense right-hand sides
+    # are fed with blocks of columns of the sparse matrix B
+    B = B.tocsc()
+    blocks = []
+    for start in range(0, B.shape[1], block_size):
+        stop = min(start + block_size, B.shape[1])
+        curB = B[:, start:stop].toarray()
+        blocks.append(csc_matrix(solve(curB)))
+    if len(blocks) == 0:
+        return csc_matrix(B.shape, dtype=float)
+    return hstack(blocks, format='csc')
+
+
+class CholeskySolver:
+    """Sparse Cholesky solver reusing the symbolic analysis.
+
+    The fill-reducing ordering and the symbolic factorization
+    are computed once and kept as long as the sparsity pattern
+    of the matrices passed to `factorize` does not change.
+    Subsequent factorizations are therefore purely numerical.
+    The argument `mode` is passed to CHOLMOD, e.g., 'simplicial'
+    yields an LDL' instead of a supernodal LL' factorization.
+    """
+
+    def __init__(self, A=None, beta=0., mode='auto'):
+        self._mode = mode
+        self._factor = None
+        self._is_numeric = False
+        self._indptr = None
+        self._indices = None
+        self.num_analyze = 0
+        self.num_factorize = 0
+        if A is not None:
+            self.factorize(A, beta)
+
+    def _analyze_if_needed(self, A):
+        if (self._factor is not None and
+                np.array_equal(self._indptr, A.indptr) and
+                np.array_equal(self._indices, A.indices)):
+            return
+        self._factor = analyze(A, mode=self._mode)
+        self._is_numeric = False
+        self._indptr = A.indptr.copy()
+        self._indices = A.indices.copy()
+        self.num_analyze += 1
+
+    def factorize(self, A, beta=0.):
+        """Numerically factorize A + beta*I in place."""
+        A = _as_sorted_csc(A)
+        self._analyze_if_needed(A)
+        self._factor.cholesky_inplace(A, beta)
+        self._is_numeric = True
+        self.num_factorize += 1
+        return self
+
+    def new_factor(self, A, beta=0.):
+        """Return a new CHOLMOD factor of A + beta*I.
+
+        The symbolic analysis of this solver is reused
+        but the factor held by the solver is not modified.
+        """
+        A = _as_sorted_csc(A)
+        self._analyze_if_needed(A)
+        self.num_factorize += 1
+        return self._factor.cholesky(A, beta)
+
+    def update(self, C, subtract=False):
+        """Update the factor in place to represent A + C*C' or A - C*C'."""
+        factor = self.get_factor()
+        factor.update_inplace(_as_sorted_csc(C), subtract)
+        if subtract and np.any(factor.D() <= 0.):
+            raise CholmodNotPositiveDefiniteError(
+                'matrix not positive definite after downdate'
+            )
+        # the update may alter the sparsity pattern of the factor,
+        # hence the next factorization requires a new analysis
+        self._indptr = None
+        self._indices = None
+        return self
+
+    def get_factor(self):
+        if not self._is_numeric:
+            raise ValueError('no matrix has been factorized yet')
+        return self._factor
+
+    def __call__(self, b):
+        return self.get_factor()(b)
+
+    def logdet(self):
+        return self.get_factor().logdet()
+
+    def inv(self):
+        return self.get_factor().inv()
+
+    def selected_inv(self):
+        return selected_inverse(factor=self.get_factor())
+
+
+class SuperLUSolver:
+    """Sparse LU solver based on SuperLU."""
+
+    def __init__(self, A=None, beta=0.):
+        self._lu = None
+        self._A = None
+        self.num_factorize = 0
+        if A is not None:
+            self.factorize(A, beta)
+
+    def factorize(self, A, beta=0.):
+        A = _as_sorted_csc(A)
+        if beta != 0.:
+            A = A + beta * identity(A.shape[0], format='csc')
+        self._A = A
+        self._lu = splu(A)
+        self.num_factorize += 1
+        return self
+
+    def update(self, C, subtract=False):
+        C = csc_matrix(C)
+        CCt = C @ C.T
+        return self.factorize(self._A - CCt if subtract else self._A + CCt)
+
+    def _solve_dense(self, b):
+        return self._lu.solve(np.asarray(b, dtype=float))
+
+    def __call__(self, b):
+        if self._lu is None:
+            raise ValueError('no matrix has been factorized yet')
+        if issparse(b):
+            return _solve_sparse_rhs(self._solve_dense, b)
+        return self._solve_dense(b)
+
+    def logdet(self):
+        # the diagonal of L only contains ones
+        return np.sum(np.log(np.abs(self._lu.U.diagonal())))
+
+    def inv(self):
+        return self(identity(self._lu.shape[0], format='csc'))
+
+    def selected_inv(self):
+        return self.inv()
+
+
+class DenseCholeskySolver:
+    """Dense Cholesky solver relying on LAPACK."""
+
+    def __init__(self, A=None, beta=0.):
+        self._cho = None
+        self._A = None
+        self.num_factorize = 0
+        if A is not None:
+            self.factorize(A, beta)
+
+    def factorize(self, A, beta=0.):
+        A = A.toarray() if issparse(A) else np.array(A, dtype=float)
+        if beta != 0.:
+            A[np.diag_indices_from(A)] += beta
+        self._A = A
+        self._cho = cho_factor(A, lower=True, check_finite=False)
+        self.num_factorize += 1
+        return self
+
+    def update(self, C, subtract=False):
+        C = C.toarray() if issparse(C) else np.asarray(C, dtype=float)
+        CCt = C @ C.T
+        return self.factorize(self._A - CCt if subtract else self._A + CCt)
+
+    def _solve_dense(self, b):
+        return cho_solve(self._cho, np.asarray(b, dtype=float),
+                         check_finite=False)
+
+    def __call__(self, b):
+        if self._cho is None:
+            raise ValueError('no matrix has been factorized yet')
+        if issparse(b):
+            return csc_matrix(self._solve_dense(b.toarray()))
+        return self._solve_dense(b)
+
+    def logdet(self):
+        return 2 * np.sum(np.log(np.diagonal(self._cho[0])))
+
+    def inv(self):
+        dim = self._cho[0].shape[0]
+        return csc_matrix(self._solve_dense(np.identity(dim)))
+
+    def selected_inv(self):
+        return self.inv()
+
+
+def conjugate_gradients(matvec, b, precond=None, x0=None,
+                        rtol=1e-10, maxiter=None):
+    """Preconditioned conjugate gradients.
+
+    Solves A x = b for a symmetric positive definite matrix A
+    that is only available via the function `matvec` computing
+    the product A v. The function `precond` applies the inverse
+    of the preconditioner to a vector. The iteration stops if
+    the norm of the residual is below rtol times the norm of b.
+    The approximate solution and the number of iterations are
+    returned, also if the tolerance was not reached within
+    maxiter iterations.
+    """
+    b = np.asarray(b, dtype=float)
+    if maxiter is None:
+        maxiter = 10 * len(b)
+    if precond is None:
+        def precond(r):
+            return r
+    if x0 is None:
+        x = np.zeros(len(b), dtype=float)
+        r = b.copy()
+    else:
+        x = np.array(x0, dtype=float)
+        r = b - matvec(x)
+    tol = rtol * np.linalg.norm(b)
+    z = precond(r)
+    p = z.copy()
+    rz = r @ z
+    num_iter = 0
+    while np.linalg.norm(r) > tol and num_iter < maxiter:
+        num_iter += 1
+        Ap = matvec(p)
+        alpha = rz / (p @ Ap)
+        x += alpha * p
+        r -= alpha * Ap
+        z = precond(r)
+        rz_new = r @ z
+        p = z + (rz_new / rz) * p
+        rz = rz_new
+    return x, num_iter
+
+
+LINEAR_SOLVER_BACKENDS = {
+    'cholmod': CholeskySolver,
+    'superlu': SuperLUSolver,
+    'dense': DenseCholeskySolver,
+}
+
+
+def choose_solver_backend(A):
+    """Select a solver backend based on size and sparsity."""
+    dim = A.shape[0]
+    if dim <= DENSE_SIZE_LIMIT:
+        return 'dense'
+    nnz = A.nnz if issparse(A) else np.count_nonzero(A)
+    density = nnz / (dim * dim)
+    if dim <= DENSE_MAX_SIZE and density >= DENSE_DENSITY_LIMIT:
+        return 'dense'
+    return 'cholmod'
+
+
+class LinearSolver:
+    """Solver for symmetric positive definite linear systems.
+
+    The backend can be one of 'cholmod', 'superlu' and 'dense'.
+    If 'auto' is selected, the backend is determined by the size
+    and sparsity of the first matrix to be factorized. In this case,
+    SuperLU is used as a fallback with a warning if a matrix turns
+    out to be numerically not positive definite. As the logarithm
+    of the determinant of such a matrix is meaningless, `logdet`
+    raises an error after a fallback. The factorization
+    is kept and can be used for any number of solves.
+    The elements of the inverse on the pattern of the Cholesky
+    factor are provided by `selected_inv` and cached until the
+    next factorization, as is the full inverse provided by `inv`.
+    The dense and SuperLU backend return the full inverse
+    as selected inverse.
+    """
+
+    def __init__(self, A=None, beta=0., backend='auto'):
+        if backend != 'auto' and backend not in LINEAR_SOLVER_BACKENDS:
+            raise ValueError(f'unknown linear solver backend {backend}')
+        self._backend = backend
+        self._solver = None
+        self._selected_inv = None
+        self._inv = None
+        self._fallback = False
+        if A is not None:
+            self.factorize(A, beta)
+
+    def factorize(self, A, beta=0.):
+        self._selected_inv = None
+        self._inv = None
+        if self._fallback:
+            # the next matrix may be positive definite again
+            self._solver = None
+            self._fallback = False
+        if self._solver is None:
+            backend = self._backend
+            if backend == 'auto':
+                backend = choose_solver_backend(A)
+            self._solver = LINEAR_SOLVER_BACKENDS[backend]()
+        try:
+            self._solver.factorize(A, beta)
+        except (CholmodNotPositiveDefiniteError, LinAlgError):
+            if self._backend != 'auto':
+                raise
+            warnings.warn('matrix is not positive definite, '
+                          'falling back to SuperLU')
+            self._solver = SuperLUSolver(A, beta)
+            self._fallback = True
+        return self
+
+    def update(self, C, subtract=False):
+        """Change the factorization to the one of A + C*C' or A - C*C'.
+
+        CHOLMOD performs a rank-k update (or downdate) of the existing
+        factor whereas the other backends factorize the modified matrix.
+        """
+        if self._solver is None:
+            raise ValueError('no matrix has been factorized yet')
+        self._selected_inv = None
+        self._inv = None
+        self._solver.update(C, subtract)
+        return self
+
+    def get_backend(self):
+        for name, cls in LINEAR_SOLVER_BACKENDS.items():
+            if type(self._solver) == cls:
+                return name
+        return None
+
+    def get_solver(self):
+        return self._solver
+
+    def __call__(self, b):
+        if self._solver is None:
+            raise ValueError('no matrix has been factorized yet')
+        return self._solver(b)
+
+    def logdet(self):
+        if self._fallback:
+            raise ValueError('no log determinant because the matrix '
+                             'is not positive definite')
+        return self._solver.logdet()
+
+    def inv(self):
+        if self._inv is None:
+            self._inv = self._solver.inv()
+        return self._inv
+
+    def selected_inv(self):
+        if self._selected_inv is None:
+            self._selected_inv = self._solver.selected_inv().tocsr()
+        return self._selected_inv
+
+
+class SchurComplementSolver:
+    """Solver eliminating some unknowns by a Schur complement.
+
+    The unknowns selected by the boolean mask `eliminate` must only
+    be coupled among each other in small blocks, e.g., the
+    normalization factors of the experimental datasets. Their block
+    of the matrix is inverted block by block, so that only the Schur
+    complement associated with the remaining unknowns is factorized
+    by a LinearSolver with the given backend. The eliminated unknowns
+    are obtained by back-substitution. The selected inverse contains
+    the elements on the pattern of the Cholesky factor of the Schur
+    complement and all elements in the rows and columns of the
+    eliminated unknowns.
+    """
+
+    def __init__(self, eliminate, A=None, beta=0., backend='auto'):
+        self._elim = np.asarray(eliminate, dtype=bool)
+        self._keep = np.logical_not(self._elim)
+        self._reduced_solver = LinearSolver(backend=backend)
+        self._A = None
+        self._selected_inv = None
+        self.num_factorize = 0
+        if A is not None:
+            self.factorize(A, beta)
+
+    def _invert_blocks(self, A_nn):
+        # the inverse of a block diagonal matrix is block diagonal
+        A_nn = A_nn.tocsr()
+        dim = A_nn.shape[0]
+        num_blocks, labels = connected_components(A_nn, directed=False)
+        rows, cols, vals = [], [], []
+        logdet = 0.
+        for block in range(num_blocks):
+            idcs = np.where(labels == block)[0]
+            block_mat = A_nn[idcs,:][:,idcs].toarray()
+            cho = cho_factor(block_mat, lower=True, check_finite=False)
+            block_inv = cho_solve(cho, np.identity(len(idcs)),
+                                  check_finite=False)
+            logdet += 2 * np.sum(np.log(np.diagonal(cho[0])))
+            rows.append(np.repeat(idcs, len(idcs)))
+            cols.append(np.tile(idcs, len(idcs)))
+            vals.append(block_inv.ravel())
+        if num_blocks == 0:
+            return csr_matrix((dim, dim), dtype=float), logdet
+        inv_A_nn = csr_matrix(
+            (np.concatenate(vals),
+             (np.concatenate(rows), np.concatenate(cols))),
+            shape=(dim, dim)
+        )
+        return inv_A_nn, logdet
+
+    def factorize(self, A, beta=0.):
+        A = _as_sorted_csc(A)
+        if A.shape[0] != len(self._elim):
+            raise IndexError('size of matrix does not match mask')
+        if beta != 0.:
+            A = A + beta * identity(A.shape[0], format='csc')
+        self._A = A
+        keep, elim = self._keep, self._elim
+        A_x = A[:, keep].tocsr()
+        A_xx = A_x[keep,:]
+        A_nx = A_x[elim,:]
+        A_nn = A[elim,:][:,elim]
+        self._inv_A_nn, self._logdet_A_nn = self._invert_blocks(A_nn)
+        # G = inv(A_nn) A_nx is needed for the back-substitution
+        self._G = csr_matrix(self._inv_A_nn @ A_nx)
+        self._reduced_solver.factorize(csc_matrix(A_xx - A_nx.T @ self._G))
+        self._selected_inv = None
+        self.num_factorize += 1
+        return self
+
+    def update(self, C, subtract=False):
+        C = csc_matrix(C)
+        CCt = C @ C.T
+        return self.factorize(self._A - CCt if subtract else self._A + CCt)
+
+    def _solve_dense(self, b):
+        b = np.asarray(b, dtype=float)
+        b_n = b[self._elim]
+        # the Schur complement is solved with the reduced right-hand side
+        x_x = self._reduced_solver(b[self._keep] - self._G.T @ b_n)
+        y_n = self._inv_A_nn @ b_n
+        x = np.empty(b.shape, dtype=float)
+        x[self._keep] = x_x
+        x[self._elim] = y_n - self._G @ x_x
+        return x
+
+    def __call__(self, b):
+        if self._A is None:
+            raise ValueError('no matrix has been factorized yet')
+        if issparse(b):
+            return _solve_sparse_rhs(self._solve_dense, b)
+        return self._solve_dense(b)
+
+    def get_backend(self):
+        # the backend of the factorization of the Schur complement
+        return self._reduced_solver.get_backend()
+
+    def logdet(self):
+        return self._logdet_A_nn + self._reduced_solver.logdet()
+
+    def _assemble_inverse(self, inv_xx):
+        # the remaining blocks of the inverse follow from
+        # the block of the unknowns that are not eliminated
+        G = self._G
+        inv_xn = -csc_matrix(self._reduced_solver(G.T.tocsc()))
+        inv_nn = self._inv_A_nn - G @ inv_xn
+        perm = np.concatenate([np.where(self._keep)[0],
+                               np.where(self._elim)[0]])
+        invperm = np.empty(len(perm), dtype=int)
+        invperm[perm] = np.arange(len(perm))
+        res = vstack([hstack([inv_xx, inv_xn]),
+                      hstack([inv_xn.T, inv_nn])], format='csr')
+        return res[invperm,:][:,invperm].tocsc()
+
+    def inv(self):
+        return self._assemble_inverse(csc_matrix(self._reduced_solver.inv()))
+
+    def selected_inv(self):
+        if self._selected_inv is None:
+            self._selected_inv = self._assemble_inverse(
+                csc_matrix(self._reduced_solver.selected_inv())
+            ).tocsr()
+        return self._selected_inv
+
+
+class WoodburySolver:
+    """Solver for A + U B U' with a matrix U of few columns.
+
+    The solves with A are performed by `A_solver` and B is given by
+    its factorization `B_solver`, e.g., a LinearSolver. The Woodbury
+    identity only requires the factorization of the capacitance matrix
+    inv(B) + U' inv(A) U, whose dimension is the number of columns of U.
+    The logarithm of the determinant follows from the matrix
+    determinant lemma if `A_solver` provides `logdet`.
+    """
+
+    def __init__(self, A_solver, U, B_solver, backend='auto'):
+        self._A_solver = A_solver
+        self._B_solver = B_solver
+        # a copy of U so that later changes by the caller
+        # do not affect the solver
+        U = csc_matrix(U, copy=True)
+        self._U = U
+        self._AinvU = csc_matrix(A_solver(U))
+        capmat = csc_matrix(B_solver.inv()) + U.T @ self._AinvU
+        self._cap_solver = LinearSolver(capmat, backend=backend)
+
+    def __call__(self, b):
+        z = self._A_solver(b)
+        return z - self._AinvU @ self._cap_solver(self._U.T @ z)
+
+    def logdet(self):
+        return (self._A_solver.logdet() + self._B_solver.logdet() +
+                self._cap_solver.logdet())
+
+
+class ScaledSolver:
+    """Solver for D A D with a diagonal matrix D.
+
+    The solves with A are performed by `solver`, e.g., a factorization
+    of A, so that the rescaled matrix does not need to be factorized.
+    The diagonal elements of D are given by `scale` and must not be zero.
+    """
+
+    def __init__(self, solver, scale):
+        scale = np.asarray(scale, dtype=float)
+        if np.any(scale == 0.):
+            raise ValueError('the scale factors must not be zero')
+        self._solver = solver
+        self._scale = scale
+        self._inv_scale = 1. / scale
+
+    def _mult_inv_scale(self, b):
+        if issparse(b):
+            return csc_matrix(diags(self._inv_scale) @ b)
+        b = np.asarray(b, dtype=float)
+        return b * self._inv_scale.reshape((-1,) + (1,)*(b.ndim-1))
+
+    def __call__(self, b):
+        return self._mult_inv_scale(self._solver(self._mult_inv_scale(b)))
+
+    def logdet(self):
+        return (self._solver.logdet() +
+                2 * np.sum(np.log(np.abs(self._scale))))
+
+    def inv(self):
+        inv_scale = diags(self._inv_scale)
+        return csc_matrix(inv_scale @ self._solver.inv() @ inv_scale)
+
+
+class DiagonalUpdateSolver:
+    """Solver for inv(P) + D with a diagonal matrix D.
+
+    The symmetric positive definite matrix P, e.g., a prior covariance
+    matrix, is assumed to consist of small blocks, which are given by
+    the connected components of its sparsity pattern. For each block
+    with Cholesky factor L, the inverse of inv(P) + D is obtained as
+    L inv(I + L' D L) L', so that P is not inverted and parameters with
+    vague priors pose no problem. Blocks of size one may also have an
+    infinite variance. The diagonal elements of D must not be negative
+    and the solution is left unchanged for elements where both inv(P)
+    and D vanish.
+    """
+
+    def __init__(self, P, diag):
+        P = csr_matrix(P)
+        diag = np.asarray(diag, dtype=float)
+        if np.any(diag < 0.):
+            raise ValueError('the diagonal elements must not be negative')
+        num_blocks, labels = connected_components(P, directed=False)
+        block_sizes = np.bincount(labels, minlength=num_blocks)
+        is_single = block_sizes[labels] == 1
+        pvars = P.diagonal()[is_single]
+        denom = 1. / pvars + diag[is_single]
+        self._single_idcs = np.flatnonzero(is_single)
+        self._single_vals = np.ones(len(denom), dtype=float)
+        np.divide(1., denom, out=self._single_vals, where=denom > 0.)
+        self._blocks = []
+        for block in np.flatnonzero(block_sizes > 1):
+            idcs = np.flatnonzero(labels == block)
+            L = cholesky_dense(P[idcs,:][:,idcs].toarray(), lower=True)
+            K = np.identity(len(idcs)) + L.T @ (diag[idcs].reshape(-1, 1) * L)
+            G = solve_triangular(cholesky_dense(K, lower=True), L.T, lower=True)
+            self._blocks.append((idcs, G.T @ G))
+
+    def __call__(self, b):
+        b = np.asarray(b, dtype=float)
+        res = np.empty_like(b)
+        single_idcs = self._single_idcs
+        res[single_idcs] = (self._single_vals.reshape((-1,) + (1,)*(b.ndim-1)) *
+                            b[single_idcs])
+        for idcs, inv_block in self._blocks:
+            res[idcs] = inv_block @ b[idcs]
+        return res
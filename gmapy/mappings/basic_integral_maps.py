@@ -165,14 +165,214 @@ def _integrate_product_lin_lin_sensmats(xa, ya, xb, yb, zero_outside=True):
     return [pa, pb]
 
 
+def _logmean_with_derivs(a, b):
+    # logarithmic mean (b-a)/log(b/a) of positive numbers
+    # and its partial derivatives with respect to a and b.
+    # If a and b are close, the Taylor expansion
+    # in q = log(b/a) is used for numerical stability
+    q = np.log(b) - np.log(a)
+    is_small = np.abs(q) < 1e-3
+    qs = np.where(is_small, 1., q)
+    m = np.where(is_small, a*(1 + q/2 + q*q/6), (b-a)/qs)
+    dm_da = np.where(is_small, 0.5 + q/6 + q*q/24, (b/a - 1 - qs)/(qs*qs))
+    dm_db = np.where(is_small, 0.5 - q/6 + q*q/24, (qs - 1 + a/b)/(qs*qs))
+    return m, dm_da, dm_db
+
+
+def _integrate_intervals(x1, x2, y1, y2, interp):
+    # integrals over the intervals [x1, x2] of the functions
+    # interpolating between (x1, y1) and (x2, y2) according
+    # to the interpolation laws in interp, and the partial
+    # derivatives with respect to y1 and y2
+    intvals = np.empty(len(x1), dtype=float)
+    dvals1 = np.empty(len(x1), dtype=float)
+    dvals2 = np.empty(len(x1), dtype=float)
+    for curint in np.unique(interp):
+        sel = interp == curint
+        cx1 = x1[sel]; cx2 = x2[sel]
+        cy1 = y1[sel]; cy2 = y2[sel]
+        if curint == 'lin-lin':
+            cd1 = (cx2 - cx1) / 2
+            cd2 = cd1
+        elif curint == 'log-lin':
+            # y is linear in log(x)
+            mx = _logmean_with_derivs(cx1, cx2)[0]
+            cd1 = mx - cx1
+            cd2 = cx2 - mx
+        elif curint == 'lin-log':
+            # y is an exponential function of x
+            m, dm1, dm2 = _logmean_with_derivs(cy1, cy2)
+            xd = cx2 - cx1
+            intvals[sel] = xd * m
+            dvals1[sel] = xd * dm1
+            dvals2[sel] = xd * dm2
+            continue
+        elif curint == 'log-log':
+            # y is a power function of x
+            m, dm1, dm2 = _logmean_with_derivs(cx1*cy1, cx2*cy2)
+            log_xd = np.log(cx2) - np.log(cx1)
+            intvals[sel] = log_xd * m
+            dvals1[sel] = log_xd * cx1 * dm1
+            dvals2[sel] = log_xd * cx2 * dm2
+            continue
+        else:
+            raise ValueError(f'invalid interpolation type "{curint}"')
+        intvals[sel] = cd1*cy1 + cd2*cy2
+        dvals1[sel] = cd1
+        dvals2[sel] = cd2
+    return intvals, dvals1, dvals2
+
+
+def _get_interval_interps(x, interp_type, xmid):
+    # interpolation laws applying to the points in xmid,
+    # which are the midpoints of intervals not containing
+    # any mesh point of the sorted mesh x
+    if isinstance(interp_type, str):
+        return np.full(len(xmid), interp_type, dtype='<U7')
+    idcs = np.searchsorted(x, xmid, side='right') - 1
+    idcs = np.clip(idcs, 0, len(x)-2)
+    return np.array(interp_type)[idcs]
+
+
+def _integrate_exact(x, y, interp_type):
+    # closed-form integral of a piecewise interpolated
+    # function and its gradient with respect to y
+    p = np.argsort(x)
+    x = np.array(x, dtype=float)[p]
+    y = np.array(y, dtype=float)[p]
+    if not isinstance(interp_type, str):
+        interp_type = np.array(interp_type)[p]
+    interp = _get_interval_interps(x, interp_type, (x[:-1] + x[1:]) / 2)
+    intvals, dvals1, dvals2 = _integrate_intervals(
+        x[:-1], x[1:], y[:-1], y[1:], interp
+    )
+    sens = np.zeros(len(x), dtype=float)
+    sens[:-1] += dvals1
+    sens[1:] += dvals2
+    orig_sens = np.empty(len(x), dtype=float)
+    orig_sens[p] = sens
+    return np.sum(intvals), orig_sens
+
+
+def _get_log_lin_moments(x1, x2):
+    # moments int_x1^x2 t^k dx for k = 0, 1, 2
+    # with t = log(x/x1) / log(x2/x1) in [0, 1]
+    log_xd = np.log(x2) - np.log(x1)
+    is_small = log_xd < 0.5
+    L = np.where(is_small, 0.5, log_xd)
+    moms = [x2 - x1,
+            (x2*(L-1) + x1) / L,
+            (x2*(L*L - 2*L + 2) - 2*x1) / (L*L)]
+    if np.any(is_small):
+        # series expansion avoids the cancellation for small L
+        L = log_xd[is_small]
+        for k in (1, 2):
+            term = x1[is_small] * L
+            series = term / (k+1)
+            for n in range(1, 25):
+                term = term * L / n
+                series = series + term / (n+k+1)
+            moms[k] = moms[k].copy()
+            moms[k][is_small] = series
+    return moms
+
+
+def _integrate_product_exact(xlist, ylist, interplist, zero_outside=False):
+    # closed-form integral of a product of piecewise
+    # interpolated functions and the gradients with respect
+    # to the function values. Closed forms are available if
+    # in each interval of the common mesh all factors follow
+    # the same interpolation law. Products of linear functions
+    # in x or log(x) are only supported for two factors.
+    # If no closed form is available, None is returned.
+    xlist = [np.array(x, dtype=float) for x in xlist]
+    ylist = [np.array(y, dtype=float) for y in ylist]
+    min_x = np.max([np.min(x) for x in xlist])
+    max_x = np.min([np.max(x) for x in xlist])
+    if not zero_outside:
+        if (not np.all([np.min(x) == min_x for x in xlist]) or
+                not np.all([np.max(x) == max_x for x in xlist])):
+            raise ValueError('The x-limits of the meshes do not coincide')
+    xm = np.unique(np.concatenate(xlist))
+    xm = xm[np.logical_and(xm >= min_x, xm <= max_x)]
+    x1 = xm[:-1]
+    x2 = xm[1:]
+    xmid = (x1 + x2) / 2
+    interps = []
+    for x, interp in zip(xlist, interplist):
+        p = np.argsort(x)
+        if not isinstance(interp, str):
+            interp = np.array(interp)[p]
+        interps.append(_get_interval_interps(x[p], interp, xmid))
+    interp = interps[0]
+    if not all(np.all(curinterp == interp) for curinterp in interps):
+        return None
+    is_lin = np.isin(interp, ('lin-lin', 'log-lin'))
+    if len(xlist) != 2 and np.any(is_lin):
+        return None
+
+    ymlist = [basic_propagate(x, y, xm, ip, zero_outside)
+              for x, y, ip in zip(xlist, ylist, interplist)]
+    intvals = np.zeros(len(x1), dtype=float)
+    dlist = [(np.zeros(len(x1)), np.zeros(len(x1))) for _ in ymlist]
+    # the product of exponential or power functions is again
+    # of this type and its values at the mesh points are the
+    # products of the values of the factors
+    is_exp = np.logical_not(is_lin)
+    if np.any(is_exp):
+        prod_ym = np.prod(ymlist, axis=0)
+        curint, dprod1, dprod2 = _integrate_intervals(
+            x1[is_exp], x2[is_exp], prod_ym[:-1][is_exp],
+            prod_ym[1:][is_exp], interp[is_exp]
+        )
+        intvals[is_exp] = curint
+        for i in range(len(ymlist)):
+            others = np.prod(ymlist[:i] + ymlist[i+1:], axis=0)
+            dlist[i][0][is_exp] = dprod1 * others[:-1][is_exp]
+            dlist[i][1][is_exp] = dprod2 * others[1:][is_exp]
+    # the product of two linear functions in x or log(x) is
+    # given by the integrals of the products of the hat functions
+    if np.any(is_lin):
+        G11 = np.zeros(len(x1)); G12 = np.zeros(len(x1)); G22 = np.zeros(len(x1))
+        sel = interp == 'lin-lin'
+        xd = x2[sel] - x1[sel]
+        G11[sel] = xd / 3; G12[sel] = xd / 6; G22[sel] = xd / 3
+        sel = interp == 'log-lin'
+        if np.any(sel):
+            m0, m1, m2 = _get_log_lin_moments(x1[sel], x2[sel])
+            G11[sel] = m0 - 2*m1 + m2; G12[sel] = m1 - m2; G22[sel] = m2
+        ya, yb = ymlist
+        a1 = ya[:-1][is_lin]; a2 = ya[1:][is_lin]
+        b1 = yb[:-1][is_lin]; b2 = yb[1:][is_lin]
+        G11 = G11[is_lin]; G12 = G12[is_lin]; G22 = G22[is_lin]
+        intvals[is_lin] = a1*b1*G11 + (a1*b2 + a2*b1)*G12 + a2*b2*G22
+        dlist[0][0][is_lin] = b1*G11 + b2*G12
+        dlist[0][1][is_lin] = b1*G12 + b2*G22
+        dlist[1][0][is_lin] = a1*G11 + a2*G12
+        dlist[1][1][is_lin] = a1*G12 + a2*G22
+    # get Jacobian to original mesh
+    # by applying chain rule
+    sensmats = []
+    for (x, y, ip), (d1, d2) in zip(zip(xlist, ylist, interplist), dlist):
+        pm = np.zeros(len(xm), dtype=float)
+        pm[:-1] += d1
+        pm[1:] += d2
+        S = get_basic_sensmat(x, y, xm, ip, zero_outside)
+        sensmats.append((pm @ S).reshape(1, -1))
+    return np.sum(intvals), sensmats
+
+
 def basic_integral_propagate(x, y, interp_type='lin-lin',
-                             zero_outside=False, **kwargs):
+                             zero_outside=False, exact=False, **kwargs):
     if np.all(interp_type == 'lin-lin'):
         p = np.argsort(x)
         x = np.array(x)[p]
         y = np.array(y)[p]
         ret = _integrate_lin_lin(x, y)
         return np.array(ret, float)
+    elif exact:
+        ret = _integrate_exact(x, y, interp_type)[0]
+        return np.array(ret, float)
     else:
         xref = x; yref = y
         def propfun(x):
@@ -183,7 +383,7 @@ def basic_integral_propagate(x, y, interp_type='lin-lin',
 
 
 def get_basic_integral_sensmat(x, y, interp_type='lin-lin',
-                               zero_outside=False, **kwargs):
+                               zero_outside=False, exact=False, **kwargs):
     if np.all(interp_type == 'lin-lin'):
         p = np.argsort(x)
         x = np.array(x)[p]
@@ -192,6 +392,9 @@ def get_basic_integral_sensmat(x, y, interp_type='lin-lin',
         ret = np.empty((1, len(x)), dtype=float)
         ret[0, p] = pret
         return ret
+    elif exact:
+        ret = _integrate_exact(x, y, interp_type)[1]
+        return ret.reshape(1, -1)
     else:
         sortord = np.argsort(x)
         xref = np.array(x)[sortord]
@@ -218,13 +421,20 @@ def get_basic_integral_sensmat(x, y, interp_type='lin-lin',
 
 
 def basic_integral_of_product_propagate(xlist, ylist, interplist,
-                                        zero_outside=False, **kwargs):
+                                        zero_outside=False, exact=False,
+                                        **kwargs):
     if (len(xlist) == 2 and
             np.all(interplist[0] == 'lin-lin') and
             np.all(interplist[1] == 'lin-lin')):
         ret = _integrate_product_lin_lin(
             xlist[0], ylist[0], xlist[1], ylist[1], zero_outside)
         return np.array([ret], dtype=float)
+    exact_res = None
+    if exact:
+        exact_res = _integrate_product_exact(xlist, ylist, interplist,
+                                             zero_outside)
+    if exact_res is not None:
+        return np.array([exact_res[0]], dtype=float)
     else:
         def propfun(x):
             return basic_product_propagate(xlist, ylist, x,
@@ -236,13 +446,20 @@ def basic_integral_of_product_propagate(xlist, ylist, interplist,
 
 
 def get_basic_integral_of_product_sensmats(xlist, ylist, interplist,
-                                           zero_outside=False, **kwargs):
+                                           zero_outside=False, exact=False,
+                                           **kwargs):
     if (len(xlist) == 2 and
             np.all(interplist[0] == 'lin-lin') and
             np.all(interplist[1] == 'lin-lin')):
         ret = _integrate_product_lin_lin_sensmats(
             xlist[0], ylist[0], xlist[1], ylist[1], zero_outside)
         return ret
+    exact_res = None
+    if exact:
+        exact_res = _integrate_product_exact(xlist, ylist, interplist,
+                                             zero_outside)
+    if exact_res is not None:
+        return exact_res[1]
     else:
         def propfun(x):
             return basic_product_propagate(xlist, ylist, x,
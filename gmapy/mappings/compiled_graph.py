@@ -0,0 +1,487 @@
+import numpy as np
+from scipy.sparse import csr_matrix, vstack, identity, issparse
+from .mapping_elements import Distributor, get_triplets, assemble_csr
+
+
+def _concat_ranges(starts, lens):
+    # indices of the concatenated ranges [start, start+len)
+    offsets = np.cumsum(lens) - lens
+    return np.arange(np.sum(lens)) + np.repeat(starts - offsets, lens)
+
+
+class CompiledGraph:
+    """Flat evaluation plan of a graph of mapping elements.
+
+    The nodes the node `output` depends on are sorted into levels
+    so that each node only depends on nodes of lower levels.
+    The values of all nodes are stored in a single workspace
+    vector starting with the input vector. On each level,
+    all linear nodes are evaluated by a single sparse matrix
+    product and all products and ratios by vectorized operations
+    on gathered workspace elements. Only nodes without such a
+    description, e.g., integrals, are evaluated one by one.
+    Distributors feeding into linear nodes do not occupy space
+    in the workspace but are absorbed into the matrix of the
+    consuming node.
+    """
+
+    def __init__(self, output):
+        self.__nodes = {}
+        self.__order = []
+        self.__consumer_kinds = {}
+        self.__collect(output)
+        self.__output_id = id(output)
+        self.__input_size = 0
+        for node_id in self.__order:
+            kind, data = self.__nodes[node_id][1:]
+            if kind == 'input':
+                self.__input_size = data.shape[1]
+                break
+        self.__allocate()
+        self.__jacobian_plan = None
+
+    def __len__(self):
+        start, stop = self.__slots[self.__output_id]
+        return stop - start
+
+    def get_input_size(self):
+        return self.__input_size
+
+    def __collect(self, node):
+        # depth-first search to obtain the nodes in topological order
+        node_id = id(node)
+        if node_id in self.__nodes:
+            return
+        kind, data = node._get_compile_info()
+        self.__nodes[node_id] = (node, kind, data)
+        if kind == 'linear':
+            ancestors = [anc for anc, _ in data]
+        elif kind in ('mul', 'div', 'generic'):
+            ancestors = data
+        else:
+            ancestors = []
+        for anc in ancestors:
+            self.__consumer_kinds.setdefault(id(anc), set()).add(kind)
+            self.__collect(anc)
+        self.__order.append(node_id)
+
+    def __is_virtual(self, node_id):
+        node = self.__nodes[node_id][0]
+        return (type(node) == Distributor and
+                node_id != self.__output_id and
+                self.__consumer_kinds.get(node_id) == {'linear'})
+
+    def __resolve(self, node, mat):
+        # replace virtual distributors by their source
+        # and the product of the involved matrices
+        node_id = id(node)
+        if not self.__is_virtual(node_id):
+            return [(node_id, mat)]
+        anc, distmat = self.__nodes[node_id][2][0]
+        return self.__resolve(anc, csr_matrix(mat @ distmat))
+
+    def __allocate(self):
+        # determine the sources and the level of each node
+        depths = {}
+        sources = {}
+        for node_id in self.__order:
+            if self.__is_virtual(node_id):
+                continue
+            node, kind, data = self.__nodes[node_id]
+            if kind == 'const':
+                depths[node_id] = 0
+                continue
+            elif kind == 'input':
+                sources[node_id] = [(None, csr_matrix(data))]
+                depths[node_id] = 1
+                continue
+            elif kind == 'linear':
+                cursrcs = []
+                for anc, mat in data:
+                    cursrcs.extend(self.__resolve(anc, csr_matrix(mat)))
+                sources[node_id] = cursrcs
+                src_ids = [src_id for src_id, _ in cursrcs]
+            else:
+                src_ids = [id(anc) for anc in data]
+                sources[node_id] = src_ids
+            depths[node_id] = 1 + max(depths[src_id] for src_id in src_ids)
+        # assign the slots in the workspace, the input vector
+        # comes first, followed by the constants and the levels
+        kind_order = {'input': 0, 'linear': 0, 'mul': 1, 'div': 2, 'generic': 3}
+        slots = {None: (0, self.__input_size)}
+        offset = self.__input_size
+        const_vals = []
+        for node_id, depth in depths.items():
+            if depth == 0:
+                vals = self.__nodes[node_id][2]
+                slots[node_id] = (offset, offset + len(vals))
+                const_vals.append(np.asarray(vals, dtype=float))
+                offset += len(vals)
+        self.__const_slice = (self.__input_size, offset)
+        self.__const_vals = (np.concatenate(const_vals) if const_vals
+                             else np.empty(0, dtype=float))
+        max_depth = max(depths.values())
+        level_nodes = [[] for _ in range(max_depth + 1)]
+        for node_id, depth in depths.items():
+            if depth > 0:
+                level_nodes[depth].append(node_id)
+        self.__levels = []
+        for cur_nodes in level_nodes[1:]:
+            cur_nodes = sorted(
+                cur_nodes, key=lambda i: kind_order[self.__nodes[i][1]]
+            )
+            level_start = offset
+            for node_id in cur_nodes:
+                size = len(self.__nodes[node_id][0])
+                slots[node_id] = (offset, offset + size)
+                offset += size
+            self.__levels.append(
+                self.__prepare_level(cur_nodes, slots, sources,
+                                     level_start, offset)
+            )
+        self.__slots = slots
+        self.__ws_size = offset
+
+    def __prepare_level(self, node_ids, slots, sources, start, stop):
+        level = {'start': start, 'stop': stop, 'generic': []}
+        lin_rows, lin_cols, lin_vals = [], [], []
+        lin_stop = start
+        binops = {'mul': ([], [], []), 'div': ([], [], [])}
+        for node_id in node_ids:
+            kind = self.__nodes[node_id][1]
+            node_start, node_stop = slots[node_id]
+            if kind in ('input', 'linear'):
+                for src_id, mat in sources[node_id]:
+                    mat = mat.tocoo()
+                    lin_rows.append(mat.row + node_start - start)
+                    lin_cols.append(mat.col + slots[src_id][0])
+                    lin_vals.append(mat.data)
+                lin_stop = node_stop
+            elif kind in ('mul', 'div'):
+                out_idcs, idcs1, idcs2 = binops[kind]
+                src1, src2 = sources[node_id]
+                out_idcs.append(np.arange(node_start, node_stop))
+                idcs1.append(np.arange(*slots[src1]))
+                idcs2.append(np.arange(*slots[src2]))
+            else:
+                node = self.__nodes[node_id][0]
+                src_slices = [slice(*slots[src_id])
+                              for src_id in sources[node_id]]
+                level['generic'].append(
+                    (node, slice(node_start, node_stop), src_slices)
+                )
+        # the linear nodes occupy the first part of the level
+        level['linear_stop'] = lin_stop
+        if lin_stop > start:
+            rows = np.concatenate(lin_rows)
+            cols = np.concatenate(lin_cols)
+            vals = np.concatenate(lin_vals)
+            level['linear'] = csr_matrix(
+                (vals, (rows, cols)), shape=(lin_stop-start, start),
+                dtype=float
+            )
+            # zeros in the constant matrices, e.g., of interpolations
+            # at mesh points, are also zero in the Jacobian matrix
+            level['linear'].eliminate_zeros()
+            linmat = level['linear'].tocoo()
+            level['linear_coo'] = (linmat.row, linmat.col, linmat.data)
+        for kind, (out_idcs, idcs1, idcs2) in binops.items():
+            if len(out_idcs) > 0:
+                level[kind] = (np.concatenate(out_idcs),
+                               np.concatenate(idcs1),
+                               np.concatenate(idcs2))
+        return level
+
+    def __run(self, x, dx=None):
+        # x can also be a matrix whose columns are input vectors,
+        # the columns of dx are the directions for the forward
+        # propagation of the derivatives
+        x = np.asarray(x, dtype=float)
+        if x.shape[0] != self.__input_size:
+            raise IndexError('wrong length of vector')
+        ws = np.empty((self.__ws_size,) + x.shape[1:], dtype=float)
+        ws[:self.__input_size] = x
+        ws[slice(*self.__const_slice)] = (
+            self.__const_vals.reshape((-1,) + (1,)*(x.ndim-1))
+        )
+        if dx is not None:
+            dx = np.asarray(dx, dtype=float)
+            if dx.shape != x.shape:
+                raise IndexError('shape of directions does not match input')
+            dws = np.zeros(ws.shape, dtype=float)
+            dws[:self.__input_size] = dx
+        for level in self.__levels:
+            start = level['start']
+            if 'linear' in level:
+                linmat = level['linear']
+                ws[start:level['linear_stop']] = linmat @ ws[:start]
+                if dx is not None:
+                    dws[start:level['linear_stop']] = linmat @ dws[:start]
+            if 'mul' in level:
+                out_idcs, idcs1, idcs2 = level['mul']
+                ws[out_idcs] = ws[idcs1] * ws[idcs2]
+                if dx is not None:
+                    dws[out_idcs] = (dws[idcs1] * ws[idcs2] +
+                                     ws[idcs1] * dws[idcs2])
+            if 'div' in level:
+                out_idcs, idcs1, idcs2 = level['div']
+                ws[out_idcs] = ws[idcs1] / ws[idcs2]
+                if dx is not None:
+                    dws[out_idcs] = (dws[idcs1] - ws[out_idcs] * dws[idcs2]) \
+                        / ws[idcs2]
+            for node, out_slice, src_slices in level['generic']:
+                if ws.ndim == 1:
+                    ws[out_slice] = node._forward([ws[s] for s in src_slices])
+                    if dx is not None:
+                        dws[out_slice] = self.__generic_jvp(
+                            node, ws, dws, src_slices
+                        )
+                    continue
+                # generic nodes only accept vectors
+                for i in range(ws.shape[1]):
+                    ws[out_slice, i] = node._forward(
+                        [ws[s, i] for s in src_slices]
+                    )
+                    if dx is not None:
+                        dws[out_slice, i] = self.__generic_jvp(
+                            node, ws[:, i], dws[:, i], src_slices
+                        )
+        if dx is not None:
+            return ws, dws
+        return ws
+
+    def __generic_jvp(self, node, ws, dws, src_slices):
+        local_jacs = node._local_jacobians([ws[s] for s in src_slices])
+        return sum(local_jac @ dws[s]
+                   for s, local_jac in zip(src_slices, local_jacs))
+
+    def __level_jacobian(self, level, ws):
+        # the partial derivatives of the nodes of the
+        # level with respect to all nodes of lower levels.
+        # If ws is None, the structural pattern is returned
+        # with all elements that can be nonzero set to one
+        if ws is None:
+            return self.__level_pattern(level)
+        start = level['start']
+        rows, cols, vals = [], [], []
+        if 'linear' in level:
+            currows, curcols, curvals = level['linear_coo']
+            rows.append(currows)
+            cols.append(curcols)
+            vals.append(curvals)
+        if 'mul' in level:
+            out_idcs, idcs1, idcs2 = level['mul']
+            rows.extend([out_idcs - start]*2)
+            cols.extend([idcs1, idcs2])
+            vals.extend([ws[idcs2], ws[idcs1]])
+        if 'div' in level:
+            out_idcs, idcs1, idcs2 = level['div']
+            inv2 = 1. / ws[idcs2]
+            rows.extend([out_idcs - start]*2)
+            cols.extend([idcs1, idcs2])
+            vals.extend([inv2, -ws[idcs1] * np.square(inv2)])
+        for node, out_slice, src_slices in level['generic']:
+            local_jacs = node._local_jacobians([ws[s] for s in src_slices])
+            for src_slice, local_jac in zip(src_slices, local_jacs):
+                currows, curcols, curvals = get_triplets(local_jac)
+                rows.append(currows + out_slice.start - start)
+                cols.append(curcols + src_slice.start)
+                vals.append(curvals)
+        numrows = level['stop'] - start
+        return assemble_csr(list(zip(rows, cols, vals)), (numrows, start))
+
+    def __level_structure(self, level):
+        # rows and columns of the elements of the level Jacobian
+        # that can be nonzero, the values of __level_values
+        # are given in the same order
+        start = level['start']
+        rows, cols = [], []
+        if 'linear' in level:
+            currows, curcols, _ = level['linear_coo']
+            rows.append(currows)
+            cols.append(curcols)
+        for kind in ('mul', 'div'):
+            if kind in level:
+                out_idcs, idcs1, idcs2 = level[kind]
+                rows.extend([out_idcs - start]*2)
+                cols.extend([idcs1, idcs2])
+        # the local Jacobian matrices of the generic
+        # nodes are considered to be dense
+        for node, out_slice, src_slices in level['generic']:
+            out_idcs = np.arange(out_slice.start, out_slice.stop) - start
+            for src_slice in src_slices:
+                src_idcs = np.arange(src_slice.start, src_slice.stop)
+                rows.append(np.repeat(out_idcs, len(src_idcs)))
+                cols.append(np.tile(src_idcs, len(out_idcs)))
+        empty_idcs = np.empty(0, dtype=np.int64)
+        return (np.concatenate([empty_idcs] + rows).astype(np.int64),
+                np.concatenate([empty_idcs] + cols).astype(np.int64))
+
+    def __level_values(self, level, ws):
+        vals = []
+        if 'linear' in level:
+            vals.append(level['linear_coo'][2])
+        if 'mul' in level:
+            out_idcs, idcs1, idcs2 = level['mul']
+            vals.extend([ws[idcs2], ws[idcs1]])
+        if 'div' in level:
+            out_idcs, idcs1, idcs2 = level['div']
+            inv2 = 1. / ws[idcs2]
+            vals.extend([inv2, -ws[idcs1] * np.square(inv2)])
+        for node, out_slice, src_slices in level['generic']:
+            local_jacs = node._local_jacobians([ws[s] for s in src_slices])
+            for src_slice, local_jac in zip(src_slices, local_jacs):
+                shape = (out_slice.stop - out_slice.start,
+                         src_slice.stop - src_slice.start)
+                local_jac = (local_jac.toarray() if issparse(local_jac)
+                             else np.broadcast_to(local_jac, shape))
+                vals.append(np.ravel(local_jac))
+        return np.concatenate([np.empty(0, dtype=float)] + vals)
+
+    def __level_pattern(self, level):
+        rows, cols = self.__level_structure(level)
+        numrows = level['stop'] - level['start']
+        return assemble_csr([(rows, cols, np.ones(len(rows)))],
+                            (numrows, level['start']))
+
+    def __get_jacobian_plan(self):
+        # The derivatives of the workspace elements with respect to
+        # the input vector are stored in CSR format with a fixed
+        # structure, starting with the identity matrix of the input.
+        # For each level, the positions of the factors and results
+        # of the product of the level Jacobian with the derivatives
+        # of the lower levels are determined once, so that the
+        # product reduces to gathers and a sum by bincount.
+        if self.__jacobian_plan is not None:
+            return self.__jacobian_plan
+        input_size = self.__input_size
+        indptr = np.zeros(self.__ws_size + 1, dtype=np.int64)
+        indptr[1:input_size+1] = np.arange(1, input_size+1)
+        indptr[input_size+1:] = input_size
+        indices = np.arange(input_size, dtype=np.int64)
+        level_plans = []
+        for level in self.__levels:
+            start, stop = level['start'], level['stop']
+            rows, cols = self.__level_structure(level)
+            ukeys, tpos = np.unique(rows * start + cols, return_inverse=True)
+            lrows = ukeys // start
+            lcols = ukeys % start
+            lens = indptr[lcols+1] - indptr[lcols]
+            factor_pos = _concat_ranges(indptr[lcols], lens)
+            level_pos = np.repeat(np.arange(len(ukeys)), lens)
+            okeys = lrows[level_pos] * input_size + indices[factor_pos]
+            uokeys, out_pos = np.unique(okeys, return_inverse=True)
+            counts = np.bincount(uokeys // input_size,
+                                 minlength=stop-start)
+            offset = indptr[start]
+            indptr[start+1:stop+1] = offset + np.cumsum(counts)
+            indices = np.concatenate([indices, uokeys % input_size])
+            level_plans.append({
+                'tpos': np.ravel(tpos), 'level_nnz': len(ukeys),
+                'level_pos': level_pos, 'factor_pos': factor_pos,
+                'out_pos': np.ravel(out_pos), 'offset': offset,
+                'size': len(uokeys)
+            })
+        start, stop = self.__slots[self.__output_id]
+        out_start, out_stop = indptr[start], indptr[stop]
+        self.__jacobian_plan = {
+            'nnz': len(indices), 'levels': level_plans,
+            'out_slice': slice(out_start, out_stop),
+            'out_indptr': indptr[start:stop+1] - out_start,
+            'out_indices': indices[out_start:out_stop]
+        }
+        return self.__jacobian_plan
+
+    def evaluate(self, x):
+        ws = self.__run(x)
+        start, stop = self.__slots[self.__output_id]
+        return ws[start:stop].copy()
+
+    def jacobian(self, x):
+        return self.__accumulate_jacobian(self.__run(x))
+
+    def jvp(self, x, dx):
+        """Product of the Jacobian matrix at `x` with the vector `dx`.
+
+        If `x` and `dx` are matrices, the product is computed for
+        each pair of columns and the results are returned as columns
+        of a matrix, so that many vectors can be propagated together.
+        """
+        ws, dws = self.__run(x, dx)
+        start, stop = self.__slots[self.__output_id]
+        return ws[start:stop].copy(), dws[start:stop].copy()
+
+    def vjp(self, x, w):
+        """Product of the transposed Jacobian matrix at `x` with `w`.
+
+        The derivatives are propagated backwards through the levels
+        so that only the local Jacobian matrices of the levels are
+        needed. If `w` is a matrix, the products with all its columns
+        are returned as columns of a matrix.
+        """
+        ws = self.__run(x)
+        if ws.ndim != 1:
+            raise ValueError('x must be a vector')
+        w = np.asarray(w, dtype=float)
+        if w.shape[0] != len(self):
+            raise IndexError('wrong length of vector')
+        aws = np.zeros((self.__ws_size,) + w.shape[1:], dtype=float)
+        start, stop = self.__slots[self.__output_id]
+        aws[start:stop] = w
+        # the adjoints of a level are complete once
+        # all higher levels have been processed
+        for level in reversed(self.__levels):
+            start, stop = level['start'], level['stop']
+            level_jac = self.__level_jacobian(level, ws)
+            aws[:start] += level_jac.T @ aws[start:stop]
+        return aws[:self.__input_size]
+
+    def jacobian_pattern(self):
+        """Jacobian matrix with all elements set to one that can be nonzero."""
+        return self.__accumulate_jacobian(None)
+
+    def jacobian_structure(self):
+        """Index arrays of the Jacobian matrix in CSR format.
+
+        The structure covers all elements that can be nonzero and
+        the values in `jacobian_values` are given in this order.
+        """
+        plan = self.__get_jacobian_plan()
+        return plan['out_indptr'].copy(), plan['out_indices'].copy()
+
+    def jacobian_values(self, x):
+        """Values of the Jacobian matrix at `x` on its fixed structure."""
+        ws = self.__run(x)
+        if ws.ndim != 1:
+            raise ValueError('x must be a vector')
+        plan = self.__get_jacobian_plan()
+        acc = np.empty(plan['nnz'], dtype=float)
+        acc[:self.__input_size] = 1.
+        for level, level_plan in zip(self.__levels, plan['levels']):
+            level_vals = np.bincount(
+                level_plan['tpos'], weights=self.__level_values(level, ws),
+                minlength=level_plan['level_nnz']
+            )
+            prods = (level_vals[level_plan['level_pos']] *
+                     acc[level_plan['factor_pos']])
+            offset = level_plan['offset']
+            acc[offset:offset+level_plan['size']] = np.bincount(
+                level_plan['out_pos'], weights=prods,
+                minlength=level_plan['size']
+            )
+        return acc[plan['out_slice']]
+
+    def __accumulate_jacobian(self, ws):
+        # forward accumulation of the derivatives of all
+        # workspace elements with respect to the input vector
+        input_size = self.__input_size
+        const_start, const_stop = self.__const_slice
+        jac = vstack([
+            identity(input_size, format='csr', dtype=float),
+            csr_matrix((const_stop - const_start, input_size), dtype=float)
+        ], format='csr')
+        for level in self.__levels:
+            level_jac = self.__level_jacobian(level, ws)
+            jac = vstack([jac, level_jac @ jac], format='csr')
+        start, stop = self.__slots[self.__output_id]
+        return jac[start:stop]
@@ -1,4 +1,5 @@
 import numpy as np
+from collections import OrderedDict
 from scipy.sparse import csr_matrix
 from .cross_section_map import CrossSectionMap
 from .cross_section_shape_map import CrossSectionShapeMap
@@ -11,15 +12,23 @@ from .cross_section_shape_of_sum_map import CrossSectionShapeOfSumMap
 from .cross_section_fission_average_map import CrossSectionFissionAverageMap
 from .cross_section_ratio_of_sacs_map import CrossSectionRatioOfSacsMap
 from .relative_error_map import RelativeErrorMap
-from .mapping_elements import InputSelectorCollection, SumOfDistributors
-from .helperfuns import mapclass_with_params
+from .mapping_elements import (
+    InputSelectorCollection,
+    SumOfDistributors,
+    get_triplets,
+    assemble_csr
+)
+from .compiled_graph import CompiledGraph
+from .sparsity_pattern import SparsityPattern
+from .helperfuns import mapclass_with_params, get_datatable_fingerprint
 
 
 class CompoundMap:
 
     def __init__(self, datatable=None, fix_sacs_jacobian=True,
                  legacy_integration=False, reduce=False,
-                 atol=1e-8, rtol=1e-5, maxord=16):
+                 atol=1e-8, rtol=1e-5, maxord=16, exact_integration=False,
+                 compiled=False, cache_size=4):
         self.mapclasslist = [
                 CrossSectionMap,
                 CrossSectionShapeMap,
@@ -33,16 +42,24 @@ class CompoundMap:
                     CrossSectionFissionAverageMap,
                     fix_jacobian=fix_sacs_jacobian,
                     legacy_integration=legacy_integration,
-                    atol=atol, rtol=rtol, maxord=maxord
+                    atol=atol, rtol=rtol, maxord=maxord,
+                    exact_integration=exact_integration
                 ),
                 mapclass_with_params(
                     CrossSectionRatioOfSacsMap,
-                    atol=atol, rtol=rtol, maxord=maxord
+                    atol=atol, rtol=rtol, maxord=maxord,
+                    exact_integration=exact_integration
                 )
             ]
         self.__reduce = reduce
+        self.__compiled = compiled
         self.__input = None
         self.__output = None
+        self.__graph = None
+        # instantiated graphs are kept in a least recently used
+        # cache with the datatable fingerprint as key
+        self.__cache_size = cache_size
+        self.__cache = OrderedDict()
         if datatable is not None:
             self.instantiate_maps(datatable, reduce)
 
@@ -51,7 +68,22 @@ class CompoundMap:
             if self.__input is None or self.__output is None:
                 raise TypeError('neither map list initialized nor datatable provided')
             return
-        self._dim = len(datatable)
+        key = (get_datatable_fingerprint(datatable), reduce)
+        graph = self.__cache.get(key, None)
+        if graph is None:
+            graph = self.__build_graph(datatable, reduce)
+            self.__cache[key] = graph
+            if len(self.__cache) > self.__cache_size:
+                self.__cache.popitem(last=False)
+        else:
+            self.__cache.move_to_end(key)
+        self.__graph = graph
+        self._dim = graph['dim']
+        self.__input = graph['input']
+        self.__output = graph['output']
+        self.__size = len(self.__output)
+
+    def __build_graph(self, datatable, reduce):
         resp = np.full(len(datatable.index), False, dtype=bool)
         selcol = InputSelectorCollection()
         distsum = SumOfDistributors()
@@ -66,10 +98,15 @@ class CompoundMap:
         relerrmap = RelativeErrorMap(
             datatable, distsum, selcol=selcol, distsum=distsum, reduce=reduce
         )
-        # save everything for later
-        self.__input = selcol
-        self.__output = distsum
-        self.__size = len(self.__output)
+        # the evaluation plan is compiled on first use
+        return {'dim': len(datatable), 'input': selcol,
+                'output': distsum, 'plan': None}
+
+    def __get_plan(self):
+        graph = self.__graph
+        if graph['plan'] is None:
+            graph['plan'] = CompiledGraph(graph['output'])
+        return graph['plan']
 
     def get_selectors(self):
         return self.__input.get_selectors()
@@ -77,6 +114,30 @@ class CompoundMap:
     def get_distributors(self):
         return self.__output.get_distributors()
 
+    def get_cache_stats(self, reset=False):
+        """Cache hits and misses summed over the nodes of the mapping.
+
+        The node caches are used by `propagate`, `jacobian`, `jvp`
+        and `vjp` unless the mapping was created with compiled=True.
+        The batched methods always use the compiled evaluation plan,
+        which bypasses the caches. All nodes depending on the input
+        are visited.
+        """
+        stats = {}
+        visited = set()
+        stack = list(self.get_selectors())
+        while len(stack) > 0:
+            node = stack.pop()
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+            for key, count in node.get_cache_stats().items():
+                stats[key] = stats.get(key, 0) + count
+            if reset:
+                node.reset_cache_stats()
+            stack.extend(node._descendants)
+        return stats
+
     def is_responsible(self, datatable=None):
         self.instantiate_maps(datatable)
         ret = np.full(self.__size, False)
@@ -87,8 +148,32 @@ class CompoundMap:
     def propagate(self, refvals, datatable=None):
         self.instantiate_maps(datatable)
         isresp = self.is_responsible()
-        self.__input.assign(refvals)
-        outvals = self.__output.evaluate()
+        if self.__compiled:
+            outvals = self.__get_plan().evaluate(refvals)
+        else:
+            self.__input.assign(refvals)
+            outvals = self.__output.evaluate()
+        if not self.__reduce:
+            propvals = refvals.copy()
+            propvals[isresp] = outvals[isresp]
+            return propvals
+        else:
+            return outvals
+
+    def propagate_batch(self, refvals, datatable=None):
+        """Propagate the columns of the matrix `refvals` together.
+
+        The result is a matrix whose columns are identical to the
+        results of `propagate` applied to the columns of `refvals`.
+        The columns are evaluated together by the compiled evaluation
+        plan, also if the mapping was not created with compiled=True.
+        """
+        self.instantiate_maps(datatable)
+        refvals = np.asarray(refvals, dtype=float)
+        if refvals.ndim != 2:
+            raise ValueError('refvals must be a matrix')
+        isresp = self.is_responsible()
+        outvals = self.__get_plan().evaluate(refvals)
         if not self.__reduce:
             propvals = refvals.copy()
             propvals[isresp] = outvals[isresp]
@@ -96,16 +181,115 @@ class CompoundMap:
         else:
             return outvals
 
-    def jacobian(self, refvals, datatable=None, with_id=True):
+    def jvp(self, refvals, vec, datatable=None, with_id=True):
+        """Product of the Jacobian matrix at `refvals` with `vec`.
+
+        The Jacobian matrix is not constructed.
+        """
+        self.instantiate_maps(datatable)
+        vec = np.asarray(vec, dtype=float)
+        if self.__compiled:
+            _, prod = self.__get_plan().jvp(refvals, vec)
+        else:
+            self.__input.assign(refvals)
+            prod = self.__output.jvp(vec)
+        if with_id and not self.__reduce:
+            prod = prod + vec
+        return prod
+
+    def vjp(self, refvals, vec, datatable=None, with_id=True):
+        """Product of the transposed Jacobian matrix at `refvals` with `vec`.
+
+        The Jacobian matrix is not constructed, the derivatives are
+        propagated backwards through the mapping instead. This is
+        useful for gradients of functions of the propagated values.
+        """
+        self.instantiate_maps(datatable)
+        vec = np.asarray(vec, dtype=float)
+        if self.__compiled:
+            prod = self.__get_plan().vjp(refvals, vec)
+        else:
+            self.__input.assign(refvals)
+            prod = self.__output.vjp(vec)
+        if with_id and not self.__reduce:
+            prod = prod + vec
+        return prod
+
+    def jvp_batch(self, refvals, vecs, datatable=None, with_id=True):
+        """Jacobian-vector products for many reference vectors.
+
+        Each column of `vecs` is multiplied by the Jacobian matrix
+        evaluated at the corresponding column of `refvals`, without
+        constructing the Jacobian matrices. The products are returned
+        as columns of a matrix and agree with those obtained with
+        the `jacobian` method. As in `propagate_batch`, the compiled
+        evaluation plan is used.
+        """
         self.instantiate_maps(datatable)
-        self.__input.assign(refvals)
-        Smat = self.__output.jacobian()
+        refvals = np.asarray(refvals, dtype=float)
+        vecs = np.asarray(vecs, dtype=float)
+        if refvals.ndim != 2 or vecs.shape != refvals.shape:
+            raise ValueError('refvals and vecs must be matrices of same shape')
+        _, prods = self.__get_plan().jvp(refvals, vecs)
         if with_id and not self.__reduce:
+            prods += vecs
+        return prods
+
+    def jacobian(self, refvals, datatable=None, with_id=True, pattern=None):
+        """Compute the Jacobian matrix.
+
+        If a sparsity pattern obtained by `jacobian_pattern` is passed
+        as `pattern`, the values are written into the matrix of the
+        pattern, whose structure remains the same for all calls.
+        The values are then computed by the compiled evaluation plan
+        on its fixed structure, so that no intermediate matrices are
+        built. The returned matrix is overwritten by the next call
+        with the same pattern.
+        """
+        self.instantiate_maps(datatable)
+        add_id = with_id and not self.__reduce
+        if pattern is not None:
+            plan = self.__get_plan()
+            if pattern.is_filled_by((plan, add_id)):
+                values_list = [plan.jacobian_values(refvals)]
+                if add_id:
+                    values_list.append(1.)
+                return pattern.fill(values_list)
+        if self.__compiled:
+            Smat = self.__get_plan().jacobian(refvals)
+        else:
+            self.__input.assign(refvals)
+            Smat = self.__output.jacobian()
+        if add_id:
             numel = self.__size
             ones = np.full(numel, 1., dtype=float)
             idcs = np.arange(numel)
-            idmat = csr_matrix((ones, (idcs, idcs)),
-                               shape=(numel, numel), dtype=float)
-            Smat += idmat
+            Smat = assemble_csr([get_triplets(Smat), (idcs, idcs, ones)],
+                                shape=(numel, numel))
+        if pattern is not None:
+            Smat = pattern.refill(Smat)
 
         return Smat
+
+    def jacobian_pattern(self, datatable=None, with_id=True):
+        """Sparsity pattern of the Jacobian matrix.
+
+        The pattern only depends on the datatable and covers
+        the Jacobian matrix for any reference values.
+        """
+        self.instantiate_maps(datatable)
+        plan = self.__get_plan()
+        indptr, indices = plan.jacobian_structure()
+        shape = (len(plan), plan.get_input_size())
+        rows = np.repeat(np.arange(shape[0]), np.diff(indptr))
+        sources = [(rows, indices)]
+        add_id = with_id and not self.__reduce
+        if add_id:
+            idcs = np.arange(self.__size)
+            sources.append((idcs, idcs))
+            shape = (self.__size, self.__size)
+        allrows = np.concatenate([r for r, _ in sources])
+        allcols = np.concatenate([c for _, c in sources])
+        Smat = csr_matrix((np.ones(len(allrows)), (allrows, allcols)),
+                          shape=shape)
+        return SparsityPattern(Smat, owner=(plan, add_id), sources=sources)
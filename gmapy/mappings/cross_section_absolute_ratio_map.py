@@ -3,7 +3,6 @@ from .mapping_elements import (
     InputSelectorCollection,
     Distributor,
     SumOfDistributors,
-    LinearInterpolation,
 )
 from .priortools import prepare_prior_and_exptable
 
@@ -91,9 +90,9 @@ class CrossSectionAbsoluteRatioMap:
             inpvar1 = selcol.define_selector(src_idcs1, src_len)
             inpvar2 = selcol.define_selector(src_idcs2, src_len)
             inpvar3 = selcol.define_selector(src_idcs3, src_len)
-            inpvar1_int = LinearInterpolation(inpvar1, src_en1, tar_en)
-            inpvar2_int = LinearInterpolation(inpvar2, src_en2, tar_en)
-            inpvar3_int = LinearInterpolation(inpvar3, src_en3, tar_en)
+            inpvar1_int = selcol.define_interpolation(inpvar1, src_en1, tar_en)
+            inpvar2_int = selcol.define_interpolation(inpvar2, src_en2, tar_en)
+            inpvar3_int = selcol.define_interpolation(inpvar3, src_en3, tar_en)
             tmpres = inpvar1_int / (inpvar2_int + inpvar3_int)
             outvar = Distributor(tmpres, tar_idcs, tar_len)
 
@@ -18,13 +18,14 @@ class CrossSectionFissionAverageMap:
 
     def __init__(self, datatable, fix_jacobian=True,
                  legacy_integration=True,
-                 atol=1e-6, rtol=1e-6, maxord=16,
+                 atol=1e-6, rtol=1e-6, maxord=16, exact_integration=False,
                  selcol=None, distsum=None, reduce=False):
         self._fix_jacobian = fix_jacobian
         self._legacy_integration = legacy_integration
         self._atol = atol
         self._rtol = rtol
         self._maxord = maxord
+        self._exact_integration = exact_integration
         self.__numrows = len(datatable)
         if selcol is None:
             selcol = InputSelectorCollection()
@@ -92,7 +93,8 @@ class CrossSectionFissionAverageMap:
             unnorm_fisobj = raw_fisobj * Const(scl)
             fisint = Integral(
                 unnorm_fisobj, ensfis, 'lin-lin',
-                atol=self._atol, rtol=self._rtol, maxord=self._maxord
+                atol=self._atol, rtol=self._rtol, maxord=self._maxord,
+                exact=self._exact_integration
             )
             fisobj = unnorm_fisobj / Replicator(fisint, len(unnorm_fisobj))
 
@@ -112,7 +114,8 @@ class CrossSectionFissionAverageMap:
                                        legacy=legacy_integration,
                                        fix_jacobian=fix_jacobian,
                                        atol=self._atol, rtol=self._rtol,
-                                       maxord=self._maxord)
+                                       maxord=self._maxord,
+                                       exact=self._exact_integration)
 
             exptable_red = exptable[exptable['REAC'].str.fullmatch(curreac, na=False)]
             rep_curfisavg = Replicator(curfisavg, len(exptable_red))
@@ -3,7 +3,6 @@ from .mapping_elements import (
     InputSelectorCollection,
     Distributor,
     SumOfDistributors,
-    LinearInterpolation,
 )
 from .priortools import prepare_prior_and_exptable
 
@@ -69,7 +68,7 @@ class CrossSectionMap:
             idcs2red = exptable_red.index
 
             inpvar = selcol.define_selector(idcs1red, src_len)
-            intres = LinearInterpolation(inpvar, ens1, ens2, zero_outside=True)
+            intres = selcol.define_interpolation(inpvar, ens1, ens2, zero_outside=True)
             outvar = Distributor(intres, idcs2red, tar_len)
             inp.add_selector(inpvar)
             out.add_distributor(outvar)
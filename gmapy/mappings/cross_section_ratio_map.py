@@ -3,7 +3,6 @@ from .mapping_elements import (
     InputSelectorCollection,
     Distributor,
     SumOfDistributors,
-    LinearInterpolation,
 )
 from .priortools import prepare_prior_and_exptable
 
@@ -81,8 +80,8 @@ class CrossSectionRatioMap:
 
             inpvar1 = selcol.define_selector(src_idcs1, src_len)
             inpvar2 = selcol.define_selector(src_idcs2, src_len)
-            inpvar1_int = LinearInterpolation(inpvar1, src_en1, tar_en)
-            inpvar2_int = LinearInterpolation(inpvar2, src_en2, tar_en)
+            inpvar1_int = selcol.define_interpolation(inpvar1, src_en1, tar_en)
+            inpvar2_int = selcol.define_interpolation(inpvar2, src_en2, tar_en)
             tmpres = inpvar1_int / inpvar2_int
             outvar = Distributor(tmpres, tar_idcs, tar_len)
             inp.add_selectors([inpvar1, inpvar2])
@@ -15,10 +15,12 @@ from .priortools import prepare_prior_and_exptable
 class CrossSectionRatioOfSacsMap:
 
     def __init__(self, datatable, atol=1e-05, rtol=1e-05,
-                 maxord=16, selcol=None, distsum=None, reduce=False):
+                 maxord=16, exact_integration=False,
+                 selcol=None, distsum=None, reduce=False):
         self.__atol = atol
         self.__rtol = rtol
         self.__maxord = maxord
+        self.__exact_integration = exact_integration
         self.__numrows = len(datatable)
         if selcol is None:
             selcol = InputSelectorCollection()
@@ -111,11 +113,13 @@ class CrossSectionRatioOfSacsMap:
 
             fisavg1 = FissionAverage(
                 ens1, xsobj1, ensfis, unnorm_fisobj, check_norm=False,
-                atol=self.__atol, rtol=self.__rtol, maxord=self.__maxord
+                atol=self.__atol, rtol=self.__rtol, maxord=self.__maxord,
+                exact=self.__exact_integration
             )
             fisavg2 = FissionAverage(
                 ens2, xsobj2, ensfis, unnorm_fisobj, check_norm=False,
-                atol=self.__atol, rtol=self.__rtol, maxord=self.__maxord
+                atol=self.__atol, rtol=self.__rtol, maxord=self.__maxord,
+                exact=self.__exact_integration
             )
             fisavg_ratio = fisavg1 / fisavg2
 
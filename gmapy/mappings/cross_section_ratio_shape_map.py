@@ -4,7 +4,6 @@ from .mapping_elements import (
     Replicator,
     Distributor,
     SumOfDistributors,
-    LinearInterpolation,
 )
 from .priortools import prepare_prior_and_exptable
 
@@ -87,8 +86,8 @@ class CrossSectionRatioShapeMap:
                 tar_idcs = exptable_red[exptable_red['NODE'].str.fullmatch(ds, na=False)].index
                 tar_en = exptable_red[exptable_red['NODE'].str.fullmatch(ds, na=False)]['ENERGY']
 
-                inpvar1_int = LinearInterpolation(inpvar1, src_en1, tar_en)
-                inpvar2_int = LinearInterpolation(inpvar2, src_en2, tar_en)
+                inpvar1_int = selcol.define_interpolation(inpvar1, src_en1, tar_en)
+                inpvar2_int = selcol.define_interpolation(inpvar2, src_en2, tar_en)
                 ratio = inpvar1_int / inpvar2_int
 
                 # obtain normalization and position in priortable
@@ -4,7 +4,6 @@ from .mapping_elements import (
     Replicator,
     Distributor,
     SumOfDistributors,
-    LinearInterpolation,
 )
 from .priortools import prepare_prior_and_exptable
 
@@ -82,7 +81,7 @@ class CrossSectionShapeMap:
                 idcs2red = exptable_ds.index
 
                 norm_fact_rep = Replicator(norm_fact, len(idcs2red))
-                inpvar_int = LinearInterpolation(inpvar, ens1, ens2)
+                inpvar_int = selcol.define_interpolation(inpvar, ens1, ens2)
                 prod = norm_fact_rep * inpvar_int
                 outvar = Distributor(prod, idcs2red, tar_len)
                 out.add_distributor(outvar)
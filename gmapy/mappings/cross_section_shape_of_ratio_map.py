@@ -4,7 +4,6 @@ from .mapping_elements import (
     Replicator,
     Distributor,
     SumOfDistributors,
-    LinearInterpolation,
 )
 from .priortools import prepare_prior_and_exptable
 
@@ -106,9 +105,9 @@ class CrossSectionShapeOfRatioMap:
                 inp.add_selector(norm_fact)
                 norm_fact_rep = Replicator(norm_fact, len(tar_idcs))
 
-                inpvar1_int = LinearInterpolation(inpvar1, src_en1, tar_en)
-                inpvar2_int = LinearInterpolation(inpvar2, src_en2, tar_en)
-                inpvar3_int = LinearInterpolation(inpvar3, src_en3, tar_en)
+                inpvar1_int = selcol.define_interpolation(inpvar1, src_en1, tar_en)
+                inpvar2_int = selcol.define_interpolation(inpvar2, src_en2, tar_en)
+                inpvar3_int = selcol.define_interpolation(inpvar3, src_en3, tar_en)
                 tmpres = norm_fact_rep * inpvar1_int / (inpvar2_int + inpvar3_int)
                 outvar = Distributor(tmpres, tar_idcs, tar_len)
                 out.add_distributor(outvar)
@@ -4,7 +4,6 @@ from .mapping_elements import (
     Replicator,
     Distributor,
     SumOfDistributors,
-    LinearInterpolation,
 )
 from .priortools import prepare_prior_and_exptable
 
@@ -99,7 +98,7 @@ class CrossSectionShapeOfSumMap:
 
                 cvars_int = []
                 for cv, src_en in zip(cvars, src_en_list):
-                    cvars_int.append(LinearInterpolation(cv, src_en, tar_en))
+                    cvars_int.append(selcol.define_interpolation(cv, src_en, tar_en))
 
                 tmpres = sum(cvars_int) * norm_fact_rep
                 outvar = Distributor(tmpres, tar_idcs, tar_len)
@@ -3,7 +3,6 @@ from .mapping_elements import (
     InputSelectorCollection,
     Distributor,
     SumOfDistributors,
-    LinearInterpolation,
 )
 from .priortools import prepare_prior_and_exptable
 
@@ -82,7 +81,7 @@ class CrossSectionTotalMap:
             inp.add_selectors(cvars)
             cvars_int = []
             for cv, en in zip(cvars, src_en_list):
-                cvars_int.append(LinearInterpolation(cv, en, tar_en))
+                cvars_int.append(selcol.define_interpolation(cv, en, tar_en))
 
             tmpres = sum(cvars_int)
             outvar = Distributor(tmpres, tar_idcs, tar_len)
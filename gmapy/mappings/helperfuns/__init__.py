@@ -1,6 +1,7 @@
 from .helperfuns import (
     mapclass_with_params,
-    get_legacy_to_pointwise_fis_factors
+    get_legacy_to_pointwise_fis_factors,
+    get_datatable_fingerprint
 )
 from .numeric_jacobian import numeric_jacobian
 from .romberg_integration import compute_romberg_integral
@@ -1,4 +1,6 @@
+import hashlib
 import numpy as np
+import pandas as pd
 
 
 def mapclass_with_params(origclass, **kwargs):
@@ -29,3 +31,15 @@ def get_legacy_to_pointwise_fis_factors(energies):
     scl = np.empty(len(sorted_scl), dtype=float)
     scl[sort_idcs] = sorted_scl
     return scl
+
+
+def get_datatable_fingerprint(datatable):
+    # The mapping graph only depends on the index and the
+    # columns below, hence a hash over them is sufficient
+    # to recognize a datatable with the same structure
+    # even if values in other columns have changed.
+    columns = [c for c in ('NODE', 'REAC', 'ENERGY', 'PTIDX')
+               if c in datatable.columns]
+    hashes = pd.util.hash_pandas_object(datatable[columns], index=True)
+    digest = hashlib.sha1(hashes.to_numpy().tobytes()).hexdigest()
+    return (len(datatable), tuple(columns), digest)
@@ -1,7 +1,8 @@
 import numpy as np
 
 
-def compute_romberg_integral(x, fun, maxord=4, atol=1e-8, rtol=1e-5, dfun=None):
+def compute_romberg_integral(x, fun, maxord=4, atol=1e-8, rtol=1e-5, dfun=None,
+                             ret_stats=False):
     """Definite integral by Romberg method.
 
     Romberg integration is performed for each
@@ -10,11 +11,16 @@ def compute_romberg_integral(x, fun, maxord=4, atol=1e-8, rtol=1e-5, dfun=None):
     defined functions, and some interpolation
     law used in-between the mesh points.
 
-    NOTE: The implementation of this function
-          is a bit inefficient because it
-          calculates the same functions values
-          several times. Can be improved at
-          some point in the future.
+    The trapezoidal rule of a refinement level
+    is obtained from the one of the previous level
+    so that the function only needs to be evaluated
+    at the new midpoints. Intervals whose error
+    estimate is well below their share of the
+    tolerance are not refined any further.
+    If ret_stats is True, a dictionary with the
+    number of refinement levels and the number of
+    evaluation points of fun and dfun is returned
+    in addition.
     """
     if maxord < 2:
         raise ValueError('maxord must be at least two')
@@ -30,9 +36,9 @@ def compute_romberg_integral(x, fun, maxord=4, atol=1e-8, rtol=1e-5, dfun=None):
             raise TypeError('dfun must be a function')
 
     x = np.sort(np.array(x, dtype=float))
+    num_intervals = len(x) - 1
     funvals = fun(x)
-    funvals_a = funvals[:-1]
-    funvals_b = funvals[1:]
+    stats = {'num_levels': 1, 'num_fun_points': len(x), 'num_dfun_points': 0}
     if calc_deriv:
         # NOTE: The function dfun provided as argument
         # yields for an x-value two partial derivatives
@@ -45,97 +51,99 @@ def compute_romberg_integral(x, fun, maxord=4, atol=1e-8, rtol=1e-5, dfun=None):
         # mesh point.
         dfunvals = np.array(dfun(x))
         dfunvals = np.sum(dfunvals, axis=0)
-        dfunvals_a = dfunvals[:-1]
-        dfunvals_b = dfunvals[1:]
+        stats['num_dfun_points'] += len(x)
     # do the Romberg integration simultaneously
     # for all the intervals defined by x;
     # in each interval an independent integration
     # is performed up to order J
     # link to document with good explanation:
     # https://www.math.usm.edu/lambers/mat460/fall09/lecture29.pdf
-    ftensor_list = []
-    df1tensor_list = []
-    df2tensor_list = []
-    T_list = []
-    dT1_list = []
-    dT2_list = []
-    curh = np.diff(x).reshape((len(x)-1, 1))
-    for j in range(1, maxord+1):
-
-        # pre-calculate all function values obtained
-        # by walking curh/2 steps
-        # required in the Romberg integration
-        if j < maxord:
-            curh.shape = (len(curh),1)
-            xtensor = (x[:-1].reshape(len(x)-1,1) +
-                    curh/2 * np.arange(1, 2**j).reshape((1,2**j-1)))
-            curshape = xtensor.shape
-            xtensor.shape = (np.prod(curshape),)
-            funvals = fun(xtensor)
-            funvals.shape = curshape
-            ftensor_list.append(funvals)
-            if calc_deriv:
-                # NOTE: xtensor does not contain
-                #       any values of x. This is
-                #       important because otherwise
-                #       dfun1 and dfun2 may not
-                #       yield the correct result
-                #       (i.e., 0 instead of 1)
-                dfunvals1, dfunvals2 = dfun(xtensor)
-                dfunvals1.shape = curshape
-                dfunvals2.shape = curshape
-                df1tensor_list.append(dfunvals1)
-                df2tensor_list.append(dfunvals2)
-
-        curh.shape = (len(curh),)
-        T_j1 = curh/2 * (funvals_a + funvals_b)
-        T_list.append([T_j1])
+    # Only the last row of the Romberg tableau is kept.
+    # The arrays span all intervals but only the elements
+    # of the intervals that are still refined are updated.
+    h = np.diff(x)
+    totlen = x[-1] - x[0]
+    T_prev = [h/2 * (funvals[:-1] + funvals[1:])]
+    est_vals = T_prev[0].copy()
+    est_errs = np.zeros(num_intervals, dtype=float)
+    if calc_deriv:
+        dT1_prev = [h/2 * dfunvals[:-1]]
+        dT2_prev = [h/2 * dfunvals[1:]]
+        est_dvals1 = dT1_prev[0].copy()
+        est_dvals2 = dT2_prev[0].copy()
+    active = np.arange(num_intervals)
+
+    for j in range(2, maxord+1):
+
+        # the new midpoints are the odd multiples of
+        # the current step size in each active interval
+        curh = h[active] / 2**(j-1)
+        steps = np.arange(1, 2**(j-1), 2).reshape(1, -1)
+        xtensor = x[active].reshape(-1, 1) + curh.reshape(-1, 1) * steps
+        curshape = xtensor.shape
+        funvals = fun(xtensor.flatten()).reshape(curshape)
+        stats['num_fun_points'] += funvals.size
+
+        T_j1 = T_prev[0].copy()
+        T_j1[active] = T_prev[0][active]/2 + curh * np.sum(funvals, axis=1)
+        T_cur = [T_j1]
         if calc_deriv:
-            dT1_j1 = curh/2 * dfunvals_a
-            dT2_j1 = curh/2 * dfunvals_b
-            dT1_list.append([dT1_j1])
-            dT2_list.append([dT2_j1])
-
-        if j >= 2:
-            T_j1 += curh * np.sum(ftensor_list[j-2], axis=1)
-            if calc_deriv:
-                dT1_j1 += curh * np.sum(df1tensor_list[j-2], axis=1)
-                dT2_j1 += curh * np.sum(df2tensor_list[j-2], axis=1)
-
-        # NOTE: this loop is not entered for the case j=1
+            # NOTE: xtensor does not contain
+            #       any values of x. This is
+            #       important because otherwise
+            #       dfun1 and dfun2 may not
+            #       yield the correct result
+            #       (i.e., 0 instead of 1)
+            dfunvals1, dfunvals2 = dfun(xtensor.flatten())
+            stats['num_dfun_points'] += funvals.size
+            dfunvals1 = np.reshape(dfunvals1, curshape)
+            dfunvals2 = np.reshape(dfunvals2, curshape)
+            dT1_j1 = dT1_prev[0].copy()
+            dT2_j1 = dT2_prev[0].copy()
+            dT1_j1[active] = (dT1_prev[0][active]/2 +
+                              curh * np.sum(dfunvals1, axis=1))
+            dT2_j1[active] = (dT2_prev[0][active]/2 +
+                              curh * np.sum(dfunvals2, axis=1))
+            dT1_cur = [dT1_j1]
+            dT2_cur = [dT2_j1]
+
+        # NOTE: the index k-3 refers for k=2 to the last
+        #       element of the previous row of the tableau
         for k in range(2, j+1):
-            T_jk = T_list[j-1][k-2] + 1/(4**(k-1)-1)*(T_list[j-1][k-2] - T_list[j-2][k-3])
-            T_list[j-1].append(T_jk)
+            fact = 1/(4**(k-1)-1)
+            T_cur.append(T_cur[k-2] + fact*(T_cur[k-2] - T_prev[k-3]))
             if calc_deriv:
-                dT1_jk = (dT1_list[j-1][k-2] +
-                          1/(4**(k-1)-1)*(dT1_list[j-1][k-2] - dT1_list[j-2][k-3]))
-                dT2_jk = (dT2_list[j-1][k-2] +
-                          1/(4**(k-1)-1)*(dT2_list[j-1][k-2] - dT2_list[j-2][k-3]))
-                dT1_list[j-1].append(dT1_jk)
-                dT2_list[j-1].append(dT2_jk)
+                dT1_cur.append(dT1_cur[k-2] + fact*(dT1_cur[k-2] - dT1_prev[k-3]))
+                dT2_cur.append(dT2_cur[k-2] + fact*(dT2_cur[k-2] - dT2_prev[k-3]))
 
+        est_errs[active] = T_cur[j-1][active] - T_prev[j-2][active]
+        est_vals[active] = T_cur[j-1][active]
+        if calc_deriv:
+            est_dvals1[active] = dT1_cur[j-1][active]
+            est_dvals2[active] = dT2_cur[j-1][active]
+        stats['num_levels'] = j
+
+        est_intval = np.sum(est_vals)
+        # looking at
+        # https://math.stackexchange.com/questions/1291613/romberg-integration-accuracy
+        # I guess this is an overestimate but in the right ballpark
+        est_error = np.abs(np.sum(est_errs))
+        # accuracy goal reached?
+        tol = np.abs(atol + rtol*est_intval)
+        if est_error < tol:
+            break
+
+        # the intervals that are converged keep their
+        # last estimate and error estimate from now on.
+        # As the error estimates of the frozen intervals
+        # do not decrease anymore, they may only use up
+        # a small fraction of the tolerance
+        is_converged = np.abs(est_errs[active]) < 0.1 * tol * h[active] / totlen
+        active = active[np.logical_not(is_converged)]
+        T_prev = T_cur
         if calc_deriv:
-            last_dT1 = dT1_list[j-1][j-1]
-            last_dT2 = dT2_list[j-1][j-1]
-            dT = np.empty(len(x), dtype=float)
-            dT[1:-1] = last_dT1[1:] + last_dT2[:-1]
-            dT[0] = last_dT1[0]
-            dT[-1] = last_dT2[-1]
-
-        est_intval = np.sum(T_list[j-1][j-1])
-
-        if j > 1:
-            # looking at
-            # https://math.stackexchange.com/questions/1291613/romberg-integration-accuracy
-            # I guess this is an overestimate but in the right ballpark
-            prev_intval = np.sum(T_list[j-2][j-2])
-            est_error = np.abs(np.sum(np.abs(est_intval-prev_intval)))
-            # accuracy goal reached?
-            if (est_error < np.abs(atol + rtol*est_intval)):
-                break
-
-        # half step size for next loop iteration
-        curh /= 2
+            dT1_prev = dT1_cur
+            dT2_prev = dT2_cur
 
     if est_error >= np.abs(atol + rtol*est_intval):
         raise ValueError(f'Desired accuracy (atol={atol}, rtol={rtol}) could not be reached.\n' +
@@ -144,6 +152,14 @@ def compute_romberg_integral(x, fun, maxord=4, atol=1e-8, rtol=1e-5, dfun=None):
                           'Try to increase maxord or reduce the accuracy by increasing atol and or rtol.')
 
     if not calc_deriv:
-        return est_intval
+        ret = est_intval
     else:
-        return dT
+        dT = np.empty(len(x), dtype=float)
+        dT[1:-1] = est_dvals1[1:] + est_dvals2[:-1]
+        dT[0] = est_dvals1[0]
+        dT[-1] = est_dvals2[-1]
+        ret = dT
+
+    if ret_stats:
+        return ret, stats
+    return ret
@@ -1,5 +1,5 @@
 import numpy as np
-from scipy.sparse import csr_matrix, vstack
+from scipy.sparse import csr_matrix, vstack, identity, issparse
 from .basic_maps import get_basic_sensmat
 from .basic_integral_maps import (
     basic_integral_propagate,
@@ -33,18 +33,61 @@ def elem_mul(x, y):
     else:
         return x.multiply(y)
 
+# the following two helper functions are used
+# to assemble a sparse matrix from (row, col, value)
+# triplets with a single conversion to CSR format
+# instead of adding up many full-size sparse matrices
+
+
+def get_triplets(mat):
+    if not issparse(mat):
+        empty_idcs = np.empty(0, dtype=np.int64)
+        return empty_idcs, empty_idcs, np.empty(0, dtype=float)
+    mat = mat.tocoo()
+    return mat.row, mat.col, mat.data
+
+
+def assemble_csr(triplets, shape):
+    # duplicate entries are summed up
+    nnz = sum(len(vals) for _, _, vals in triplets)
+    rows = np.empty(nnz, dtype=np.int64)
+    cols = np.empty(nnz, dtype=np.int64)
+    vals = np.empty(nnz, dtype=float)
+    pos = 0
+    for currows, curcols, curvals in triplets:
+        nextpos = pos + len(curvals)
+        rows[pos:nextpos] = currows
+        cols[pos:nextpos] = curcols
+        vals[pos:nextpos] = curvals
+        pos = nextpos
+    return csr_matrix((vals, (rows, cols)), shape=shape, dtype=float)
+
 # the following classes are the building
 # blocks to construct mathematical expressions
 # enabling the automated computation of derivatives
 
 
 class MyAlgebra:
+    """Base class of the nodes of a mapping.
+
+    The methods `evaluate` and `jacobian` return the result
+    of the last call unless an InputSelector the node depends
+    on has been assigned different values in the meantime,
+    which is signaled by `_signal_changes`. Derived classes
+    implement the computations in `_evaluate` and `_jacobian`.
+    The returned Jacobian matrices must not be modified.
+    """
 
-    def __init__(self):
+    def __init__(self, cache=True):
         self._values_updated = True
         self._jacobian_updated = True
         self._ancestors = []
         self._descendants = []
+        self._cache = cache
+        self._last_values = None
+        self._last_jacobian = None
+        self._sorted_nodes = None
+        self.reset_cache_stats()
 
     def __add__(self, other):
         return Addition(self, other)
@@ -65,16 +108,164 @@ class MyAlgebra:
         return False
 
     def evaluate(self):
+        if (self._cache and not self._values_updated
+                and self._last_values is not None):
+            self._cache_stats['value_hits'] += 1
+            return self._last_values.copy()
+        self._cache_stats['value_misses'] += 1
+        values = self._evaluate()
         self._values_updated = False
+        if not self._cache:
+            return values
+        self._last_values = values
+        return values.copy()
 
     def jacobian(self):
+        if (self._cache and not self._jacobian_updated
+                and self._last_jacobian is not None):
+            self._cache_stats['jacobian_hits'] += 1
+            return self._last_jacobian
+        self._cache_stats['jacobian_misses'] += 1
+        jac = self._jacobian()
         self._jacobian_updated = False
+        if self._cache:
+            self._last_jacobian = jac
+        return jac
+
+    def _evaluate(self):
+        raise NotImplementedError
+
+    def _jacobian(self):
+        raise NotImplementedError
+
+    def get_cache_stats(self):
+        return self._cache_stats.copy()
+
+    def reset_cache_stats(self):
+        self._cache_stats = {
+            'value_hits': 0, 'value_misses': 0,
+            'jacobian_hits': 0, 'jacobian_misses': 0
+        }
+
+    # products with the Jacobian matrix without constructing it.
+    # The nodes are processed in topological order according to
+    # their description by _get_compile_info and the values
+    # are taken from the current assignment of the InputSelectors
+
+    def jvp(self, v):
+        """Product of the Jacobian matrix with the vector `v`.
+
+        The vector `v` refers to the vector to which the
+        InputSelectors are applied.
+        """
+        v = np.asarray(v, dtype=float)
+        tangents = {}
+        for node, kind, data in self._get_sorted_nodes():
+            if kind == 'input':
+                res = data @ v
+            elif kind == 'const':
+                res = np.zeros(len(node), dtype=float)
+            elif kind == 'linear':
+                res = sum(mat @ tangents[id(anc)] for anc, mat in data)
+            elif kind == 'mul':
+                obj1, obj2 = data
+                res = (tangents[id(obj1)] * obj2.evaluate() +
+                       obj1.evaluate() * tangents[id(obj2)])
+            elif kind == 'div':
+                obj1, obj2 = data
+                v2 = obj2.evaluate()
+                res = (tangents[id(obj1)] -
+                       obj1.evaluate() / v2 * tangents[id(obj2)]) / v2
+            else:
+                local_jacs = node._local_jacobians(
+                    [anc.evaluate() for anc in data]
+                )
+                res = sum(local_jac @ tangents[id(anc)]
+                          for anc, local_jac in zip(data, local_jacs))
+            tangents[id(node)] = res
+        return tangents[id(self)]
+
+    def vjp(self, w):
+        """Product of the transposed Jacobian matrix with the vector `w`.
+
+        The result is 0.0 if the node does not depend on an InputSelector
+        in analogy to the `jacobian` method.
+        """
+        adjoints = {id(self): np.asarray(w, dtype=float)}
+
+        def add_adjoint(node, adj):
+            node_id = id(node)
+            if node_id in adjoints:
+                adjoints[node_id] = adjoints[node_id] + adj
+            else:
+                adjoints[node_id] = adj
+
+        res = 0.
+        for node, kind, data in reversed(self._get_sorted_nodes()):
+            adj = adjoints.pop(id(node), None)
+            if adj is None:
+                continue
+            if kind == 'input':
+                res = res + data.T @ adj
+            elif kind == 'linear':
+                for anc, mat in data:
+                    add_adjoint(anc, mat.T @ adj)
+            elif kind == 'mul':
+                obj1, obj2 = data
+                add_adjoint(obj1, adj * obj2.evaluate())
+                add_adjoint(obj2, adj * obj1.evaluate())
+            elif kind == 'div':
+                obj1, obj2 = data
+                v2 = obj2.evaluate()
+                add_adjoint(obj1, adj / v2)
+                add_adjoint(obj2, -adj * obj1.evaluate() / np.square(v2))
+            elif kind == 'generic':
+                local_jacs = node._local_jacobians(
+                    [anc.evaluate() for anc in data]
+                )
+                for anc, local_jac in zip(data, local_jacs):
+                    add_adjoint(anc, local_jac.T @ adj)
+        return res
+
+    def _get_sorted_nodes(self):
+        # depth-first search to obtain the nodes this node
+        # depends on in topological order, the result is
+        # kept until the structure of the graph changes
+        if self._sorted_nodes is not None:
+            return self._sorted_nodes
+        visited = set()
+        sorted_nodes = []
+
+        def collect(node):
+            if id(node) in visited:
+                return
+            visited.add(id(node))
+            kind, data = node._get_compile_info()
+            if kind == 'linear':
+                ancestors = [anc for anc, _ in data]
+            elif kind in ('mul', 'div', 'generic'):
+                ancestors = data
+            else:
+                ancestors = []
+            for anc in ancestors:
+                collect(anc)
+            sorted_nodes.append((node, kind, data))
+
+        collect(self)
+        self._sorted_nodes = sorted_nodes
+        return sorted_nodes
+
+    def _reset_sorted_nodes(self):
+        self._sorted_nodes = None
+        for desc in self._descendants:
+            desc._reset_sorted_nodes()
 
     def _add_descendant(self, descendant):
         self._descendants.append(descendant)
 
     def _add_ancestors(self, ancestors):
         self._ancestors.extend(ancestors)
+        self._reset_sorted_nodes()
 
     def _get_ancestors(self):
         return self._ancestors
@@ -95,6 +286,25 @@ class MyAlgebra:
     def jacobian_updated(self):
         return self._jacobian_updated
 
+    # the following methods describe the node for the
+    # compiled evaluation plan in compiled_graph.py.
+    # Nodes without a specialized description are evaluated
+    # by the plan via _forward and _local_jacobians, which
+    # take the values of the ancestors as arguments.
+
+    def _get_compile_info(self):
+        return ('generic', self._get_ancestors())
+
+    def _forward(self, invals):
+        raise NotImplementedError(
+            f'{type(self).__name__} cannot be compiled'
+        )
+
+    def _local_jacobians(self, invals):
+        raise NotImplementedError(
+            f'{type(self).__name__} cannot be compiled'
+        )
+
 
 class InputSelector(MyAlgebra):
 
@@ -118,16 +328,17 @@ class InputSelector(MyAlgebra):
     def islinear(self):
         return True
 
-    def evaluate(self):
-        super().evaluate()
+    def _evaluate(self):
         if self.__values is None:
             raise ValueError('please assign numbers')
         return self.__values
 
-    def jacobian(self):
-        super().jacobian()
+    def _jacobian(self):
         return self.__jacmat
 
+    def _get_compile_info(self):
+        return ('input', self.__jacmat)
+
     def assign(self, arraylike):
         if len(arraylike) != self.__size:
             raise IndexError('wrong length of vector')
@@ -158,32 +369,47 @@ class Selector(MyAlgebra):
     def islinear(self):
         return True
 
-    def evaluate(self):
-        super().evaluate()
+    def _evaluate(self):
         allvals = self.__inpobj.evaluate()
         return allvals[self.__idcs]
 
-    def jacobian(self):
-        super().jacobian()
+    def _jacobian(self):
+        outerS = self.__get_outer_jacobian()
+        innerS = self.__inpobj.jacobian()
+        S = matmul(outerS,  innerS)
+        return S
+
+    def _get_compile_info(self):
+        return ('linear', [(self.__inpobj, self.__get_outer_jacobian())])
+
+    def __get_outer_jacobian(self):
         src_size = len(self.__inpobj)
         tar_size = len(self.__idcs)
         coeffs = np.ones(tar_size)
         tar_idcs = np.arange(tar_size)
-        outerS = csr_matrix(
+        return csr_matrix(
             (coeffs, (tar_idcs, self.__idcs)),
             shape=(tar_size, src_size), dtype=float
         )
-        innerS = self.__inpobj.jacobian()
-        S = matmul(outerS,  innerS)
-        return S
 
 
 class InputSelectorCollection:
+    """Collection of the input selectors of a mapping.
+
+    Selectors of the same indices are only created once.
+    In the same way, the collection keeps track of the linear
+    interpolations defined with `define_interpolation` so that
+    maps and datasets sharing the same quantity and energy
+    meshes also share the interpolation node and matrix.
+    """
 
     def __init__(self, listlike=None):
         if listlike is None:
             listlike = []
         self.__selector_list = []
+        self.__selector_dict = {}
+        self.__interp_dict = {}
+        self.__interp_mats = {}
         self.add_selectors(listlike)
 
     def assign(self, arraylike):
@@ -208,17 +434,41 @@ class InputSelectorCollection:
         selids = {id(sel) for sel in self.__selector_list}
         if id(selector) not in selids:
             self.__selector_list.append(selector)
+            key = self.__get_selector_key(selector.get_indices())
+            self.__selector_dict.setdefault(key, selector)
 
     def define_selector(self, idcs, size):
-        for sel in self.__selector_list:
-            refidcs = sel.get_indices()
-            if len(idcs) == len(refidcs):
-                if np.all(idcs == refidcs):
-                    return sel
+        key = self.__get_selector_key(idcs)
+        sel = self.__selector_dict.get(key, None)
+        if sel is not None:
+            return sel
         newsel = InputSelector(idcs, size)
         self.__selector_list.append(newsel)
+        self.__selector_dict[key] = newsel
         return newsel
 
+    def define_interpolation(self, obj, src_x, tar_x, zero_outside=False):
+        src_x = np.array(src_x, dtype=float)
+        tar_x = np.array(tar_x, dtype=float)
+        mesh_key = (src_x.tobytes(), tar_x.tobytes(), zero_outside)
+        # the interpolation node keeps obj alive so that its id
+        # cannot be reused by another object as long as the
+        # node is in the dictionary
+        node_key = (id(obj),) + mesh_key
+        node = self.__interp_dict.get(node_key, None)
+        if node is not None:
+            return node
+        jacmat = self.__interp_mats.get(mesh_key, None)
+        node = LinearInterpolation(obj, src_x, tar_x, zero_outside,
+                                   jacobian=jacmat)
+        self.__interp_dict[node_key] = node
+        self.__interp_mats[mesh_key] = node.get_interpolation_matrix()
+        return node
+
+    @staticmethod
+    def __get_selector_key(idcs):
+        return np.array(idcs, dtype=np.int64).tobytes()
+
 
 class Const(MyAlgebra):
 
@@ -233,19 +483,20 @@ class Const(MyAlgebra):
     def islinear(self):
         return True
 
-    def evaluate(self):
-        super().evaluate()
+    def _evaluate(self):
         return self.__values
 
-    def jacobian(self):
-        super().jacobian()
+    def _jacobian(self):
         return 0.0
 
+    def _get_compile_info(self):
+        return ('const', self.__values)
+
 
 class Distributor(MyAlgebra):
 
     def __init__(self, obj, idcs, size, cache=True):
-        super().__init__()
+        super().__init__(cache=cache)
         if len(obj) != len(idcs):
             raise ValueError('size mismatch')
         obj._add_descendant(self)
@@ -262,9 +513,7 @@ class Distributor(MyAlgebra):
             (coeffs, (tar_idcs, src_idcs)),
             shape=(self.__size, src_len), dtype=float
         )
-        self.__cache = cache
-        self.__last_propvals = None
-        self.__last_jacobian = None
+        self.__last_triplets = None
 
     def __len__(self):
         return self.__size
@@ -272,24 +521,36 @@ class Distributor(MyAlgebra):
     def islinear(self):
         return True
 
-    def evaluate(self):
+    def _evaluate(self):
         res = np.zeros(self.__size, dtype=float)
-        if self.__cache and not self.values_updated():
-            res[self.__idcs] += self.__last_propvals
-            return res
-        super().evaluate()
-        nonzero_res = self.__obj.evaluate()
-        self.__last_propvals = nonzero_res
-        res[self.__idcs] += nonzero_res
+        res[self.__idcs] += self.__obj.evaluate()
         return res
 
     def jacobian(self):
-        if self.__cache and not self.jacobian_updated():
-            return self.__last_jacobian
-        super().jacobian()
-        jac = matmul(self.__dist_mat, self.__obj.jacobian())
-        self.__last_jacobian = jac
-        return jac
+        triplets, inpsize = self._jacobian_triplets()
+        if inpsize is None:
+            return 0.0
+        return assemble_csr([triplets], (self.__size, inpsize))
+
+    def _jacobian_triplets(self):
+        # the triplets of the Jacobian matrix and the number of columns,
+        # which is None if the jacobian of the object is a float.
+        # The triplets are cached instead of the Jacobian matrix
+        if (self._cache and not self._jacobian_updated
+                and self.__last_triplets is not None):
+            self._cache_stats['jacobian_hits'] += 1
+            return self.__last_triplets
+        self._cache_stats['jacobian_misses'] += 1
+        inner_jac = self.__obj.jacobian()
+        inpsize = inner_jac.shape[1] if issparse(inner_jac) else None
+        rows, cols, vals = get_triplets(inner_jac)
+        # the distribution only maps the row indices
+        self.__last_triplets = ((self.__idcs[rows], cols, vals), inpsize)
+        self._jacobian_updated = False
+        return self.__last_triplets
+
+    def _get_compile_info(self):
+        return ('linear', [(self.__obj, self.__dist_mat)])
 
     def get_indices(self):
         return self.__idcs.copy()
@@ -316,19 +577,33 @@ class SumOfDistributors(MyAlgebra):
             raise IndexError('empty list of distributors')
         return len(self.__distributor_list[0])
 
-    def evaluate(self):
-        super().evaluate()
+    def _evaluate(self):
         res = self.__distributor_list[0].evaluate()
         for obj in self.__distributor_list[1:]:
             res += obj.evaluate()
         return res
 
-    def jacobian(self):
-        super().jacobian()
-        jac = self.__distributor_list[0].jacobian()
-        for obj in self.__distributor_list[1:]:
-            jac += obj.jacobian()
-        return jac
+    def _jacobian(self):
+        triplets, inpsize = self._jacobian_triplets()
+        if inpsize is None:
+            return 0.0
+        return assemble_csr(triplets, (len(self), inpsize))
+
+    def _jacobian_triplets(self):
+        triplets = []
+        inpsize = None
+        for obj in self.__distributor_list:
+            curtriplets, curinpsize = obj._jacobian_triplets()
+            if type(obj) == Distributor:
+                curtriplets = [curtriplets]
+            triplets.extend(curtriplets)
+            if curinpsize is not None:
+                inpsize = curinpsize
+        return triplets, inpsize
+
+    def _get_compile_info(self):
+        idmat = identity(len(self), format='csr', dtype=float)
+        return ('linear', [(obj, idmat) for obj in self.__distributor_list])
 
     def get_distributors(self):
         return self.__distributor_list
@@ -361,18 +636,29 @@ class Replicator(MyAlgebra):
     def islinear(self):
         return True
 
-    def evaluate(self):
-        super().evaluate()
+    def _evaluate(self):
         return np.repeat(
             self.__obj.evaluate().reshape(1, -1),
             self.__num, axis=0
         ).flatten()
 
-    def jacobian(self):
-        super().jacobian()
-        return vstack(
-            [self.__obj.jacobian()] * self.__num, format='csr'
-        )
+    def _jacobian(self):
+        inner_jac = self.__obj.jacobian()
+        rows, cols, vals = get_triplets(inner_jac)
+        # the row indices of the replicas are shifted
+        # by multiples of the length of the object
+        objlen = len(self.__obj)
+        shifts = objlen * np.arange(self.__num).reshape(-1, 1)
+        rows = (rows.reshape(1, -1) + shifts).ravel()
+        cols = np.tile(cols, self.__num)
+        vals = np.tile(vals, self.__num)
+        shape = (len(self), inner_jac.shape[1])
+        return assemble_csr([(rows, cols, vals)], shape)
+
+    def _get_compile_info(self):
+        idmat = identity(len(self.__obj), format='csr', dtype=float)
+        repmat = vstack([idmat] * self.__num, format='csr')
+        return ('linear', [(self.__obj, repmat)])
 
 
 class Addition(MyAlgebra):
@@ -393,14 +679,16 @@ class Addition(MyAlgebra):
     def islinear(self):
         return True
 
-    def evaluate(self):
-        super().evaluate()
+    def _evaluate(self):
         return self.__obj1.evaluate() + self.__obj2.evaluate()
 
-    def jacobian(self):
-        super().jacobian()
+    def _jacobian(self):
         return self.__obj1.jacobian() + self.__obj2.jacobian()
 
+    def _get_compile_info(self):
+        idmat = identity(len(self), format='csr', dtype=float)
+        return ('linear', [(self.__obj1, idmat), (self.__obj2, idmat)])
+
 
 class Multiplication(MyAlgebra):
 
@@ -417,18 +705,19 @@ class Multiplication(MyAlgebra):
     def __len__(self):
         return len(self.__obj1)
 
-    def evaluate(self):
-        super().evaluate()
+    def _evaluate(self):
         return self.__obj1.evaluate() * self.__obj2.evaluate()
 
-    def jacobian(self):
-        super().jacobian()
+    def _jacobian(self):
         vals1 = self.__obj1.evaluate().reshape(-1, 1)
         vals2 = self.__obj2.evaluate().reshape(-1, 1)
         S1 = elem_mul(self.__obj1.jacobian(), vals2)
         S2 = elem_mul(self.__obj2.jacobian(), vals1)
         return S1 + S2
 
+    def _get_compile_info(self):
+        return ('mul', [self.__obj1, self.__obj2])
+
 
 class Division(MyAlgebra):
 
@@ -445,32 +734,37 @@ class Division(MyAlgebra):
     def __len__(self):
         return len(self.__obj1)
 
-    def evaluate(self):
-        super().evaluate()
+    def _evaluate(self):
         return self.__obj1.evaluate() / self.__obj2.evaluate()
 
-    def jacobian(self):
-        super().jacobian()
+    def _jacobian(self):
         v1 = self.__obj1.evaluate().reshape(-1, 1)
         v2_inv = 1.0 / self.__obj2.evaluate().reshape(-1, 1)
         S1 = elem_mul(self.__obj1.jacobian(), v2_inv)
         S2 = elem_mul(self.__obj2.jacobian(), -v1 * np.square(v2_inv))
         return S1 + S2
 
+    def _get_compile_info(self):
+        return ('div', [self.__obj1, self.__obj2])
+
 
 class LinearInterpolation(MyAlgebra):
 
-    def __init__(self, obj, src_x, tar_x, zero_outside=False):
+    def __init__(self, obj, src_x, tar_x, zero_outside=False, jacobian=None):
         super().__init__()
         if len(obj) != len(src_x):
             raise ValueError('length mismatch')
         obj._add_descendant(self)
         self._add_ancestors([obj])
         self.__obj = obj
-        yzeros = np.zeros(len(src_x), dtype=float)
-        self.__jacobian = get_basic_sensmat(
-            src_x, yzeros, tar_x, 'lin-lin', zero_outside
-        )
+        if jacobian is None:
+            yzeros = np.zeros(len(src_x), dtype=float)
+            jacobian = get_basic_sensmat(
+                src_x, yzeros, tar_x, 'lin-lin', zero_outside
+            )
+        elif jacobian.shape != (len(tar_x), len(src_x)):
+            raise ValueError('shape of jacobian does not match the meshes')
+        self.__jacobian = jacobian
 
     def __len__(self):
         return self.__jacobian.shape[0]
@@ -478,19 +772,23 @@ class LinearInterpolation(MyAlgebra):
     def islinear(self):
         return True
 
-    def evaluate(self):
-        super().evaluate()
+    def _evaluate(self):
         return matmul(self.__jacobian, self.__obj.evaluate()).flatten()
 
-    def jacobian(self):
-        super().jacobian()
+    def _jacobian(self):
         return matmul(self.__jacobian, self.__obj.jacobian())
 
+    def get_interpolation_matrix(self):
+        return self.__jacobian
+
+    def _get_compile_info(self):
+        return ('linear', [(self.__obj, self.__jacobian)])
+
 
 class Integral(MyAlgebra):
 
-    def __init__(self, obj, xvals, interp_type, cache=False, **kwargs):
-        super().__init__()
+    def __init__(self, obj, xvals, interp_type, cache=True, **kwargs):
+        super().__init__(cache=cache)
         if not isinstance(obj, MyAlgebra):
             raise TypeError('obj must be of class MyAlgebra')
         obj._add_descendant(self)
@@ -499,44 +797,41 @@ class Integral(MyAlgebra):
         self.__xvals = np.array(xvals)
         self.__interp_type = interp_type
         self.__kwargs = kwargs
-        self.__last_result = None
-        self.__last_jacobian = None
-        self.__cache = cache
 
     def __len__(self):
         return 1
 
     def islinear(self):
-        return True
+        # only the integral of a piecewise linear
+        # function is linear in the function values
+        return bool(np.all(np.asarray(self.__interp_type) == 'lin-lin'))
 
-    def evaluate(self):
-        if self.__cache and not self.values_updated():
-            return self.__last_result
-        super().evaluate()
+    def _evaluate(self):
         yvals = self.__obj.evaluate()
-        self.__last_result = np.array([basic_integral_propagate(
-            self.__xvals, yvals, self.__interp_type, **self.__kwargs
-        )])
-        return self.__last_result.copy()
+        return self._forward([yvals])
 
-    def jacobian(self):
-        if self.__cache and not self.jacobian_updated():
-            return self.__last_jacobian.copy()
-        super().jacobian()
+    def _jacobian(self):
         yvals = self.__obj.evaluate()
-        outer_jac = csr_matrix(get_basic_integral_sensmat(
-            self.__xvals, yvals, self.__interp_type, **self.__kwargs
-        ))
+        outer_jac = self._local_jacobians([yvals])[0]
         inner_jac = self.__obj.jacobian()
-        self.__last_jacobian = matmul(outer_jac, inner_jac)
-        return self.__last_jacobian.copy()
+        return matmul(outer_jac, inner_jac)
+
+    def _forward(self, invals):
+        return np.array([basic_integral_propagate(
+            self.__xvals, invals[0], self.__interp_type, **self.__kwargs
+        )])
+
+    def _local_jacobians(self, invals):
+        return [csr_matrix(get_basic_integral_sensmat(
+            self.__xvals, invals[0], self.__interp_type, **self.__kwargs
+        ))]
 
 
 class IntegralOfProduct(MyAlgebra):
 
     def __init__(self, obj_list, xlist, interplist,
-                 zero_outside=False, cache=False, **kwargs):
-        super().__init__()
+                 zero_outside=False, cache=True, **kwargs):
+        super().__init__(cache=cache)
         if not all(isinstance(obj, MyAlgebra) for obj in obj_list):
             raise TypeError('all objects in obj_list must be of type ' +
                             'obj_list')
@@ -553,41 +848,36 @@ class IntegralOfProduct(MyAlgebra):
         self.__interplist = interplist
         self.__zero_outside = zero_outside
         self.__kwargs = kwargs
-        self.__last_result = None
-        self.__last_jacobian = None
-        self.__cache = cache
 
     def __len__(self):
         return 1
 
-    def evaluate(self):
-        if self.__cache and not self.values_updated():
-            return self.__last_result.copy()
-        super().evaluate()
+    def _evaluate(self):
         ylist = [obj.evaluate() for obj in self._get_ancestors()]
-        self.__last_result = basic_integral_of_product_propagate(
-            self.__xlist, ylist, self.__interplist,
-            self.__zero_outside, **self.__kwargs
-        )
-        return self.__last_result.copy()
+        return self._forward(ylist)
 
-    def jacobian(self):
-        if self.__cache and not self.jacobian_updated():
-            return self.__last_jacobian.copy()
-        super().jacobian()
+    def _jacobian(self):
         ancestors = self._get_ancestors()
         ylist = [obj.evaluate() for obj in ancestors]
-        outer_jacs = get_basic_integral_of_product_sensmats(
-            self.__xlist, ylist, self.__interplist,
-            self.__zero_outside, **self.__kwargs
-        )
-        outer_jacs = [csr_matrix(mat) for mat in outer_jacs]
+        outer_jacs = self._local_jacobians(ylist)
         inner_jacs = [obj.jacobian() for obj in ancestors]
         jac = 0.
         for outer_jac, inner_jac in zip(outer_jacs, inner_jacs):
             jac += matmul(outer_jac, inner_jac)
-        self.__last_jacobian = jac
-        return self.__last_jacobian.copy()
+        return jac
+
+    def _forward(self, invals):
+        return basic_integral_of_product_propagate(
+            self.__xlist, invals, self.__interplist,
+            self.__zero_outside, **self.__kwargs
+        )
+
+    def _local_jacobians(self, invals):
+        outer_jacs = get_basic_integral_of_product_sensmats(
+            self.__xlist, invals, self.__interplist,
+            self.__zero_outside, **self.__kwargs
+        )
+        return [csr_matrix(mat) for mat in outer_jacs]
 
 
 class LegacyFissionAverage(MyAlgebra):
@@ -600,6 +890,9 @@ class LegacyFissionAverage(MyAlgebra):
         if not isinstance(fisobj, MyAlgebra):
             raise TypeError('fisobj must be of class MyAlgebra')
         xsobj._add_descendant(self)
+        # the fission spectrum is not considered in the Jacobian
+        # but changes of it must be signaled to this node
+        fisobj._add_descendant(self)
         self._add_ancestors([xsobj])
         self.__xsobj = xsobj
         self.__en = en
@@ -611,23 +904,30 @@ class LegacyFissionAverage(MyAlgebra):
     def __len__(self):
         return 1
 
-    def islinear(self):
-        return True
+    def _evaluate(self):
+        xs = self.__xsobj.evaluate()
+        fisvals = self.__fisobj.evaluate()
+        return self._forward([xs, fisvals])
 
-    def evaluate(self):
-        super().evaluate()
+    def _jacobian(self):
         xs = self.__xsobj.evaluate()
         fisvals = self.__fisobj.evaluate()
+        xsjac = self.__xsobj.jacobian()
+        out_jac = self._local_jacobians([xs, fisvals])[0]
+        return matmul(out_jac, xsjac)
+
+    def _get_compile_info(self):
+        return ('generic', [self.__xsobj, self.__fisobj])
+
+    def _forward(self, invals):
+        xs, fisvals = invals
         ret = propagate_fisavg(self.__en, xs, self.__fisen, fisvals,
                                check_norm=self.__check_norm)
         assert isinstance(ret, float)
         return np.array([ret])
 
-    def jacobian(self):
-        super().jacobian()
-        xs = self.__xsobj.evaluate()
-        fisvals = self.__fisobj.evaluate()
-        xsjac = self.__xsobj.jacobian()
+    def _local_jacobians(self, invals):
+        xs, fisvals = invals
         if self.__fix_jacobian:
             sensvec = get_sensmat_fisavg_corrected(
                 self.__en, xs, self.__fisen, fisvals,
@@ -638,7 +938,10 @@ class LegacyFissionAverage(MyAlgebra):
                 self.__en, xs, self.__fisen, fisvals
             )
         out_jac = csr_matrix(sensvec.reshape(1, -1))
-        return matmul(out_jac, xsjac)
+        # as in the jacobian method, the dependence
+        # on the fission spectrum is not considered
+        fis_jac = csr_matrix((1, len(fisvals)), dtype=float)
+        return [out_jac, fis_jac]
 
 
 class FissionAverage(MyAlgebra):
@@ -652,6 +955,7 @@ class FissionAverage(MyAlgebra):
         self.__rtol = kwargs.get('rtol', 1e-5)
         self.__atol = kwargs.get('atol', 1e-6)
         self.__maxord = kwargs.get('maxord', 16)
+        self.__exact = kwargs.get('exact', False)
         if legacy:
             self.__fisavg = LegacyFissionAverage(
                 en, xsobj, fisen, fisobj, check_norm, fix_jacobian,
@@ -660,12 +964,13 @@ class FissionAverage(MyAlgebra):
             if check_norm:
                 self.__fisint = Integral(
                     fisobj, fisen, 'lin-lin',
-                    atol=self.__atol, rtol=self.__rtol, maxord=self.__maxord
+                    atol=self.__atol, rtol=self.__rtol, maxord=self.__maxord,
+                    exact=self.__exact
                 )
             self.__fisavg = IntegralOfProduct(
                 [xsobj, fisobj], [en, fisen], ['lin-lin', 'lin-lin'],
                 zero_outside=True, atol=self.__atol, rtol=self.__rtol,
-                maxord=self.__maxord
+                maxord=self.__maxord, exact=self.__exact
             )
         self.__fisavg._add_descendant(self)
         self._add_ancestors([self.__fisavg])
@@ -678,15 +983,32 @@ class FissionAverage(MyAlgebra):
     def islinear(self):
         return type(self.__fisavg) == LegacyFissionAverage
 
-    def evaluate(self):
-        super().evaluate()
+    def _evaluate(self):
         if self.__check_norm and not self.__legacy:
-            if not np.isclose(self.__fisint.evaluate()[0], 1.,
-                              rtol=self.__rtol, atol=self.__atol):
-                raise ValueError('fission spectrum not normalized')
+            self.__check_fisint(self.__fisint.evaluate())
         ret = self.__fisavg.evaluate()
         return ret
 
-    def jacobian(self):
-        super().jacobian()
+    def _jacobian(self):
         return self.__fisavg.jacobian()
+
+    def _get_compile_info(self):
+        if self.__check_norm and not self.__legacy:
+            return ('generic', [self.__fisavg, self.__fisint])
+        return ('generic', [self.__fisavg])
+
+    def _forward(self, invals):
+        if len(invals) > 1:
+            self.__check_fisint(invals[1])
+        return invals[0].copy()
+
+    def _local_jacobians(self, invals):
+        jacs = [identity(1, format='csr', dtype=float)]
+        if len(invals) > 1:
+            jacs.append(csr_matrix((1, 1), dtype=float))
+        return jacs
+
+    def __check_fisint(self, fisint_vals):
+        if not np.isclose(fisint_vals[0], 1.,
+                          rtol=self.__rtol, atol=self.__atol):
+            raise ValueError('fission spectrum not normalized')
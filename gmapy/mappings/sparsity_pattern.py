@@ -0,0 +1,142 @@
+import numpy as np
+from scipy.sparse import csr_matrix, csc_matrix
+
+
+class SparsityPattern:
+    """Fixed sparsity pattern of a Jacobian matrix.
+
+    The pattern is given by the structure of the CSR matrix `mat`.
+    The method `refill` copies the values of a matrix whose nonzero
+    elements are covered by the pattern into the data array of
+    a matrix with the fixed pattern, which is reused for all
+    refills. The positions of the elements in the data array
+    are only recomputed if the structure of the provided
+    matrix changes.
+
+    If the structures of the matrices that make up the Jacobian
+    matrix are known in advance, they can be passed as list of
+    (rows, cols) tuples in `sources` together with an `owner`
+    object identifying their origin. Their positions in the data
+    array are determined once and `fill` only needs to scatter
+    the values. The matrix returned by `refill` and `fill` is
+    overwritten by the next call.
+    """
+
+    def __init__(self, mat, owner=None, sources=()):
+        mat = csr_matrix(mat)
+        mat.sum_duplicates()
+        mat.sort_indices()
+        self.__shape = mat.shape
+        self.__mat = csr_matrix(
+            (np.zeros(mat.nnz, dtype=float), mat.indices, mat.indptr),
+            shape=mat.shape, copy=False
+        )
+        self.__mat.has_sorted_indices = True
+        self.__keys = self.__get_keys(mat)
+        self.__last_indptr = None
+        self.__last_indices = None
+        self.__last_pos = None
+        self.__owner = owner
+        self.__source_pos = [self.__find(rows, cols) for rows, cols in sources]
+
+    @property
+    def shape(self):
+        return self.__shape
+
+    @property
+    def nnz(self):
+        return self.__mat.nnz
+
+    def __get_keys(self, mat):
+        rows = np.repeat(np.arange(mat.shape[0]), np.diff(mat.indptr))
+        return rows * mat.shape[1] + mat.indices.astype(np.int64)
+
+    def __find(self, rows, cols):
+        keys = (np.asarray(rows, dtype=np.int64) * self.__shape[1] +
+                np.asarray(cols, dtype=np.int64))
+        pos = np.searchsorted(self.__keys, keys)
+        pos[pos == len(self.__keys)] = 0
+        if np.any(self.__keys[pos] != keys):
+            raise ValueError('matrix not covered by the sparsity pattern')
+        return pos
+
+    def __get_positions(self, mat):
+        if (self.__last_pos is not None and
+                np.array_equal(mat.indptr, self.__last_indptr) and
+                np.array_equal(mat.indices, self.__last_indices)):
+            return self.__last_pos
+        rows = np.repeat(np.arange(mat.shape[0]), np.diff(mat.indptr))
+        pos = self.__find(rows, mat.indices)
+        self.__last_indptr = mat.indptr.copy()
+        self.__last_indices = mat.indices.copy()
+        self.__last_pos = pos
+        return pos
+
+    def refill(self, mat):
+        if mat.shape != self.__shape:
+            raise IndexError('shape of matrix does not match the pattern')
+        mat = csr_matrix(mat)
+        mat.sum_duplicates()
+        mat.sort_indices()
+        pos = self.__get_positions(mat)
+        data = self.__mat.data
+        data.fill(0.)
+        data[pos] = mat.data
+        return self.__mat
+
+    def is_filled_by(self, owner):
+        return self.__owner is not None and self.__owner == owner
+
+    def fill(self, values_list):
+        """Scatter the values of the source matrices into the pattern.
+
+        The elements of `values_list` are the values of the
+        matrices given by `sources` in the order of their structure
+        or scalars if all values of a matrix are the same.
+        """
+        data = self.__mat.data
+        data.fill(0.)
+        for pos, vals in zip(self.__source_pos, values_list):
+            data[pos] += vals
+        return self.__mat
+
+    def get_matrix(self):
+        return self.__mat
+
+    def get_submatrix_map(self, row_sel, col_sel):
+        return SubmatrixMap(self, row_sel, col_sel)
+
+
+class SubmatrixMap:
+    """Extraction of a submatrix with a fixed sparsity pattern.
+
+    The submatrix of the rows `row_sel` and columns `col_sel`
+    of a matrix with the sparsity pattern `pattern` is stored
+    in CSC format. The positions of its elements in the data
+    array of the full matrix are determined once so that
+    `refill` only needs to gather the values into a new
+    matrix, which shares the index arrays with the others.
+    The submatrix therefore remains valid if the full matrix
+    is refilled later.
+    """
+
+    def __init__(self, pattern, row_sel, col_sel):
+        mat = pattern.get_matrix()
+        # the positions in the data array are encoded in the
+        # values, the offset of one prevents the removal of zeros
+        posmat = csr_matrix(
+            (np.arange(1, mat.nnz+1, dtype=float), mat.indices, mat.indptr),
+            shape=mat.shape
+        )
+        submat = posmat[row_sel,:][:,col_sel].tocsc()
+        submat.sort_indices()
+        self.__pos = submat.data.astype(np.int64) - 1
+        submat.data = np.zeros(len(self.__pos), dtype=float)
+        self.__submat = submat
+
+    def refill(self, mat):
+        submat = self.__submat
+        res = csc_matrix((mat.data[self.__pos], submat.indices, submat.indptr),
+                         shape=submat.shape, copy=False)
+        res.has_sorted_indices = True
+        return res
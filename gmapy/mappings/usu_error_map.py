@@ -1,6 +1,12 @@
 import numpy as np
 from sksparse.cholmod import cholesky
-from scipy.sparse import issparse, csr_matrix
+from scipy.sparse import issparse
+from scipy.linalg import cho_factor, cho_solve
+from .mapping_elements import get_triplets, assemble_csr
+from ..data_management.structured_covmat import (
+    StructuredCovariance,
+    select_covmat
+)
 
 
 class USUErrorMap:
@@ -29,9 +35,8 @@ class USUErrorMap:
 
     def jacobian(self, refvals, datatable=None, only_usu=False):
         num_points = datatable.shape[0]
-        idcs1, idcs2, coeffs = self.__compute(datatable, refvals, 'jacobian', only_usu)
-        Smat = csr_matrix((coeffs, (idcs2, idcs1)), dtype=float,
-                          shape=(num_points, num_points))
+        triplets = self.__compute(datatable, refvals, 'jacobian', only_usu)
+        Smat = assemble_csr(triplets, shape=(num_points, num_points))
         return Smat
 
     def __compute(self, datatable, refvals, what, only_usu=False):
@@ -54,15 +59,12 @@ class USUErrorMap:
             else:
                 propvals = np.full(len(base_propvals), 0., dtype='d')
         elif what == 'jacobian':
+            triplets = []
             if not only_usu:
-                base_S = compmap.jacobian(refvals, datatable).tocoo()
-                idcs1_list = [base_S.col]
-                idcs2_list = [base_S.row]
-                coeffs_list = [base_S.data]
-            else:
-                idcs1_list = []
-                idcs2_list = []
-                coeffs_list = []
+                base_S = compmap.jacobian(refvals, datatable)
+                base_rows, base_cols, base_coeffs = get_triplets(base_S)
+                # copy because the coefficients are rescaled below
+                triplets.append((base_rows, base_cols, base_coeffs.copy()))
         else:
             raise ValueError('what must be either "propagate" or "jacobian"')
 
@@ -85,18 +87,14 @@ class USUErrorMap:
                 propvals[glob_tar_idcs] += base_propvals[glob_tar_idcs] * refvals[glob_src_idcs]
             if what == 'jacobian':
                 glob_sensvals = base_propvals[glob_tar_idcs]
-                idcs1_list.append(glob_src_idcs)
-                idcs2_list.append(glob_tar_idcs)
-                coeffs_list.append(glob_sensvals)
+                triplets.append((glob_tar_idcs, glob_src_idcs, glob_sensvals))
 
         if what == 'propagate':
             return propvals
         elif what == 'jacobian':
-            coeffs_list[0] *= relpropvals[idcs2_list[0]]
-            idcs1 = np.concatenate(idcs1_list)
-            idcs2 = np.concatenate(idcs2_list)
-            coeffs = np.concatenate(coeffs_list)
-            return idcs1, idcs2, coeffs
+            first_rows, _, first_coeffs = triplets[0]
+            first_coeffs *= relpropvals[first_rows]
+            return triplets
 
     # additional functions to obtain scores and
     # gradients related to the USU uncertainties.
@@ -109,118 +107,203 @@ class USUErrorMap:
     # good assignment of uncertainties do not have to
     # update the datatable.
 
+    def likelihood_evaluator(self, datatable, covmat, expvals=None):
+        return USULikelihoodEvaluator(self, datatable, covmat, expvals)
+
     def loglikelihood(self, datatable, refvals, expvals, covmat):
-        logdet_res = self.logdet(datatable, refvals, covmat)
-        chisquare_res = self.chisquare(datatable, refvals, expvals, covmat)
-        num_points = np.sum(datatable.NODE.str.match('exp_'))
-        loglike_res = (-0.5) * (logdet_res + chisquare_res + num_points*np.log(2*np.pi))
-        return loglike_res
+        evaluator = self.likelihood_evaluator(datatable, covmat, expvals)
+        return evaluator.loglikelihood(refvals)
 
     def grad_loglikelihood(self, datatable, refvals, expvals, covmat):
-        grad_logdet_res = self.grad_logdet(datatable, refvals, covmat)
-        grad_chisquare_res = self.grad_chisquare(datatable, refvals, expvals, covmat)
-        grad_loglike_res = (-0.5) * (grad_logdet_res + grad_chisquare_res)
-        return grad_loglike_res
-
-    def _prepare_auxiliary_usu_info(self, datatable, refvals, covmat):
-        usu_idcs = datatable.index[datatable.NODE.str.match('usu_')]
-        exp_idcs = datatable.index[datatable.NODE.str.match('exp_')]
-        Susu = self.jacobian(refvals, datatable, only_usu=False)
-        Susu = Susu[exp_idcs,:][:,usu_idcs].tocsc()
-        # the .tocsc() addition to avoid an efficiency warning
-        # during the Cholesky decomposition
-        expcov = covmat[exp_idcs,:][:,exp_idcs].tocsc()
-        usucov = covmat[usu_idcs,:][:,usu_idcs].tocsc()
-        expcov_fact = cholesky(expcov)
-        usucov_fact = cholesky(usucov)
-        usu_aux = {
-            'refvals': refvals,
-            'usu_idcs': usu_idcs,
-            'exp_idcs': exp_idcs,
-            'Susu': Susu,
-            'expcov_fact': expcov_fact,
-            'usucov_fact': usucov_fact,
-                }
-        return usu_aux
-
-    def _mult_dt_Z_d(self, A_fact, U_fact, S, d):
-        z0 = A_fact(d)
-        first_term = d.T @ z0
-        z1 = S.T @ z0
-        zc = U_fact.inv() + S.T @ A_fact(S)
-        zc_fact = cholesky(zc.tocsc())
-        if issparse(z1):
-            z1 = z1.asformat('csc')
-        z2 = zc_fact(z1)
-        second_term = z1.T @ z2
-        return first_term - second_term
-
-    def _mult_Z_d(self, A_fact, U_fact, S, d):
-        first_term = A_fact(d)
-        z1 = S.T @ first_term
-        zc = U_fact.inv() + S.T @ A_fact(S)
-        zc_fact = cholesky(zc)
-        z2 = zc_fact(z1)
-        second_term = A_fact(S @ z2)
-        return first_term - second_term
+        evaluator = self.likelihood_evaluator(datatable, covmat, expvals)
+        return evaluator.grad_loglikelihood(refvals)
 
     def logdet(self, datatable, refvals, covmat):
-        usu_aux = self._prepare_auxiliary_usu_info(datatable, refvals, covmat)
-        Susu = usu_aux['Susu']
-        usucov_fact = usu_aux['usucov_fact']
-        expcov_fact = usu_aux['expcov_fact']
-        Z = usucov_fact.inv() + Susu.T @ expcov_fact(Susu)
-        Z_fact = cholesky(Z)
-        res = expcov_fact.logdet() + usucov_fact.logdet() + Z_fact.logdet()
-        return res
+        evaluator = self.likelihood_evaluator(datatable, covmat)
+        return evaluator.logdet(refvals)
 
     def chisquare(self, datatable, refvals, expvals, covmat):
-        usu_aux = self._prepare_auxiliary_usu_info(datatable, refvals, covmat)
-        usu_idcs = usu_aux['usu_idcs']
-        exp_idcs = usu_aux['exp_idcs']
-        Susu = usu_aux['Susu']
-        usucov_fact = usu_aux['usucov_fact']
-        expcov_fact = usu_aux['expcov_fact']
-        refvals = np.copy(refvals)
-        # calculate the difference between predictions and experiments
-        # (we force the USU error to be zero; however, should this be a user choice?)
-        refvals[usu_idcs] = 0.
-        preds = self.propagate(refvals, datatable)
-        preds = preds[exp_idcs]
-        real_expvals = expvals[exp_idcs]
-        d = real_expvals - preds
-        return self._mult_dt_Z_d(expcov_fact,
-                                     usucov_fact, Susu, d)
+        evaluator = self.likelihood_evaluator(datatable, covmat, expvals)
+        return evaluator.chisquare(refvals)
 
     def grad_logdet(self, datatable, refvals, covmat):
-        usu_aux = self._prepare_auxiliary_usu_info(datatable, refvals, covmat)
-        usu_idcs = usu_aux['usu_idcs']
-        Susu = usu_aux['Susu']
-        usucov_fact = usu_aux['usucov_fact']
-        expcov_fact = usu_aux['expcov_fact']
-        S_invCov_ST = self._mult_dt_Z_d(expcov_fact, usucov_fact,
-                                            Susu, Susu)
-        res = S_invCov_ST.diagonal()
-        # given that the diagonal in USU covmat is given by UNC^2
-        # the derivatives are given by 2*UNC = 2*sqrt(diag(covmat))
-        res *= 2*np.sqrt(covmat[usu_idcs,:][:,usu_idcs].diagonal())
-        return res
+        evaluator = self.likelihood_evaluator(datatable, covmat)
+        return evaluator.grad_logdet(refvals)
 
     def grad_chisquare(self, datatable, refvals, expvals, covmat):
-        usu_aux = self._prepare_auxiliary_usu_info(datatable, refvals, covmat)
-        usu_idcs = usu_aux['usu_idcs']
-        exp_idcs = usu_aux['exp_idcs']
-        Susu = usu_aux['Susu']
-        usucov_fact = usu_aux['usucov_fact']
-        expcov_fact = usu_aux['expcov_fact']
-        # calculate the difference between predictions and experiments
-        # (we force the USU error to be zero; however, should this be a user choice?)
-        refvals[usu_idcs] = 0.
-        preds = self.propagate(refvals, datatable)
-        preds = preds[exp_idcs]
-        real_expvals = expvals[exp_idcs]
-        d = real_expvals - preds
-        zvec = self._mult_Z_d(expcov_fact, usucov_fact, Susu, d)
-        zvec = Susu.T @ zvec
-        zvec *= zvec * 2*np.sqrt(covmat[usu_idcs,:][:,usu_idcs].diagonal())
-        return (-zvec)
+        evaluator = self.likelihood_evaluator(datatable, covmat, expvals)
+        return evaluator.grad_chisquare(refvals)
+
+
+class USULikelihoodEvaluator:
+    """Log likelihood of the USU model and its gradient.
+
+    The experimental data are assumed to be normally distributed with
+    covariance matrix C + S D^2 S', where C is the experimental
+    covariance matrix, S the Jacobian matrix with respect to the USU
+    errors and D the diagonal matrix of USU uncertainties. The gradients
+    are taken with respect to these uncertainties. Hence the USU
+    errors must be uncorrelated, also with the experimental errors,
+    otherwise a ValueError is raised.
+
+    All quantities are obtained from the same factorizations:
+    C is factorized once per covariance matrix passed to `set_covmat`,
+    and the products S' inv(C) S and S' inv(C) d (with d the difference
+    between experimental values and predictions) once per vector of
+    reference values. Given these, a set of USU uncertainties only
+    requires the Cholesky decomposition of the small dense matrix
+    I + D S' inv(C) S D. The results for the last reference values
+    and USU uncertainties are cached, so an optimizer can request
+    the log likelihood and its gradient in separate calls.
+    """
+
+    def __init__(self, mapping, datatable, covmat, expvals=None):
+        self._mapping = mapping
+        self._datatable = datatable
+        self._usu_idcs = datatable.index[datatable.NODE.str.match('usu_')]
+        self._exp_idcs = datatable.index[datatable.NODE.str.match('exp_')]
+        self._expvals = None
+        if expvals is not None:
+            self._expvals = np.asarray(expvals, dtype=float)[self._exp_idcs]
+        self._cov_version = 0
+        self._refvals_key = None
+        self._key = None
+        self.set_covmat(covmat)
+
+    def set_covmat(self, covmat):
+        exp_idcs = self._exp_idcs
+        usu_idcs = self._usu_idcs
+        if isinstance(covmat, StructuredCovariance):
+            # the cached factors of the experimental blocks are reused
+            self._expcov_fact = covmat.select(exp_idcs).factorize()
+        else:
+            # the .tocsc() addition to avoid an efficiency warning
+            # during the Cholesky decomposition
+            expcov = covmat[exp_idcs,:][:,exp_idcs].tocsc()
+            self._expcov_fact = cholesky(expcov)
+        self._expcov_logdet = self._expcov_fact.logdet()
+        # only the diagonal of the USU block enters the likelihood,
+        # hence any other covariances must be absent
+        usucov = select_covmat(covmat, usu_idcs)
+        offdiag = usucov.tocsr()
+        offdiag.setdiag(0.)
+        if offdiag.count_nonzero() > 0:
+            raise ValueError('the USU errors must be uncorrelated')
+        if isinstance(covmat, StructuredCovariance):
+            sel = np.concatenate([exp_idcs, usu_idcs])
+            is_correlated = covmat.select(sel).is_correlated(
+                np.arange(len(exp_idcs), len(sel))
+            )
+        else:
+            crosscov = covmat.tocsr()[usu_idcs,:][:,exp_idcs]
+            is_correlated = crosscov.count_nonzero() > 0
+        if is_correlated:
+            raise ValueError('the USU errors must be uncorrelated '
+                             'with the experimental errors')
+        self._usu_uncs = np.sqrt(usucov.diagonal())
+        self._cov_version += 1
+
+    def get_usu_uncertainties(self):
+        return self._usu_uncs.copy()
+
+    def _prepare_refvals(self, refvals):
+        refvals = np.asarray(refvals, dtype=float)
+        key = (refvals.tobytes(), self._cov_version)
+        if key == self._refvals_key:
+            return
+        mapping = self._mapping
+        datatable = self._datatable
+        usu_idcs = self._usu_idcs
+        exp_idcs = self._exp_idcs
+        expcov_fact = self._expcov_fact
+        Susu = mapping.jacobian(refvals, datatable, only_usu=False)
+        Susu = Susu[exp_idcs,:][:,usu_idcs].tocsc()
+        St_invC_S = Susu.T @ expcov_fact(Susu)
+        if issparse(St_invC_S):
+            St_invC_S = St_invC_S.toarray()
+        self._St_invC_S = np.asarray(St_invC_S)
+        if self._expvals is not None:
+            # calculate the difference between predictions and experiments
+            # (we force the USU error to be zero; however, should this be a user choice?)
+            refvals = refvals.copy()
+            refvals[usu_idcs] = 0.
+            preds = mapping.propagate(refvals, datatable)
+            d = self._expvals - preds[exp_idcs]
+            invC_d = expcov_fact(d)
+            self._d_invC_d = d @ invC_d
+            self._St_invC_d = np.ravel(Susu.T @ invC_d)
+        self._refvals_key = key
+
+    def evaluate(self, refvals, usu_uncs=None):
+        """Compute the log determinant, chi-square value and gradients.
+
+        The result is a dictionary with the keys `logdet`, `grad_logdet`,
+        `chisquare` and `grad_chisquare`. The chi-square value and its
+        gradient are only available if experimental values were provided.
+        If `usu_uncs` is None, the USU uncertainties are taken from
+        the covariance matrix.
+        """
+        if usu_uncs is None:
+            usu_uncs = self._usu_uncs
+        usu_uncs = np.asarray(usu_uncs, dtype=float)
+        self._prepare_refvals(refvals)
+        key = (self._refvals_key, usu_uncs.tobytes())
+        if key == self._key:
+            return self._result
+        # matrix determinant lemma and Woodbury identity with the
+        # capacitance matrix K = I + D S' inv(C) S D
+        M = self._St_invC_S
+        DM = usu_uncs.reshape(-1, 1) * M
+        K = np.identity(len(usu_uncs)) + DM * usu_uncs.reshape(1, -1)
+        K_fact = cho_factor(K, lower=True)
+        # S' inv(C + S D^2 S') S
+        St_invCeff_S = M - DM.T @ cho_solve(K_fact, DM)
+        res = {}
+        res['logdet'] = (self._expcov_logdet +
+                         2 * np.sum(np.log(np.diagonal(K_fact[0]))))
+        res['grad_logdet'] = 2 * usu_uncs * np.diagonal(St_invCeff_S)
+        if self._expvals is not None:
+            Dr = usu_uncs * self._St_invC_d
+            K_inv_Dr = cho_solve(K_fact, Dr)
+            # S' inv(C + S D^2 S') d
+            St_invCeff_d = self._St_invC_d - DM.T @ K_inv_Dr
+            res['chisquare'] = self._d_invC_d - Dr @ K_inv_Dr
+            res['grad_chisquare'] = -2 * usu_uncs * np.square(St_invCeff_d)
+        self._result = res
+        self._key = key
+        return res
+
+    def _get(self, name, refvals, usu_uncs):
+        res = self.evaluate(refvals, usu_uncs)
+        if name not in res:
+            raise ValueError('experimental values required for the chi-square value')
+        val = res[name]
+        return val.copy() if isinstance(val, np.ndarray) else val
+
+    def logdet(self, refvals, usu_uncs=None):
+        return self._get('logdet', refvals, usu_uncs)
+
+    def grad_logdet(self, refvals, usu_uncs=None):
+        return self._get('grad_logdet', refvals, usu_uncs)
+
+    def chisquare(self, refvals, usu_uncs=None):
+        return self._get('chisquare', refvals, usu_uncs)
+
+    def grad_chisquare(self, refvals, usu_uncs=None):
+        return self._get('grad_chisquare', refvals, usu_uncs)
+
+    def loglikelihood(self, refvals, usu_uncs=None):
+        logdet_res = self.logdet(refvals, usu_uncs)
+        chisquare_res = self.chisquare(refvals, usu_uncs)
+        num_points = len(self._exp_idcs)
+        return (-0.5) * (logdet_res + chisquare_res + num_points*np.log(2*np.pi))
+
+    def grad_loglikelihood(self, refvals, usu_uncs=None):
+        grad_logdet_res = self.grad_logdet(refvals, usu_uncs)
+        grad_chisquare_res = self.grad_chisquare(refvals, usu_uncs)
+        return (-0.5) * (grad_logdet_res + grad_chisquare_res)
+
+    def loglikelihood_and_gradient(self, refvals, usu_uncs=None):
+        """Log likelihood and its gradient, e.g., for `jac=True` in scipy."""
+        return (self.loglikelihood(refvals, usu_uncs),
+                self.grad_loglikelihood(refvals, usu_uncs))
@@ -6,6 +6,11 @@ from statsmodels.tsa.stattools import acf
 from .mappings.compound_map import CompoundMap
 from .mappings.priortools import prepare_prior_and_exptable
 from .inference import lm_update
+from .selected_inversion import selected_inverse
+from .data_management.structured_covmat import (
+    StructuredCovariance,
+    select_covmat
+)
 from multiprocessing import Process, Pipe
 import time
 
@@ -108,22 +113,35 @@ def compute_effective_sample_size(arr):
     return n/(1+2*sums)
 
 
+def _factorize(covmat):
+    # structured covariance matrices are factorized blockwise
+    if isinstance(covmat, StructuredCovariance):
+        return covmat.factorize()
+    return cholesky(covmat.tocsc())
+
+
+def _whiten(fact, d):
+    if isinstance(fact, StructuredCovariance):
+        return fact.whiten(d)
+    return fact.solve_L(fact.apply_P(d), use_LDLt_decomposition=False)
+
+
 class Posterior:
 
     def __init__(self, priorvals, priorcov, mapping, expvals, expcov,
                  squeeze = True, relative_exp_errors=False):
         self.__priorvals = priorvals.reshape(-1, 1)
         adjustable = priorcov.diagonal() != 0.
-        priorcov = priorcov.tocsr()[adjustable,:].tocsc()[:,adjustable]
+        priorcov = select_covmat(priorcov, adjustable)
         self.__size = priorvals.size
         self.__adj = adjustable
         self.__adj_idcs = np.where(adjustable)[0]
         self.__nonadj = np.logical_not(adjustable)
         self.__numadj = np.sum(adjustable)
-        self.__priorfact = cholesky(priorcov)
+        self.__priorfact = _factorize(priorcov)
         self.__mapping = mapping
         self.__expvals = expvals.reshape(-1, 1)
-        self.__expfact = cholesky(expcov)
+        self.__expfact = _factorize(expcov)
         self.__relative_exp_errors = relative_exp_errors
         self.__apply_squeeze = squeeze
 
@@ -143,18 +161,15 @@ class Posterior:
         # prior contribution
         pf = self.__priorfact
         d1 = x[adj] - self.__priorvals[adj]
-        d1_perm = pf.apply_P(d1)
-        z1 = pf.solve_L(d1_perm, use_LDLt_decomposition=False)
+        z1 = _whiten(pf, d1)
         # likelihood contribution
         m = self.__mapping
         ef = self.__expfact
-        propx = np.hstack([m.propagate(x[:,i]).reshape(-1,1)
-                          for i in range(x.shape[1])])
+        propx = m.propagate_batch(x)
         d2 = self.__expvals - propx
         if self.__relative_exp_errors:
             d2 = d2 / propx * self.__expvals
-        d2_perm = ef.apply_P(d2)
-        z2 = ef.solve_L(d2_perm, use_LDLt_decomposition=False)
+        z2 = _whiten(ef, d2)
         prior_res = np.sum(np.square(z1), axis=0)
         like_res = np.sum(np.square(z2), axis=0)
         res = -0.5 * (prior_res + like_res)
@@ -185,8 +200,7 @@ class Posterior:
         ef = self.__expfact
         propx = m.propagate(x.flatten()).reshape(-1, 1)
         d2 = self.__expvals - propx
-        S = m.jacobian(x.flatten())
-        z2 = S.T @ ef(d2)
+        z2 = m.vjp(x.flatten(), ef(d2).flatten()).reshape(-1, 1)
         z2[nonadj] = 0.
         res = z1 + z2
         if self.__apply_squeeze:
@@ -213,7 +227,7 @@ class Posterior:
         del S
         return proposal
 
-    def approximate_covmat(self, xref):
+    def approximate_covmat(self, xref, selected=False):
         xref = xref.flatten()
         adj = self.__adj
         adjidcs = self.__adj_idcs
@@ -221,9 +235,13 @@ class Posterior:
         S = self.__mapping.jacobian(xref).tocsc()[:, self.__adj]
         pf = self.__priorfact
         ef = self.__expfact
-        tmp = coo_matrix(sps.linalg.inv(
-            (S.T @ ef(S.tocsc()) + pf.inv()).tocsc())
-        )
+        fact = cholesky((S.T @ ef(S.tocsc()) + pf.inv()).tocsc())
+        # if selected is True, the covariance matrix is only
+        # computed on the pattern of the Cholesky factor
+        if selected:
+            tmp = coo_matrix(selected_inverse(factor=fact))
+        else:
+            tmp = coo_matrix(fact.inv())
         postcov = csr_matrix((tmp.data, (adjidcs[tmp.row], adjidcs[tmp.col])),
                              dtype=float, shape=(size, size))
         return postcov
@@ -240,14 +258,15 @@ def gmap_mh_inference(datatable, covmat, num_samples, prop_scaling,
     exp_idcs = dt[exp_sel].index
     prior_idcs = dt[~exp_sel].index
     priorvals = dt.loc[prior_idcs, 'PRIOR'].to_numpy()
-    priorcov = covmat.tocsr()[prior_idcs,:].tocsc()[:,prior_idcs]
+    priorcov = select_covmat(covmat, prior_idcs)
     expvals = dt.loc[exp_idcs, 'DATA'].to_numpy()
-    expcov = covmat.tocsr()[exp_idcs,:].tocsc()[:,exp_idcs]
+    expcov = select_covmat(covmat, exp_idcs)
     if np.any(expcov.diagonal() <= 0):
         raise ValueError('observed data must have non-zero uncertainty')
     if startvals is None:
         print('Determine initial values for MCMC chain...')
-        mapping = CompoundMap(datatable, rtol=int_rtol, reduce=False)
+        mapping = CompoundMap(datatable, rtol=int_rtol, reduce=False,
+                              compiled=True)
         lmres = lm_update(mapping, datatable, covmat, print_status=True) 
         startvals = np.empty(len(datatable), dtype=float)
         startvals[prior_idcs] = priorvals
@@ -258,7 +277,10 @@ def gmap_mh_inference(datatable, covmat, num_samples, prop_scaling,
             raise IndexError('startvals must be of same length as datatable')
         startvals = startvals[prior_idcs]
     # intialize objects to sample and to obtain values from log posterior pdf
-    mapping = CompoundMap(datatable, rtol=int_rtol, reduce=True)
+    # the input changes in every step so that the node caches
+    # are of no use and the compiled evaluation plan is faster
+    mapping = CompoundMap(datatable, rtol=int_rtol, reduce=True,
+                          compiled=True)
     post = Posterior(priorvals, priorcov, mapping, expvals, expcov,
                      relative_exp_errors=relative_exp_errors)
     propfun = post.generate_proposal_fun(startvals, scale=prop_scaling)
@@ -0,0 +1,166 @@
+import numpy as np
+from scipy.sparse import csr_matrix, csc_matrix, coo_matrix, tril, issparse
+from sksparse.cholmod import cholesky
+
+
+def _get_filled_pattern(L):
+    # the Takahashi recurrences require the pattern of L
+    # to be closed with respect to the elimination tree.
+    # Numerical zeros dropped during the export of the factor
+    # are therefore restored by propagating the pattern of
+    # each column to its parent column. All columns are treated
+    # at once and the propagation is repeated until the pattern
+    # does not change anymore, i.e., a closed pattern is only
+    # checked by a single pass.
+    n = L.shape[0]
+    diag = L.diagonal()
+    if np.any(diag == 0):
+        raise ValueError('factor has a zero on the diagonal')
+    lower = tril(L, -1).tocoo()
+    pattern = csc_matrix((np.ones(lower.nnz, dtype=bool),
+                          (lower.row, lower.col)), shape=(n, n))
+    while True:
+        pattern.sort_indices()
+        counts = np.diff(pattern.indptr)
+        cols = np.repeat(np.arange(n), counts)
+        # the parent of a column is its first row below the diagonal
+        parent = np.full(n, n, dtype=np.int64)
+        has_rows = counts > 0
+        parent[has_rows] = pattern.indices[pattern.indptr[:-1][has_rows]]
+        sel = pattern.indices > parent[cols]
+        if not np.any(sel):
+            break
+        fill = csc_matrix((np.ones(np.sum(sel), dtype=bool),
+                           (pattern.indices[sel], parent[cols[sel]])),
+                          shape=(n, n))
+        newpattern = (pattern + fill).tocsc()
+        if newpattern.nnz == pattern.nnz:
+            break
+        pattern = newpattern
+    # the elements of L on the closed pattern including explicit zeros
+    prows, pcols = pattern.nonzero()
+    filled = coo_matrix((np.concatenate([np.zeros(len(prows)), lower.data]),
+                         (np.concatenate([prows, lower.row]),
+                          np.concatenate([pcols, lower.col]))),
+                        shape=(n, n)).tocsc()
+    filled.sum_duplicates()
+    filled.sort_indices()
+    splits = filled.indptr[1:-1]
+    rows_list = np.split(filled.indices.astype(np.int64), splits)
+    vals_list = np.split(filled.data, splits)
+    return diag, rows_list, vals_list
+
+
+def _concat_ranges(starts, lens):
+    # indices of the concatenated ranges [start, start+len)
+    offsets = np.cumsum(lens) - lens
+    return np.arange(np.sum(lens)) + np.repeat(starts - offsets, lens)
+
+
+def _takahashi_recurrences(diag, rows_list, vals_list):
+    # with A = L D L' and L having a unit diagonal,
+    # the elements of Z = inv(A) on the pattern of L satisfy
+    #   Z[J,j] = -Z[J,J] l
+    #   Z[j,j] = 1/d - l' Z[J,j]
+    # where J is the set of row indices of column j below the
+    # diagonal and l the associated elements of L
+    n = len(diag)
+    dvals = np.square(diag)
+    counts = np.array([len(r) for r in rows_list], dtype=np.int64)
+    colptr = np.concatenate([[0], np.cumsum(counts)])
+    rows = np.concatenate([np.empty(0, dtype=np.int64)] + rows_list)
+    rows = rows.astype(np.int64, copy=False)
+    lvals = np.concatenate([np.empty(0, dtype=float)] + vals_list)
+    lvals /= np.repeat(diag, counts)
+    # J only contains ancestors of j in the elimination tree, hence
+    # the columns of the same depth are processed together
+    depth = np.zeros(n, dtype=np.int64)
+    for j in range(n-1, -1, -1):
+        if counts[j] > 0:
+            depth[j] = depth[rows_list[j][0]] + 1
+    order = np.argsort(depth, kind='stable')
+    level_ptr = np.concatenate([[0], np.cumsum(np.bincount(depth))])
+    zvals = np.empty(len(rows), dtype=float)
+    zdiag = np.empty(n, dtype=float)
+    for start, stop in zip(level_ptr[:-1], level_ptr[1:]):
+        cols = order[start:stop]
+        cnts = counts[cols]
+        # the elements (j, k) with k in J of all columns j of the level
+        eidcs = _concat_ranges(colptr[cols], cnts)
+        eloc = np.repeat(np.arange(len(cols)), cnts)
+        ecols = cols[eloc]
+        erows = rows[eidcs]
+        elvals = lvals[eidcs]
+        acc = zdiag[erows] * elvals
+        # the elements Z[r,k] of the columns k in J with r in J
+        # are gathered and located by the sorted keys j*n + r
+        keys = ecols * n + erows
+        klens = counts[erows]
+        gidcs = _concat_ranges(colptr[erows], klens)
+        gown = np.repeat(np.arange(len(eidcs)), klens)
+        query = ecols[gown] * n + rows[gidcs]
+        pos = np.minimum(np.searchsorted(keys, query), len(keys)-1)
+        sel = keys[pos] == query
+        gown = gown[sel]
+        pos = pos[sel]
+        gz = zvals[gidcs[sel]]
+        acc += np.bincount(pos, weights=gz*elvals[gown], minlength=len(acc))
+        acc += np.bincount(gown, weights=gz*elvals[pos], minlength=len(acc))
+        zvals[eidcs] = -acc
+        zdiag[cols] = 1. / dvals[cols] + np.bincount(
+            eloc, weights=elvals*acc, minlength=len(cols)
+        )
+    zvals_list = [zvals[colptr[j]:colptr[j+1]] for j in range(n)]
+    return zdiag, zvals_list
+
+
+def selected_inverse(A=None, factor=None):
+    """Compute the elements of the inverse of A on the pattern of its factor.
+
+    The inverse of the symmetric positive definite matrix A
+    is only computed for the elements that correspond to the
+    nonzero elements of its Cholesky factor L and L' (in
+    the original ordering). In particular, the full diagonal
+    of the inverse is obtained. Instead of A, the CHOLMOD
+    factor of A can be provided by the `factor` argument.
+    """
+    if factor is None:
+        if A is None:
+            raise ValueError('either A or factor must be provided')
+        if not issparse(A):
+            A = csr_matrix(A)
+        factor = cholesky(A.tocsc())
+    L = factor.L().tocsc()
+    L.sort_indices()
+    n = L.shape[0]
+    diag, rows_list, vals_list = _get_filled_pattern(L)
+    zdiag, zvals_list = _takahashi_recurrences(diag, rows_list, vals_list)
+    # assemble the result in the permuted ordering
+    cols_list = [np.full(len(r), j) for j, r in enumerate(rows_list)]
+    offrows = np.concatenate([np.empty(0, dtype=int)] + rows_list)
+    offcols = np.concatenate([np.empty(0, dtype=int)] + cols_list)
+    offvals = np.concatenate([np.empty(0, dtype=float)] + zvals_list)
+    diagidcs = np.arange(n)
+    rows = np.concatenate([diagidcs, offrows, offcols])
+    cols = np.concatenate([diagidcs, offcols, offrows])
+    vals = np.concatenate([zdiag, offvals, offvals])
+    # undo the fill-reducing permutation P A P' = L L'
+    perm = factor.P()
+    return csr_matrix((vals, (perm[rows], perm[cols])), shape=(n, n))
+
+
+def is_covered_by_pattern(S, Z):
+    """Check which rows of S are fully covered by the pattern of Z.
+
+    The quadratic form s' Z s for a row s of S can only be computed
+    by a selected inverse Z if all pairs of nonzero indices of s
+    are present in the pattern of Z.
+    """
+    B = csr_matrix(S, copy=True)
+    B.eliminate_zeros()
+    B.data = np.ones(len(B.data), dtype=float)
+    P = csr_matrix(Z, copy=True)
+    P.data = np.ones(len(P.data), dtype=float)
+    counts = np.ravel((B @ P).multiply(B).sum(axis=1))
+    nnz = np.ravel(B.sum(axis=1))
+    return np.isclose(counts, np.square(nnz))
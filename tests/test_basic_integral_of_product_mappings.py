@@ -99,6 +99,44 @@ class TestBasicIntegralOfProductMapping(unittest.TestCase):
                 perm_interplist, zero_outside=True, maxord=10, rtol=1e-3)
         self.assertTrue(np.allclose(test_res1, test_res2, rtol=1e-15))
 
+    def test_exact_integral_of_product_for_equal_interps(self):
+        x1 = np.array([1, 3, 8, 14])
+        y1 = np.array([7, 2, 9, 16])
+        x2 = np.array([2, 4, 9, 20])
+        y2 = np.array([5, 8, 1.5, 4])
+        xlist = [x1, x2]
+        ylist = [y1, y2]
+        min_x = max([min(x1), min(x2)])
+        max_x = min([max(x1), max(x2)])
+        ref_x = np.unique(np.concatenate([x1, x2]))
+        ref_x = ref_x[np.logical_and(ref_x >= min_x, ref_x <= max_x)]
+        for interp in ['lin-lin', 'lin-log', 'log-lin', 'log-log']:
+            interplist = [interp, interp]
+            def propfun(x):
+                r1 = basic_propagate(x1, y1, x, interp, zero_outside=True)
+                r2 = basic_propagate(x2, y2, x, interp, zero_outside=True)
+                return r1*r2
+            ref_res = compute_romberg_integral(ref_x, propfun, maxord=20,
+                                               atol=1e-8, rtol=1e-8)
+            test_res = basic_integral_of_product_propagate(
+                xlist, ylist, interplist, zero_outside=True, exact=True
+            )
+            self.assertTrue(np.allclose(test_res, ref_res, rtol=1e-8))
+            test_sensmats = get_basic_integral_of_product_sensmats(
+                xlist, ylist, interplist, zero_outside=True, exact=True
+            )
+            for i in range(2):
+                def curfun(y):
+                    curylist = ylist.copy()
+                    curylist[i] = y
+                    return basic_integral_of_product_propagate(
+                        xlist, curylist, interplist, zero_outside=True,
+                        exact=True
+                    )
+                ref_sensmat = numeric_jacobian(curfun, ylist[i])
+                self.assertTrue(np.allclose(test_sensmats[i], ref_sensmat,
+                                            rtol=1e-8, atol=1e-10))
+
 
 class TestBasicIntegralOfProductJacobian(unittest.TestCase):
 
@@ -0,0 +1,137 @@
+import unittest
+import pathlib
+import tempfile
+import os
+from unittest.mock import patch
+import numpy as np
+from gmapy.data_management.database_IO import read_legacy_gma_database
+from gmapy.mappings.priortools import remove_dummy_datasets
+from gmapy.data_management.uncfuns import (
+    create_datablock_covmat,
+    create_experimental_covmat,
+    create_experimental_block_covmat
+)
+from gmapy.data_management import block_covmat
+from gmapy.data_management.block_covmat import get_content_hash
+from gmapy.data_management.structured_covmat import StructuredCovariance
+
+
+class TestExperimentalBlockCovmat(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        dbpath = (pathlib.Path(__file__).parent / 'testdata' /
+                'data-2017-07-26.gma').resolve().as_posix()
+        db_dic = read_legacy_gma_database(dbpath)
+        datablock_list = db_dic['datablock_list']
+        remove_dummy_datasets(datablock_list)
+        cls._datablock_list = datablock_list[:40]
+        # the correlation matrices of the last two
+        # datablocks are not positive definite
+        cls._nonpd_datablock_list = datablock_list[-2:]
+        cls._covmat = create_experimental_covmat(cls._datablock_list)
+
+    def test_block_solves_and_logdet(self):
+        blockcov = create_experimental_block_covmat(self._datablock_list)
+        covmat = self._covmat.toarray()
+        self.assertTrue(np.all(blockcov.tocsr().toarray() == covmat))
+        b = np.random.rand(covmat.shape[0])
+        self.assertTrue(np.allclose(blockcov(b), np.linalg.solve(covmat, b)))
+        self.assertTrue(np.isclose(blockcov.logdet(),
+                                   np.linalg.slogdet(covmat)[1]))
+
+    def test_parallel_build(self):
+        covmat = create_experimental_covmat(self._datablock_list,
+                                            num_workers=3)
+        self.assertTrue((covmat != self._covmat).nnz == 0)
+        # more workers than blocks
+        datablock_list = self._datablock_list[:2]
+        covmat = create_experimental_covmat(datablock_list, num_workers=5)
+        expected = create_experimental_covmat(datablock_list)
+        self.assertTrue((covmat != expected).nnz == 0)
+
+    def test_parallel_build_raises_errors_of_workers(self):
+        with self.assertRaises(ValueError):
+            create_experimental_covmat(self._datablock_list, num_workers=3,
+                                       fix_covmat='unknown')
+
+    def test_block_covmat_returned(self):
+        blockcov = create_experimental_covmat(self._datablock_list,
+                                              retblockcov=True)
+        self.assertIsInstance(blockcov, StructuredCovariance)
+        self.assertTrue(np.all(blockcov.is_factorized()))
+        self.assertTrue((blockcov.tocsr() != self._covmat).nnz == 0)
+
+    def test_blocks_factorized_on_demand(self):
+        blockcov = create_experimental_block_covmat(self._datablock_list,
+                                                    factorize=False)
+        self.assertFalse(np.any(blockcov.is_factorized()))
+        self.assertTrue((blockcov.tocsr() != self._covmat).nnz == 0)
+
+    def test_cached_blocks(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            covmat1 = create_experimental_covmat(self._datablock_list,
+                                                 cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)),
+                             len(self._datablock_list))
+            covmat2 = create_experimental_covmat(self._datablock_list,
+                                                 cache_dir=cache_dir)
+            # other options yield other blocks
+            create_experimental_covmat(self._datablock_list,
+                                       cache_dir=cache_dir, relative=True)
+            self.assertEqual(len(os.listdir(cache_dir)),
+                             2*len(self._datablock_list))
+            # blocks of another cache format are not reused
+            with patch.object(block_covmat, 'CACHE_FORMAT_VERSION',
+                              block_covmat.CACHE_FORMAT_VERSION + 1):
+                create_experimental_covmat(self._datablock_list,
+                                           cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)),
+                             3*len(self._datablock_list))
+        self.assertTrue((covmat1 != self._covmat).nnz == 0)
+        self.assertTrue((covmat2 != self._covmat).nnz == 0)
+
+    def test_fix_covmat_methods(self):
+        datablock_list = self._nonpd_datablock_list
+        for fix_covmat in (True, 'shrink', 'auto'):
+            with self.assertWarns(UserWarning) as cm:
+                blockcov = create_experimental_block_covmat(
+                    datablock_list, fix_covmat=fix_covmat
+                )
+            self.assertEqual(len(cm.warnings), len(datablock_list))
+            self.assertTrue(np.all(blockcov.is_factorized()))
+        blockcov = create_experimental_block_covmat(
+            datablock_list, fix_covmat=False
+        )
+        self.assertFalse(np.any(blockcov.is_factorized()))
+        # the nearest correlation matrix is closer than the shrunk one
+        for datablock in datablock_list:
+            _, dist_shrink = create_datablock_covmat(
+                datablock, fix_covmat='shrink', return_distance=True
+            )
+            _, dist_auto = create_datablock_covmat(
+                datablock, fix_covmat='auto', return_distance=True
+            )
+            self.assertTrue(0 < dist_auto < dist_shrink)
+
+    def test_content_hash(self):
+        datablock = self._datablock_list[0]
+        hash1 = get_content_hash(datablock)
+        reordered = dict(reversed(list(datablock.items())))
+        self.assertEqual(hash1, get_content_hash(reordered))
+        modified = dict(datablock)
+        modified['datasets'] = [dict(ds) for ds in datablock['datasets']]
+        modified['datasets'][0]['CSS'] = datablock['datasets'][0]['CSS'] * 1.01
+        self.assertNotEqual(hash1, get_content_hash(modified))
+
+    def test_missing_factors_are_computed(self):
+        blocks = [np.array([[4., 2.], [2., 3.]]), np.array([[2.]])]
+        blockcov = StructuredCovariance.from_blocks(blocks, 'exp')
+        dense = np.array([[4., 2., 0.], [2., 3., 0.], [0., 0., 2.]])
+        b = np.array([1., 2., 3.])
+        self.assertTrue(np.allclose(blockcov(b), np.linalg.solve(dense, b)))
+        self.assertEqual(blockcov.shape, (3, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
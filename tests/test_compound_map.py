@@ -38,6 +38,144 @@ class TestCompoundMap(unittest.TestCase):
         jac2 = compmap2.jacobian(x2).toarray()
         self.assertTrue(np.allclose(jac1, jac2))
 
+    def test_compiled_and_graph_evaluation_agree(self):
+        dt = self._gmadb.get_datatable()
+        x = dt['PRIOR'].to_numpy()
+        x += 1e-5
+        for reduce in (False, True):
+            if reduce:
+                x = x[~dt.NODE.str.match('exp').to_numpy()]
+            compmap1 = CompoundMap(dt, reduce=reduce, compiled=False)
+            compmap2 = CompoundMap(dt, reduce=reduce, compiled=True)
+            res1 = compmap1.propagate(x)
+            res2 = compmap2.propagate(x)
+            self.assertTrue(np.allclose(res1, res2, rtol=1e-12, atol=0))
+            jac1 = compmap1.jacobian(x)
+            jac2 = compmap2.jacobian(x)
+            self.assertTrue(np.allclose(jac1.toarray(), jac2.toarray(),
+                                        rtol=1e-12, atol=0))
+
+    def test_jacobian_refill_with_sparsity_pattern(self):
+        dt = self._gmadb.get_datatable()
+        x = dt['PRIOR'].to_numpy()
+        compmap = CompoundMap(dt)
+        pattern = compmap.jacobian_pattern()
+        for scl in (1.0, 1.1, 0.9):
+            jac1 = compmap.jacobian(x*scl)
+            jac2 = compmap.jacobian(x*scl, pattern=pattern)
+            self.assertEqual(jac2.nnz, pattern.nnz)
+            self.assertTrue(np.all((jac1 - jac2).toarray() == 0))
+        isobs = dt.NODE.str.match('exp_').to_numpy()
+        submap = pattern.get_submatrix_map(isobs, ~isobs)
+        jac1 = compmap.jacobian(x)
+        jac2 = submap.refill(compmap.jacobian(x, pattern=pattern))
+        jac1 = jac1[isobs,:][:,~isobs]
+        self.assertTrue(np.all((jac1 - jac2).toarray() == 0))
+
+    def test_node_caches_used_by_default(self):
+        dt = self._gmadb.get_datatable()
+        x = dt['PRIOR'].to_numpy()
+        compmap = CompoundMap(dt)
+        res1 = compmap.propagate(x)
+        jac1 = compmap.jacobian(x)
+        compmap.get_cache_stats(reset=True)
+        res2 = compmap.propagate(x.copy())
+        jac2 = compmap.jacobian(x.copy())
+        stats = compmap.get_cache_stats()
+        self.assertTrue(np.all(res1 == res2))
+        self.assertTrue((jac1 != jac2).nnz == 0)
+        # nothing is recomputed for unchanged input
+        self.assertEqual(stats['value_misses'], 0)
+        self.assertEqual(stats['jacobian_misses'], 0)
+        self.assertTrue(stats['value_hits'] > 0)
+        self.assertTrue(stats['jacobian_hits'] > 0)
+        # a changed input only leads to the recomputation
+        # of the nodes depending on it
+        x[0] *= 1.1
+        compmap.propagate(x)
+        stats = compmap.get_cache_stats()
+        self.assertTrue(0 < stats['value_misses'] < stats['value_hits'])
+        # batched evaluations use the compiled plan
+        compmap.get_cache_stats(reset=True)
+        res3 = compmap.propagate_batch(np.column_stack([x, x]))
+        stats = compmap.get_cache_stats()
+        self.assertEqual(stats['value_hits'] + stats['value_misses'], 0)
+        self.assertTrue(np.allclose(res3[:, 0], compmap.propagate(x),
+                                    rtol=1e-12, atol=0))
+
+    def test_refill_reuses_the_data_array(self):
+        dt = self._gmadb.get_datatable()
+        x = dt['PRIOR'].to_numpy()
+        compmap = CompoundMap(dt)
+        pattern = compmap.jacobian_pattern()
+        isobs = dt.NODE.str.match('exp_').to_numpy()
+        submap = pattern.get_submatrix_map(isobs, ~isobs)
+        jac1 = compmap.jacobian(x, pattern=pattern)
+        data = jac1.data
+        subjac1 = submap.refill(jac1)
+        subvals1 = subjac1.toarray()
+        # the values are written into the same matrix
+        jac2 = compmap.jacobian(x*1.1, pattern=pattern)
+        self.assertIs(jac2, jac1)
+        self.assertIs(jac2.data, data)
+        self.assertTrue((jac2 != compmap.jacobian(x*1.1)).nnz == 0)
+        # but the extracted submatrices remain valid
+        subjac2 = submap.refill(jac2)
+        self.assertTrue(np.all(subjac1.toarray() == subvals1))
+        self.assertFalse(np.all(subjac2.toarray() == subvals1))
+        # a pattern of another mapping is refilled from the matrix
+        other = CompoundMap(dt)
+        jac3 = other.jacobian(x*0.9, pattern=pattern)
+        self.assertIs(jac3, jac1)
+        self.assertTrue((jac3 != other.jacobian(x*0.9)).nnz == 0)
+
+    def test_cached_graph_respects_datatable_changes(self):
+        dt = self._gmadb.get_datatable()
+        x = dt['PRIOR'].to_numpy()
+        compmap = CompoundMap(dt)
+        res1 = compmap.propagate(x, dt)
+        dt2 = dt.copy()
+        isexp = dt2.NODE.str.match('exp_').to_numpy()
+        idx = dt2.index[isexp][0]
+        dt2.loc[idx, 'ENERGY'] *= 1.01
+        res2 = compmap.propagate(x, dt2)
+        res3 = CompoundMap(dt2).propagate(x)
+        self.assertTrue(np.all(res2 == res3))
+        res4 = compmap.propagate(x, dt)
+        self.assertTrue(np.all(res1 == res4))
+
+    def test_batched_propagate_and_jacobian_vector_products(self):
+        dt = self._gmadb.get_datatable()
+        x = dt['PRIOR'].to_numpy()
+        np.random.seed(31)
+        refvals = x.reshape(-1, 1) * np.random.uniform(0.9, 1.1, (len(x), 3))
+        vecs = np.random.normal(size=refvals.shape)
+        compmap = CompoundMap(dt)
+        res = compmap.propagate_batch(refvals)
+        prods = compmap.jvp_batch(refvals, vecs)
+        for i in range(refvals.shape[1]):
+            res_ref = compmap.propagate(refvals[:, i])
+            prod_ref = compmap.jacobian(refvals[:, i]) @ vecs[:, i]
+            self.assertTrue(np.allclose(res[:, i], res_ref,
+                                        rtol=1e-12, atol=0))
+            self.assertTrue(np.allclose(prods[:, i], prod_ref,
+                                        rtol=1e-10, atol=1e-12))
+
+    def test_matrix_free_jacobian_products(self):
+        dt = self._gmadb.get_datatable()
+        x = dt['PRIOR'].to_numpy()
+        np.random.seed(37)
+        vec = np.random.normal(size=len(x))
+        for compiled in (True, False):
+            compmap = CompoundMap(dt, compiled=compiled)
+            S = compmap.jacobian(x)
+            jvp_res = compmap.jvp(x, vec)
+            vjp_res = compmap.vjp(x, vec)
+            self.assertTrue(np.allclose(jvp_res, S @ vec,
+                                        rtol=1e-10, atol=1e-12))
+            self.assertTrue(np.allclose(vjp_res, S.T @ vec,
+                                        rtol=1e-10, atol=1e-12))
+
 
 if __name__ == '__main__':
     unittest.main()
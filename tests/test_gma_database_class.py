@@ -2,6 +2,7 @@ import unittest
 import pathlib
 import pandas as pd
 from gmapy.gma_database_class import GMADatabase
+from gmapy.inference import leave_one_out_update
 import numpy as np
 from copy import deepcopy
 from scipy.sparse import csr_matrix
@@ -199,6 +200,70 @@ class TestGMADatabase(unittest.TestCase):
 
 
 
+    def test_incremental_addition_of_data(self):
+        gmadb1 = deepcopy(self._gmadb)
+        tbl = gmadb1.get_datatable()
+        covmat = gmadb1.get_covmat()
+        add_idcs = tbl.index[tbl.NODE.str.fullmatch('exp_8030')]
+        keep_idcs = np.full(len(tbl), True)
+        keep_idcs[add_idcs] = False
+        gmadb2 = deepcopy(self._gmadb)
+        gmadb2.remove_data(add_idcs)
+        gmadb2.evaluate()
+        newtbl = tbl.loc[add_idcs].reset_index(drop=True)
+        newcov = covmat[add_idcs,:][:,add_idcs]
+        gmadb2.add_data(newtbl, newcov, incremental=True, polish_iters=3)
+        gmadb1.evaluate()
+        res1 = gmadb1.get_datatable()
+        res1 = pd.concat([res1[keep_idcs], res1.loc[add_idcs]])
+        res2 = gmadb2.get_datatable()
+        self.assertTrue(np.allclose(res1.POST, res2.POST, rtol=1e-5))
+        self.assertTrue(np.allclose(res1.POSTUNC, res2.POSTUNC, rtol=1e-4))
+
+    def test_leave_one_out_cross_validation(self):
+        gmadb1 = deepcopy(self._gmadb)
+        gmadb1.evaluate()
+        cvres = gmadb1.cross_validate()
+        tbl = gmadb1.get_datatable()
+        remove_idcs = tbl.index[tbl.NODE.str.fullmatch('exp_8030')]
+        gmadb2 = deepcopy(self._gmadb)
+        gmadb2.evaluate(remove_idcs=remove_idcs)
+        loopreds = gmadb1.get_datatable().loc[remove_idcs, 'LOOPRED']
+        postvals = gmadb2.get_datatable().loc[remove_idcs, 'POST']
+        self.assertTrue(np.allclose(loopreds, postvals, rtol=1e-3))
+        self.assertTrue(np.all(cvres.NODE.str.match('exp_')))
+        self.assertEqual(cvres.NUM.sum(), len(gmadb1.get_exp_idcs()))
+        cvres2 = gmadb1.cross_validate(num_workers=2)
+        self.assertTrue(np.allclose(cvres.CHISQR, cvres2.CHISQR,
+                                    equal_nan=True))
+
+    def test_leave_one_out_raises_errors_of_workers(self):
+        gmadb = deepcopy(self._gmadb)
+        gmadb.evaluate()
+        cache = gmadb._cache
+        dt = gmadb.get_datatable()
+        expdt = dt.loc[dt.NODE.str.match('exp_', na=False)]
+        group_idcs_list = [np.array(idcs) for idcs
+                           in expdt.groupby('NODE').groups.values()]
+        # the inverse posterior covariance matrix is too small
+        invcovmat = cache['upd_invcov'][:-1,:-1]
+        with self.assertRaises(IndexError):
+            leave_one_out_update(
+                gmadb._mapping, dt, gmadb.get_covmat(), cache['upd_vals'],
+                cache['adj_idcs'], invcovmat, group_idcs_list, num_workers=2
+            )
+
+    def test_mapping_uses_compiled_plan(self):
+        mapping = self._gmadb.get_mapping()
+        dt = self._gmadb.get_datatable()
+        x = dt['PRIOR'].to_numpy()
+        mapping.get_cache_stats(reset=True)
+        mapping.propagate(x, dt)
+        mapping.jacobian(x, dt)
+        stats = mapping.get_cache_stats()
+        self.assertEqual(sum(stats.values()), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
 
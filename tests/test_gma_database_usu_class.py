@@ -187,6 +187,77 @@ class TestGMADatabaseUSU(unittest.TestCase):
         red_res1 = res1[optim_idcs]
         self.assertTrue(np.allclose(red_res1, res2))
 
+    def test_likelihood_evaluator_with_varying_usu_uncertainties(self):
+        gmadb = deepcopy(self._gmadb)
+        gmadb.set_usu_components(['REAC'])
+        datatable = gmadb.get_datatable()
+        covmat = gmadb.get_covmat()
+        mapping = gmadb.get_mapping()
+        refvals = datatable['PRIOR'].to_numpy()
+        expvals = datatable.DATA.to_numpy()
+        usu_idcs = datatable.index[datatable.NODE.str.match('usu_')]
+        evaluator = mapping.likelihood_evaluator(datatable, covmat, expvals)
+        for usu_uncs in (np.linspace(0.01, 0.2, num=len(usu_idcs)),
+                         np.linspace(0., 0.05, num=len(usu_idcs))):
+            res1, grad1 = evaluator.loglikelihood_and_gradient(refvals, usu_uncs)
+            covmat[usu_idcs, usu_idcs] = np.square(usu_uncs)
+            res2 = mapping.loglikelihood(datatable, refvals, expvals, covmat)
+            grad2 = mapping.grad_loglikelihood(datatable, refvals, expvals, covmat)
+            self.assertTrue(np.isclose(res1, res2))
+            self.assertTrue(np.allclose(grad1, grad2))
+
+    def test_likelihood_evaluator_rejects_correlated_usu_errors(self):
+        gmadb = deepcopy(self._gmadb)
+        gmadb.set_usu_components(['REAC'])
+        datatable = gmadb.get_datatable()
+        mapping = gmadb.get_mapping()
+        usu_idcs = datatable.index[datatable.NODE.str.match('usu_')]
+        exp_idcs = datatable.index[datatable.NODE.str.match('exp_')]
+        for idx in (usu_idcs[1], exp_idcs[0]):
+            covmat = gmadb.get_covmat().tolil()
+            covmat[usu_idcs[0], idx] = 1e-4
+            covmat[idx, usu_idcs[0]] = 1e-4
+            with self.assertRaises(ValueError):
+                mapping.likelihood_evaluator(datatable, covmat.tocsr())
+
+    def test_ml_estimation_of_usu_uncertainties(self):
+        gmadb = deepcopy(self._gmadb)
+        gmadb.set_usu_components(['REAC'])
+        dt = gmadb.get_datatable()
+        is_usu = dt.NODE.str.match('usu_', na=False)
+        dt['usu_coupling'] = np.where(is_usu, 'all', None)
+        gmadb.set_datatable(dt)
+        gmadb.set_usu_couplings('usu_coupling')
+        gmadb.determine_usu_uncertainties(method='ml')
+        dt = gmadb.get_datatable()
+        usu_uncs = dt.UNC[is_usu].to_numpy()
+        self.assertTrue(np.all(usu_uncs == usu_uncs[0]))
+        self.assertTrue(usu_uncs[0] > 0.)
+        # the derivative with respect to the common uncertainty vanishes
+        mapping = gmadb.get_mapping()
+        evaluator = mapping.likelihood_evaluator(
+            dt, gmadb.get_covmat(), dt.DATA.to_numpy()
+        )
+        grad = evaluator.grad_loglikelihood(dt.PRIOR.to_numpy())
+        dgrad = evaluator.grad_loglikelihood(dt.PRIOR.to_numpy(), usu_uncs*1.1)
+        self.assertTrue(np.abs(np.sum(grad)) < 1e-3 * np.abs(np.sum(dgrad)))
+
+    def test_ml_estimation_starting_from_zero_uncertainties(self):
+        gmadb = deepcopy(self._gmadb)
+        gmadb.set_usu_components(['REAC'])
+        dt = gmadb.get_datatable()
+        is_usu = dt.NODE.str.match('usu_', na=False)
+        dt['usu_coupling'] = np.where(is_usu, 'all', None)
+        dt.loc[is_usu, 'UNC'] = 0.
+        gmadb.set_datatable(dt)
+        gmadb.set_usu_couplings('usu_coupling')
+        # zero uncertainties are a stationary point of the likelihood
+        # but must not be the result of the optimization
+        gmadb.determine_usu_uncertainties(method='ml')
+        usu_uncs = gmadb.get_datatable().UNC[is_usu].to_numpy()
+        self.assertTrue(np.all(usu_uncs == usu_uncs[0]))
+        self.assertTrue(usu_uncs[0] > 0.)
+
     def test_evaluation_with_usu_converges(self):
         gmadb = deepcopy(self._gmadb)
         dt = gmadb.get_datatable()
@@ -209,6 +280,24 @@ class TestGMADatabaseUSU(unittest.TestCase):
         gmadb.evaluate(print_status=True, adjust_usu=True, rtol=1e-6, atol=1e-6)
         self.assertTrue(gmadb._cache['converged'])
 
+    def test_evaluation_with_marginalized_usu_errors(self):
+        gmadb1 = deepcopy(self._gmadb)
+        gmadb1.set_usu_components(['REAC'])
+        gmadb2 = deepcopy(gmadb1)
+        gmadb1.evaluate(adjust_usu=False, rtol=1e-6, atol=1e-6)
+        gmadb2.evaluate(adjust_usu=False, rtol=1e-6, atol=1e-6,
+                        marginalize_errors=True)
+        self.assertTrue(gmadb2._cache['converged'])
+        dt1 = gmadb1.get_datatable()
+        dt2 = gmadb2.get_datatable()
+        # the USU errors are small, hence integrating them out
+        # and adjusting them yields almost the same estimates
+        isxs = dt1.NODE.str.match('xsid_').to_numpy()
+        isusu = dt1.NODE.str.match('usu_').to_numpy()
+        self.assertTrue(np.allclose(dt1.POST[isxs], dt2.POST[isxs], rtol=1e-3))
+        self.assertTrue(np.allclose(dt1.POST[isusu], dt2.POST[isusu],
+                                    rtol=1e-2, atol=1e-4))
+
     # NOTE: At present this test is at present not really related
     # to the GMADatabaseUSU class but is here for convenience
     # of a programmer that does not want to move a small
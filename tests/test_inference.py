@@ -14,7 +14,7 @@ from gmapy.mappings.priortools import (
     attach_shape_prior,
     initialize_shape_prior
 )
-from gmapy.inference import gls_update
+from gmapy.inference import gls_update, PosteriorCovmatQuery
 from gmapy.mappings.compound_map import CompoundMap
 
 
@@ -103,5 +103,39 @@ class TestInference(unittest.TestCase):
         self.assertTrue(upd_covmat_same)
 
 
+    def test_posterior_covmat_query(self):
+        datatable = self._datatable.copy()
+        datablocklist = self._datablocklist
+        compmap = CompoundMap(legacy_integration=True)
+        uncs = datatable['UNC'].to_numpy()
+        expsel = datatable['NODE'].str.match('exp_').to_numpy()
+        expdata = datatable['DATA'].to_numpy()
+        exp_idcs = datatable.index[expsel].to_numpy()
+        tmp = coo_matrix(create_experimental_covmat(datablocklist, expdata[expsel]))
+        covmat = csr_matrix((tmp.data, (exp_idcs[tmp.row], exp_idcs[tmp.col])),
+                            shape=(len(datatable), len(datatable)), dtype=float)
+        nonexp_idcs = datatable.index[np.logical_not(expsel)]
+        covmat += csr_matrix((uncs[nonexp_idcs], (nonexp_idcs, nonexp_idcs)),
+                             shape=(len(datatable), len(datatable)), dtype=float)
+        upd_res = gls_update(compmap, datatable, covmat, retcov=True)
+        query = PosteriorCovmatQuery(compmap, upd_res['upd_vals'],
+                                     upd_res['upd_invcov'], upd_res['idcs'],
+                                     block_size=50)
+        # reference calculation with the full posterior covariance matrix
+        refvals = datatable['PRIOR'].to_numpy().copy()
+        refvals[upd_res['idcs']] = upd_res['upd_vals']
+        S = compmap.jacobian(refvals, datatable)[exp_idcs,:]
+        S = S[:, upd_res['idcs']].toarray()
+        ref_postcov = S @ upd_res['upd_covmat'] @ S.T
+        postcov = query.compute(datatable, idcs=exp_idcs).toarray()
+        self.assertTrue(np.allclose(postcov, ref_postcov))
+        postuncs = query.compute(datatable, idcs=exp_idcs, unc_only=True)
+        self.assertTrue(np.allclose(postuncs, np.sqrt(np.diag(ref_postcov))))
+        idcs_list = [exp_idcs[:10], exp_idcs[10:25]]
+        res = query.compute_batch(datatable, idcs_list, unc_only=True)
+        self.assertTrue(np.allclose(res[0], postuncs[:10]))
+        self.assertTrue(np.allclose(res[1], postuncs[10:25]))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,134 @@
+import unittest
+import os
+import pathlib
+import time
+import io
+import contextlib
+import warnings
+import numpy as np
+from gmapy.data_management.database_IO import read_legacy_gma_database
+from gmapy.data_management.specialized_uncertainty_funs.legacy_uncertainty_funs import (
+    create_dataset_relunc_vector,
+    create_relative_dataset_covmat
+)
+from gmapy.mappings.priortools import SHAPE_MT_IDS
+
+
+def create_relative_dataset_covmat_loop(dataset):
+    # reference implementation with the loops of Fortran GMAP
+    numpts = len(dataset['CSS'])
+    uncs = create_dataset_relunc_vector(dataset)
+    MT = dataset['MT']
+    EPAF = np.array(dataset['EPAF'])
+    E = np.array(dataset['E'])
+    CO = np.array(dataset['CO'])
+    ENFF = np.array(dataset['ENFF']) if 'ENFF' in dataset else None
+    if dataset['NNCOX'] != 0:
+        CO /= 10
+    covmat = np.zeros((numpts, numpts), dtype=float)
+    problematic_datasets = {}
+    for KS in range(numpts):
+        for KT in range(KS):
+            Q1 = 0.
+            for L in range(2,11):
+                if dataset['NETG'][L] not in (0,9):
+                    FKS = EPAF[0,L] + EPAF[1,L]
+                    if EPAF[2,L] == 0.:
+                        if dataset['NS'] not in problematic_datasets:
+                            print(f'Warning: EPAF[2,{L}] is zero for dataset {dataset["NS"]} '
+                                  f'(MT: {dataset["MT"]}, {dataset.get("BREF","").strip()}, '
+                                  f'{dataset.get("CLABL").strip()}). '
+                                   'You may want to check the uncertainty specifications '
+                                   'of this datasset.')
+                            problematic_datasets[dataset['NS']] = True
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        XYY = EPAF[1,L] - (E[KS]-E[KT])/(EPAF[2,L]*E[KS])
+                    XYY = max(XYY, 0.)
+                    FKT = EPAF[0,L] + XYY
+                    Q1 += CO[KS,L]*CO[KT,L]*FKS*FKT
+            XNORU = 0.
+            if MT not in SHAPE_MT_IDS:
+                XNORU = np.sum(np.square(ENFF))
+            CERR = Q1 + XNORU
+            if CERR / (uncs[KS] * uncs[KT]) > 0.99:
+                CERR = 0.99 * uncs[KS] * uncs[KT]
+            covmat[KS, KT] = CERR
+            covmat[KT, KS] = CERR
+        covmat[KS, KS] = uncs[KS]*uncs[KS]
+    return covmat
+
+
+class TestLegacyUncertaintyFunctions(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        dbpath = (pathlib.Path(__file__).parent / 'testdata' /
+                'data-2017-07-26.gma').resolve().as_posix()
+        db_dic = read_legacy_gma_database(dbpath)
+        datasets = []
+        for datablock in db_dic['datablock_list']:
+            if 'ECOR' in datablock:
+                continue
+            datasets.extend(datablock['datasets'])
+        cls._datasets = datasets
+
+    def test_vectorized_dataset_covmat_equals_loop_version(self):
+        for dataset in self._datasets:
+            out_loop = io.StringIO()
+            out_vec = io.StringIO()
+            with contextlib.redirect_stdout(out_loop):
+                covmat1 = create_relative_dataset_covmat_loop(dataset)
+            with contextlib.redirect_stdout(out_vec):
+                covmat2 = create_relative_dataset_covmat(dataset)
+            # the results must be identical bit for bit
+            self.assertTrue(np.array_equal(covmat1, covmat2, equal_nan=True))
+            self.assertEqual(out_loop.getvalue(), out_vec.getvalue())
+
+    def test_relunc_vector_independent_of_memory_layout(self):
+        for dataset in self._datasets:
+            copied = dict(dataset)
+            copied['CO'] = np.ascontiguousarray(dataset['CO'])
+            uncs1 = create_dataset_relunc_vector(dataset)
+            uncs2 = create_dataset_relunc_vector(copied)
+            self.assertTrue(np.array_equal(uncs1, uncs2))
+
+    # timings are unreliable on loaded machines, hence this
+    # comparison only runs if GMAPY_BENCHMARKS is set
+    @unittest.skipUnless(os.environ.get('GMAPY_BENCHMARKS'),
+                         'benchmarks are disabled')
+    def test_vectorized_dataset_covmat_is_faster(self):
+        time_loop = 0.
+        time_vec = 0.
+        with contextlib.redirect_stdout(io.StringIO()):
+            for dataset in self._datasets:
+                start_time = time.perf_counter()
+                create_relative_dataset_covmat_loop(dataset)
+                time_loop += time.perf_counter() - start_time
+                start_time = time.perf_counter()
+                create_relative_dataset_covmat(dataset)
+                time_vec += time.perf_counter() - start_time
+        self.assertTrue(time_vec < time_loop)
+
+    def test_warning_for_zero_epaf(self):
+        dataset = max(self._datasets, key=lambda ds: len(ds['CSS']))
+        dataset = dict(dataset)
+        active_L = [L for L in range(2, 11)
+                    if dataset['NETG'][L] not in (0,9)]
+        if len(active_L) == 0:
+            self.skipTest('no active uncertainty component')
+        dataset['EPAF'] = np.array(dataset['EPAF'], dtype=float)
+        dataset['EPAF'][2, active_L[-1]] = 0.
+        out = io.StringIO()
+        # the division by zero must not lead to numpy warnings
+        with contextlib.redirect_stdout(out), warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            create_relative_dataset_covmat(dataset)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith(
+            f'Warning: EPAF[2,{active_L[-1]}] is zero for dataset'
+        ))
+
+
+if __name__ == '__main__':
+    unittest.main()
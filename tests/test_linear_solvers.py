@@ -0,0 +1,196 @@
+import unittest
+import numpy as np
+from scipy.sparse import (csc_matrix, random as sprandom, identity,
+        block_diag, diags)
+from gmapy.linear_solvers import (CholeskySolver, LinearSolver,
+        choose_solver_backend, conjugate_gradients, SchurComplementSolver,
+        WoodburySolver, ScaledSolver, DiagonalUpdateSolver)
+
+
+class TestLinearSolvers(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        np.random.seed(17)
+        dim = 60
+        X = sprandom(dim, dim, density=0.05, random_state=17)
+        A = X @ X.T + identity(dim)
+        cls._A = csc_matrix(A)
+        cls._dim = dim
+
+    def test_cholesky_solver_solution(self):
+        A = self._A
+        b = np.random.rand(self._dim)
+        solver = CholeskySolver(A)
+        x = solver(b)
+        self.assertTrue(np.allclose(A @ x, b))
+
+    def test_cholesky_solver_with_damping(self):
+        A = self._A
+        b = np.random.rand(self._dim)
+        lmb = 0.7
+        solver = CholeskySolver(A, beta=lmb)
+        x = solver(b)
+        self.assertTrue(np.allclose(A @ x + lmb * x, b))
+
+    def test_cholesky_solver_reuses_symbolic_analysis(self):
+        A = self._A
+        b = np.random.rand(self._dim)
+        solver = CholeskySolver()
+        for scl in (1., 2., 5.):
+            solver.factorize(A * scl)
+            x = solver(b)
+            self.assertTrue(np.allclose(scl * (A @ x), b))
+        newfact = solver.new_factor(A * 3.)
+        self.assertTrue(np.allclose(3. * (A @ newfact(b)), b))
+        # the factor of the solver must not be affected
+        self.assertTrue(np.allclose(5. * (A @ solver(b)), b))
+        self.assertEqual(solver.num_analyze, 1)
+        self.assertEqual(solver.num_factorize, 4)
+
+    def test_cholesky_solver_reanalyzes_if_pattern_changes(self):
+        A = self._A
+        solver = CholeskySolver(A)
+        B = A + csc_matrix(np.full(A.shape, 1e-3))
+        b = np.random.rand(self._dim)
+        solver.factorize(B)
+        self.assertTrue(np.allclose(B @ solver(b), b))
+        self.assertEqual(solver.num_analyze, 2)
+
+    def test_all_backends_yield_same_solution(self):
+        A = self._A
+        b = np.random.rand(self._dim)
+        B = csc_matrix(np.random.rand(self._dim, 3))
+        ref_x = np.linalg.solve(A.toarray(), b)
+        ref_X = np.linalg.solve(A.toarray(), B.toarray())
+        ref_logdet = np.linalg.slogdet(A.toarray())[1]
+        for backend in ('cholmod', 'superlu', 'dense'):
+            solver = LinearSolver(A, backend=backend)
+            self.assertEqual(solver.get_backend(), backend)
+            self.assertTrue(np.allclose(solver(b), ref_x))
+            X = solver(B)
+            self.assertTrue(np.allclose(X.toarray(), ref_X))
+            self.assertTrue(np.isclose(solver.logdet(), ref_logdet))
+            invA = solver.inv().toarray()
+            self.assertTrue(np.allclose(invA @ A.toarray(), np.identity(self._dim)))
+
+    def test_backend_selection(self):
+        self.assertEqual(choose_solver_backend(self._A), 'dense')
+        X = sprandom(1000, 1000, density=0.001, random_state=3)
+        self.assertEqual(choose_solver_backend(X @ X.T), 'cholmod')
+        with self.assertRaises(ValueError):
+            LinearSolver(self._A, backend='unknown')
+
+    def test_fallback_for_indefinite_matrix(self):
+        A = self._A.toarray()
+        A[0,0] = -1.
+        b = np.random.rand(self._dim)
+        with self.assertWarns(UserWarning):
+            solver = LinearSolver(A)
+        self.assertEqual(solver.get_backend(), 'superlu')
+        self.assertTrue(np.allclose(A @ solver(b), b))
+        # the log determinant is only defined for positive definite matrices
+        with self.assertRaises(ValueError):
+            solver.logdet()
+        solver.factorize(self._A)
+        self.assertEqual(solver.get_backend(), 'dense')
+        self.assertTrue(np.isclose(solver.logdet(),
+                                   np.linalg.slogdet(self._A.toarray())[1]))
+        with self.assertRaises(Exception):
+            LinearSolver(A, backend='dense')
+
+
+    def test_rank_update_and_downdate(self):
+        A = self._A
+        C = csc_matrix(np.random.rand(self._dim, 3))
+        b = np.random.rand(self._dim)
+        ApCCt = (A + C @ C.T).toarray()
+        for backend in ('cholmod', 'superlu', 'dense'):
+            solver = LinearSolver(A, backend=backend)
+            solver.update(C)
+            self.assertTrue(np.allclose(ApCCt @ solver(b), b))
+            solver.update(C, subtract=True)
+            self.assertTrue(np.allclose(A @ solver(b), b))
+
+    def test_preconditioned_conjugate_gradients(self):
+        A = self._A
+        b = np.random.rand(self._dim)
+        invdiag = 1. / A.diagonal()
+        x, num_iter = conjugate_gradients(
+            lambda v: A @ v, b, precond=lambda r: invdiag * r, rtol=1e-12
+        )
+        self.assertTrue(np.allclose(A @ x, b, rtol=1e-10, atol=1e-10))
+        self.assertTrue(num_iter <= self._dim)
+        x0 = x + 1e-3 * np.random.rand(self._dim)
+        x, _ = conjugate_gradients(lambda v: A @ v, b, x0=x0, rtol=1e-12)
+        self.assertTrue(np.allclose(A @ x, b, rtol=1e-10, atol=1e-10))
+
+    def test_schur_complement_solver(self):
+        A = self._A
+        b = np.random.rand(self._dim)
+        eliminate = np.arange(self._dim) % 6 == 0
+        refinv = np.linalg.inv(A.toarray() + 0.3*np.identity(self._dim))
+        for backend in ('cholmod', 'superlu', 'dense'):
+            solver = SchurComplementSolver(eliminate, A, beta=0.3,
+                                           backend=backend)
+            self.assertTrue(np.allclose(solver(b), refinv @ b))
+            self.assertTrue(np.allclose(solver.inv().toarray(), refinv))
+            self.assertTrue(np.allclose(solver.selected_inv().diagonal(),
+                                        refinv.diagonal()))
+            self.assertTrue(np.isclose(solver.logdet(),
+                                       -np.linalg.slogdet(refinv)[1]))
+
+    def test_woodbury_solver(self):
+        A = self._A
+        U = sprandom(self._dim, 4, density=0.3, format='csc')
+        B = csc_matrix(np.diag(np.random.rand(4) + 0.5))
+        refmat = (A + U @ B @ U.T).toarray()
+        b = np.random.rand(self._dim)
+        rhs = sprandom(self._dim, 3, density=0.2, format='csc')
+        for backend in ('cholmod', 'superlu', 'dense'):
+            solver = WoodburySolver(LinearSolver(A, backend=backend), U,
+                                    LinearSolver(B, backend=backend))
+            self.assertTrue(np.allclose(solver(b),
+                                        np.linalg.solve(refmat, b)))
+            self.assertTrue(np.allclose(solver(rhs).toarray(),
+                                        np.linalg.solve(refmat, rhs.toarray())))
+            self.assertTrue(np.isclose(solver.logdet(),
+                                       np.linalg.slogdet(refmat)[1]))
+
+    def test_scaled_solver(self):
+        A = self._A
+        scale = np.random.rand(self._dim) + 0.5
+        scale[::7] *= -1
+        refmat = A.toarray() * scale.reshape(-1, 1) * scale.reshape(1, -1)
+        b = np.random.rand(self._dim)
+        rhs = sprandom(self._dim, 3, density=0.2, format='csc')
+        solver = ScaledSolver(CholeskySolver(A), scale)
+        self.assertTrue(np.allclose(solver(b), np.linalg.solve(refmat, b)))
+        self.assertTrue(np.allclose(solver(rhs).toarray(),
+                                    np.linalg.solve(refmat, rhs.toarray())))
+        self.assertTrue(np.allclose(solver.inv().toarray(),
+                                    np.linalg.inv(refmat)))
+        self.assertTrue(np.isclose(solver.logdet(),
+                                   np.linalg.slogdet(refmat)[1]))
+
+    def test_diagonal_update_solver(self):
+        P = block_diag([self._A, diags([2., 3., 0.5])], format='csc')
+        dim = P.shape[0]
+        diag = np.random.rand(dim)
+        diag[::5] = 0.
+        refmat = np.linalg.inv(P.toarray()) + np.diag(diag)
+        b = np.random.rand(dim)
+        B = np.random.rand(dim, 3)
+        solver = DiagonalUpdateSolver(P, diag)
+        self.assertTrue(np.allclose(solver(b), np.linalg.solve(refmat, b)))
+        self.assertTrue(np.allclose(solver(B), np.linalg.solve(refmat, B)))
+        # infinite prior variances
+        P = diags([np.inf, np.inf, 2.])
+        solver = DiagonalUpdateSolver(P, [4., 0., 1.])
+        self.assertTrue(np.allclose(solver(np.ones(3)), [0.25, 1., 2/3]))
+        with self.assertRaises(ValueError):
+            DiagonalUpdateSolver(P, [-1., 0., 1.])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -134,6 +134,38 @@ class TestLevenbergMarquardtUpdate(unittest.TestCase):
         self.assertTrue(np.all(np.isclose(res1['upd_vals'], res2['upd_vals'],
             atol=1e-8, rtol=1e-8)))
 
+    def test_elimination_of_normalization_factors(self):
+        datatable = self._datatable
+        totcov = self._totcov
+        compmap = CompoundMap()
+        res1 = gls_update(compmap, datatable, totcov, retcov=True)
+        res2 = gls_update(compmap, datatable, totcov, retcov=True,
+                          eliminate_norm=True)
+        self.assertTrue(np.allclose(res1['upd_vals'], res2['upd_vals'],
+                                    atol=1e-8, rtol=1e-8))
+        self.assertTrue(np.allclose(res1['upd_covmat'], res2['upd_covmat'],
+                                    atol=1e-12, rtol=1e-8))
+        res3 = lm_update(compmap, datatable, totcov, retcov=False,
+                lmb=1e-8, maxiter=20, must_converge=True)
+        res4 = lm_update(compmap, datatable, totcov, retcov=False,
+                lmb=1e-8, maxiter=20, must_converge=True,
+                eliminate_norm=True)
+        self.assertTrue(np.allclose(res3['upd_vals'], res4['upd_vals'],
+                                    atol=1e-8, rtol=1e-8))
+
+    def test_lm_with_pcg_inner_solver(self):
+        datatable = self._datatable
+        totcov = self._totcov
+        compmap = CompoundMap()
+        res1 = lm_update(compmap, datatable, totcov, retcov=False,
+                lmb=1e-8, maxiter=20, print_status=True, must_converge=True)
+        res2 = lm_update(compmap, datatable, totcov, retcov=False,
+                lmb=1e-8, maxiter=20, print_status=True, must_converge=True,
+                inner_solver='pcg')
+        self.assertTrue(res2['num_pcg_iter'] > 0)
+        self.assertTrue(np.all(np.isclose(res1['upd_vals'], res2['upd_vals'],
+            atol=1e-6, rtol=1e-5)))
+
     def test_lm_prior_influence(self):
         datatable = self._datatable
         totcov = self._totcov
@@ -3,6 +3,7 @@ import numpy as np
 from gmapy.mappings.helperfuns import numeric_jacobian
 from gmapy.mappings.mapping_elements import (
     InputSelector,
+    InputSelectorCollection,
     LinearInterpolation,
     Integral,
     IntegralOfProduct,
@@ -85,6 +86,57 @@ class TestMappingElements(unittest.TestCase):
             np.array([5.5, 7.0, 8.5])
         )
 
+    def test_shared_linear_interpolation(self):
+        inpvec = np.array([1, 2, 3, 4, 5, 6])
+        selcol = InputSelectorCollection()
+        x = selcol.define_selector([0, 1, 2], 6)
+        y = selcol.define_selector([3, 4, 5], 6)
+        self.assertIs(selcol.define_selector(np.array([0, 1, 2]), 6), x)
+        z1 = selcol.define_interpolation(x, [1, 2, 3], [1.5, 2, 2.5])
+        z2 = selcol.define_interpolation(x, [1, 2, 3], [1.5, 2, 2.5])
+        z3 = selcol.define_interpolation(y, [1, 2, 3], [1.5, 2, 2.5])
+        self.assertIs(z1, z2)
+        self.assertIsNot(z1, z3)
+        self.assertIs(z1.get_interpolation_matrix(),
+                      z3.get_interpolation_matrix())
+        self.assert_equal(
+            self.eval_expr(inpvec, z3, y),
+            np.array([4.5, 5.0, 5.5])
+        )
+
+    def test_cached_values_and_jacobians(self):
+        inpvec = np.array([1., 2., 3., 4., 5., 6.])
+        x = InputSelector([0, 1, 2], 6)
+        y = InputSelector([3, 4, 5], 6)
+        z = x * y
+        intz = Integral(z, [1, 2, 3], 'lin-log', maxord=10)
+        res1 = self.eval_expr(inpvec, intz, x, y)
+        jac1 = intz.jacobian().toarray()
+        # reassigning the same values reuses all results
+        res2 = self.eval_expr(inpvec.copy(), intz, x, y)
+        jac2 = intz.jacobian().toarray()
+        self.assertTrue(np.all(res1 == res2))
+        self.assertTrue(np.all(jac1 == jac2))
+        self.assertEqual(intz.get_cache_stats(), {
+            'value_hits': 1, 'value_misses': 1,
+            'jacobian_hits': 1, 'jacobian_misses': 1
+        })
+        # a change of y must propagate to the values
+        # and the Jacobian matrix although x is unchanged
+        inpvec[4] = 7.
+        res3 = self.eval_expr(inpvec, intz, x, y)
+        jac3 = intz.jacobian().toarray()
+        x_ref = InputSelector([0, 1, 2], 6)
+        y_ref = InputSelector([3, 4, 5], 6)
+        intz_ref = Integral(x_ref * y_ref, [1, 2, 3], 'lin-log',
+                            maxord=10, cache=False)
+        res_ref = self.eval_expr(inpvec, intz_ref, x_ref, y_ref)
+        jac_ref = intz_ref.jacobian().toarray()
+        self.assertTrue(np.all(res3 == res_ref))
+        self.assertTrue(np.all(jac3 == jac_ref))
+        self.assertEqual(x.get_cache_stats()['value_misses'], 1)
+        self.assertEqual(y.get_cache_stats()['value_misses'], 2)
+
     def test_integral(self):
         inpvec = np.array([1, 2, 3, 4, 5, 6])
         x = InputSelector([0, 1, 2], 6)
@@ -287,6 +339,23 @@ class TestMappingJacobians(unittest.TestCase):
             xsidcs, inpvec, fisavg, xs, fisvals)
         )
 
+    def test_jacobian_vector_products(self):
+        inpvec = np.array([1., 2., 3., 4., 5., 6., 7.])
+        x = InputSelector([0, 1, 2], 7)
+        y = InputSelector([3, 4, 5], 7)
+        c = Const([1., 2., 3.])
+        z = (x * y + c) / (y + x)
+        intz = Integral(z, [1, 2, 3], 'lin-log', maxord=10)
+        w = Replicator(intz, 3) * x
+        jac = self.eval_test_jacobian(inpvec, w, x, y)
+        np.random.seed(17)
+        vec = np.random.normal(size=7)
+        adj = np.random.normal(size=3)
+        self.assertTrue(np.allclose(w.jvp(vec), jac @ vec,
+                                    rtol=1e-12, atol=1e-14))
+        self.assertTrue(np.allclose(w.vjp(adj), jac.T @ adj,
+                                    rtol=1e-12, atol=1e-14))
+
 
 if __name__ == '__main__':
     unittest.main()
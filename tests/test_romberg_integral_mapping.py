@@ -53,6 +53,20 @@ class TestRombergIntegralMapping(unittest.TestCase):
         test_intval2 = compute_romberg_integral(perm_x, np.square, maxord=20, atol=1e-4, rtol=1e-4)
         self.assertTrue(np.all(test_intval1 == test_intval2))
 
+    def test_function_evaluated_once_per_point(self):
+        x = [1,5]
+        evaluated = []
+        def myfun(x):
+            evaluated.append(x)
+            return np.exp(x)
+        test_intval, stats = compute_romberg_integral(
+            x, myfun, maxord=20, atol=1e-8, rtol=1e-8, ret_stats=True
+        )
+        evaluated = np.concatenate(evaluated)
+        self.assertEqual(len(np.unique(evaluated)), len(evaluated))
+        self.assertEqual(stats['num_fun_points'], len(evaluated))
+        self.assertEqual(len(evaluated), 2**(stats['num_levels']-1) + 1)
+
 
 class TestRombergIntegralJacobian(unittest.TestCase):
 
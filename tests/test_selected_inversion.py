@@ -0,0 +1,60 @@
+import unittest
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix, random as sprandom, identity
+from sksparse.cholmod import cholesky
+from gmapy.selected_inversion import selected_inverse, is_covered_by_pattern
+from gmapy.linear_solvers import LinearSolver
+
+
+class TestSelectedInversion(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        dim = 200
+        X = sprandom(dim, dim, density=0.01, random_state=31)
+        A = X @ X.T + identity(dim)
+        cls._A = csc_matrix(A)
+        cls._dim = dim
+
+    def test_selected_inverse_matches_inverse(self):
+        A = self._A
+        Z = selected_inverse(A).tocoo()
+        refZ = np.linalg.inv(A.toarray())
+        self.assertTrue(np.allclose(Z.data, refZ[Z.row, Z.col]))
+        self.assertTrue(np.allclose(np.sort(Z.row), np.sort(Z.col)))
+
+    def test_selected_inverse_contains_diagonal(self):
+        A = self._A
+        fact = cholesky(A)
+        Z = selected_inverse(factor=fact)
+        refZ = np.linalg.inv(A.toarray())
+        self.assertTrue(np.allclose(Z.diagonal(), np.diag(refZ)))
+
+    def test_selected_inverse_covers_pattern_of_matrix(self):
+        # the pattern of the factor includes the pattern of A
+        A = self._A
+        Z = selected_inverse(A)
+        Acoo = A.tocoo()
+        Zdense = Z.toarray()
+        self.assertTrue(np.all(Zdense[Acoo.row, Acoo.col] != 0.))
+
+    def test_quadratic_forms_of_covered_rows(self):
+        A = self._A
+        solver = LinearSolver(A, backend='cholmod')
+        Z = solver.selected_inv()
+        S = csr_matrix(sprandom(50, self._dim, density=0.01, random_state=5))
+        is_covered = is_covered_by_pattern(S, Z)
+        self.assertTrue(np.any(is_covered))
+        refZ = np.linalg.inv(A.toarray())
+        Sd = S.toarray()
+        refvals = np.sum((Sd @ refZ) * Sd, axis=1)
+        vals = np.ravel(np.sum(S.multiply(S @ Z), axis=1))
+        self.assertTrue(np.allclose(vals[is_covered], refvals[is_covered]))
+        # the result is cached until the next factorization
+        self.assertTrue(solver.selected_inv() is Z)
+        solver.factorize(A * 2.)
+        self.assertFalse(solver.selected_inv() is Z)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import unittest
+import pathlib
+import numpy as np
+from scipy.sparse import csr_matrix, block_diag, diags
+from gmapy.data_management.structured_covmat import StructuredCovariance
+from gmapy.data_management.unc_utils import scale_covmat
+from gmapy.data_management.uncfuns import (
+    create_prior_covmat,
+    create_experimental_covmat
+)
+from gmapy.gma_database_class import GMADatabase
+
+
+class TestStructuredCovariance(unittest.TestCase):
+
+    def create_random_block(self, n):
+        X = np.random.rand(n, n)
+        return X @ X.T + np.identity(n)
+
+    def setUp(self):
+        np.random.seed(42)
+        blocks = [self.create_random_block(n) for n in (3, 5, 2)]
+        priorvars = np.random.rand(4) + 0.5
+        usuvars = np.random.rand(3) + 0.5
+        self._covmat = StructuredCovariance.concatenate([
+            StructuredCovariance.from_diagonal(priorvars, 'prior'),
+            StructuredCovariance.from_blocks(blocks, 'exp'),
+            StructuredCovariance.from_diagonal(usuvars, 'usu')
+        ])
+        self._dense = block_diag(
+            [diags(priorvars)] + blocks + [diags(usuvars)]
+        ).toarray()
+
+    def test_matrix_assembly(self):
+        covmat = self._covmat
+        self.assertEqual(covmat.shape, self._dense.shape)
+        self.assertTrue(np.all(covmat.toarray() == self._dense))
+        self.assertTrue(np.all(covmat.diagonal() == self._dense.diagonal()))
+        self.assertTrue(np.all(covmat.get_kind_idcs('usu') == [14, 15, 16]))
+        self.assertEqual(len(covmat.get_blocks('exp')), 3)
+
+    def test_solve_logdet_and_inverse(self):
+        covmat = self._covmat
+        dense = self._dense
+        b = np.random.rand(dense.shape[0], 2)
+        x = np.linalg.solve(dense, b)
+        self.assertTrue(np.allclose(covmat(b), x))
+        self.assertTrue(np.allclose(covmat(b[:,0]), x[:,0]))
+        bsp = csr_matrix(np.where(b > 0.5, b, 0.))
+        self.assertTrue(np.allclose(covmat(bsp).toarray(),
+                                    np.linalg.solve(dense, bsp.toarray())))
+        self.assertTrue(np.isclose(covmat.logdet(),
+                                   np.linalg.slogdet(dense)[1]))
+        self.assertTrue(np.allclose(covmat.inv().toarray(),
+                                    np.linalg.inv(dense)))
+        z = covmat.whiten(b[:,0])
+        self.assertTrue(np.isclose(z @ z, b[:,0] @ x[:,0]))
+        self.assertTrue(np.allclose(covmat @ b, dense @ b))
+
+    def test_select(self):
+        covmat = self._covmat
+        covmat.factorize()
+        sel = np.full(covmat.shape[0], True)
+        sel[[0, 5]] = False
+        subcov = covmat.select(sel)
+        self.assertTrue(np.all(subcov.toarray() ==
+                               self._dense[np.ix_(sel, sel)]))
+        # the unchanged blocks keep their factorization
+        self.assertEqual(np.sum(subcov.is_factorized()), 3)
+        idcs = np.array([15, 3, 8, 7])
+        subcov = covmat.select(idcs)
+        self.assertTrue(np.all(subcov.toarray() ==
+                               self._dense[np.ix_(idcs, idcs)]))
+
+    def test_set_diagonal(self):
+        covmat = self._covmat
+        covmat.factorize()
+        idcs = np.array([4, 15])
+        covmat.set_diagonal(idcs, [10., 20.])
+        dense = self._dense.copy()
+        dense[idcs, idcs] = [10., 20.]
+        self.assertTrue(np.all(covmat.toarray() == dense))
+        # only the blocks concerned need a new factorization
+        self.assertEqual(np.sum(~covmat.is_factorized()), 2)
+        self.assertTrue(np.allclose(covmat(np.ones(17)),
+                                    np.linalg.solve(dense, np.ones(17))))
+
+    def test_set_diagonal_uncorrelated(self):
+        covmat = self._covmat
+        idcs = np.array([5, 2])
+        covmat.set_diagonal(idcs, [3., 4.], uncorrelated=True)
+        dense = self._dense.copy()
+        dense[idcs,:] = 0.
+        dense[:,idcs] = 0.
+        dense[idcs, idcs] = [3., 4.]
+        self.assertTrue(np.all(covmat.toarray() == dense))
+        self.assertFalse(covmat.is_correlated([5]))
+        self.assertTrue(covmat.is_correlated([6]))
+
+    def test_scale_and_replace(self):
+        covmat = self._covmat
+        covmat.factorize()
+        sclvec = np.random.rand(covmat.shape[0]) + 0.1
+        scaled = covmat.scale(sclvec)
+        expected = scale_covmat(self._dense, sclvec)
+        self.assertTrue(np.allclose(scaled.toarray(), expected))
+        self.assertTrue(np.all(scaled.is_factorized()))
+        self.assertTrue(np.isclose(scaled.logdet(),
+                                   np.linalg.slogdet(expected)[1]))
+        idcs = np.array([0, 1, 16])
+        newcov = StructuredCovariance.from_sparse(
+            np.array([[1., 0.5, 0.], [0.5, 1., 0.], [0., 0., 2.]]), 'new'
+        )
+        covmat.replace(idcs, newcov)
+        dense = self._dense.copy()
+        dense[idcs,:] = 0.
+        dense[:,idcs] = 0.
+        dense[np.ix_(idcs, idcs)] = newcov.toarray()
+        self.assertTrue(np.all(covmat.toarray() == dense))
+        self.assertTrue(np.all(covmat.get_kind_idcs('new') == idcs))
+
+    def test_from_sparse(self):
+        dense = self._dense.copy()
+        dense[9,:] = 0.
+        dense[:,9] = 0.
+        covmat = StructuredCovariance.from_sparse(csr_matrix(dense), 'block')
+        self.assertTrue(np.all(covmat.toarray() == dense))
+        self.assertTrue(np.all(covmat.diagonal() == dense.diagonal()))
+        # a row with zero variance cannot be factorized
+        with self.assertRaises(ValueError):
+            covmat.factorize()
+
+    def test_covmat_of_gma_database(self):
+        dbpath = (pathlib.Path(__file__).parent / 'testdata' /
+                'data-2017-07-26.gma').resolve().as_posix()
+        gmadb = GMADatabase(dbpath)
+        dt = gmadb.get_datatable()
+        db = gmadb._raw_database
+        normsel = dt['NODE'].str.match('norm_', na=False).to_numpy()
+        normuncs = dt.loc[normsel, 'UNC'].to_numpy()
+        expected = block_diag([
+            create_prior_covmat(db['prior_list']),
+            create_experimental_covmat(db['datablock_list']),
+            diags(np.square(normuncs))
+        ], format='csr')
+        self.assertTrue((gmadb.get_covmat() != expected).nnz == 0)
+        covmat = gmadb.get_structured_covmat()
+        self.assertEqual(len(covmat.get_blocks('exp')),
+                         len(db['datablock_list']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import numpy as np
+from gmapy.data_management.unc_utils import (
+    fix_cormat,
+    nearest_cormat,
+    clip_cormat_eigenvalues,
+    shrink_cormat
+)
+
+
+class TestFixCormat(unittest.TestCase):
+
+    def create_cormat(self, n=30, seed=14):
+        np.random.seed(seed)
+        X = np.random.rand(n, n)
+        cormat = np.corrcoef(X)
+        np.fill_diagonal(cormat, 1.)
+        # perturb correlations to destroy positive definiteness
+        sel = np.triu(np.ones((n, n), dtype=bool), 1)
+        cormat[sel] += 0.3 * (np.random.rand(np.sum(sel)) - 0.5)
+        cormat[sel] = np.clip(cormat[sel], -1, 1)
+        cormat.T[sel] = cormat[sel]
+        self.assertTrue(np.any(np.linalg.eigvalsh(cormat) < 0))
+        return cormat
+
+    def assert_valid_cormat(self, cormat):
+        self.assertTrue(np.all(cormat.diagonal() == 1))
+        self.assertTrue(np.allclose(cormat, cormat.T))
+        np.linalg.cholesky(cormat)
+
+    def test_positive_definite_cormat_unchanged(self):
+        cormat = np.array([[1., 0.5], [0.5, 1.]])
+        res, dist = fix_cormat(cormat, return_distance=True)
+        self.assertTrue(np.all(res == cormat))
+        self.assertEqual(dist, 0.)
+
+    def test_nearest_cormat_of_higham_example(self):
+        # example in section 4 of Higham (2002)
+        cormat = np.array([[1., 1., 0.], [1., 1., 1.], [0., 1., 1.]])
+        res = nearest_cormat(cormat, min_eig=0.)
+        expected = np.array([[1., 0.7607, 0.1573],
+                             [0.7607, 1., 0.7607],
+                             [0.1573, 0.7607, 1.]])
+        self.assertTrue(np.allclose(res, expected, atol=1e-4))
+
+    def test_repair_methods(self):
+        cormat = self.create_cormat()
+        dists = {}
+        for method in ('higham', 'clip', 'shrink'):
+            res, dists[method] = fix_cormat(cormat, method=method,
+                                            return_distance=True)
+            self.assert_valid_cormat(res)
+            self.assertTrue(np.isclose(dists[method],
+                                       np.linalg.norm(res - cormat)))
+        self.assertLess(dists['higham'], dists['clip'])
+        self.assertLess(dists['clip'], dists['shrink'])
+
+    def test_auto_method_depends_on_size(self):
+        cormat = self.create_cormat()
+        res1 = fix_cormat(cormat, method='auto', max_higham_size=30)
+        res2 = fix_cormat(cormat, method='auto', max_higham_size=29)
+        self.assertTrue(np.allclose(res1, nearest_cormat(cormat)))
+        self.assertTrue(np.allclose(res2, clip_cormat_eigenvalues(cormat)))
+
+    def test_shrink_is_default_method(self):
+        cormat = self.create_cormat(seed=15)
+        res = fix_cormat(cormat)
+        self.assertTrue(np.all(res == shrink_cormat(cormat)))
+        # the input matrix is not modified
+        self.assertTrue(np.any(np.linalg.eigvalsh(cormat) < 0))
+
+    def test_invalid_input(self):
+        with self.assertRaises(ValueError):
+            fix_cormat(np.array([[2., 0.], [0., 1.]]))
+        with self.assertRaises(ValueError):
+            fix_cormat(np.eye(2), method='unknown')
+
+
+if __name__ == '__main__':
+    unittest.main()